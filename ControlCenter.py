@@ -25,9 +25,14 @@ auth_key = "8194d5119dbdfaa09a45db0e3d2b53fd68a62696e1cac3579ec9991c834820f2"
 
 # Class representing the control center system
 class ControlCenter:
-    def __init__(self, address: str, port: int = 8080):
-        # Initialize MQTT client for train communications
-        self.mqttclient: Client = Client("control-center")
+    def __init__(self, address: str, port: int = 8080, share_group: str | None = None):
+        # Initialize MQTT client for train communications; control centers sharing the load need distinct ids.
+        # Train updates are comma separated text, so payloads are delivered as str
+        self.mqttclient: Client = Client(f"control-center-{address}" if share_group else "control-center",
+                                         payload_type=str)
+
+        # Shared subscription group: the broker gives each train update to one control center of the group
+        self.share_group: str | None = share_group
         
         # Dictionary to store train ID with their current locations
         self.current_train_locations: dict[str, list[int]] = dict() 
@@ -137,12 +142,10 @@ class ControlCenter:
                 self.locations.append([command[1], command[2], command[3], round(time.time(), 2)])
                 print(self.locations)
             # Handle location update command
+            # Trains first seen through a retained location (e.g. after a restart) are added here
             elif(command[0] == "location"):
-                if(command[1] in self.current_train_locations):
-                    self.current_train_locations[command[1]] = [command[2], command[3]]
-                    self.locations.append([command[1], command[2], command[3], round(time.time(), 2)])
-                else:
-                    print(f'invalid train: {command[1]}')
+                self.current_train_locations[command[1]] = [command[2], command[3]]
+                self.locations.append([command[1], command[2], command[3], round(time.time(), 2)])
             # Handle route update command
             elif(command[0] == "route"):
                 self.current_train_routes[command[1]] = [command[2], command[3]]
@@ -151,9 +154,13 @@ class ControlCenter:
 
     # Connect to MQTT broker and subscribe to train updates
     def connect(self, broker: str, port: int, keep_alive: int = 10):
-        self.mqttclient.connect(broker, port, keep_alive)
+        # Resume the session after a reconnect; topic aliases shorten the train updates we receive
+        self.mqttclient.connect(broker, port, keep_alive, clean_start=False, topic_alias_maximum=1024)
         self.mqttclient.loop()
-        self.mqttclient.subscribe(f"trains/#")
+        if(self.share_group):
+            self.mqttclient.subscribe(f"$share/{self.share_group}/trains/#")
+        else:
+            self.mqttclient.subscribe(f"trains/#")
 
     # Start listening to MQTT and HTTP simultaneously
     def start(self):
@@ -166,16 +173,18 @@ class ControlCenter:
 if __name__ == "__main__":
 
     # Check for required number of command-line arguments
-    if len(sys.argv) != 3:
-        print("Usage: python ControlCenter.py <BrokerIP> <HTTP_IP>")
+    if len(sys.argv) not in (3, 4):
+        print("Usage: python ControlCenter.py <BrokerIP> <HTTP_IP> [<ShareGroup>]")
         sys.exit(1)
 
     # Extract MQTT broker IP and HTTP server IP
     broker_ip = sys.argv[1]
     http_ip = sys.argv[2]
+    # Optional shared subscription group, to spread train updates across several control centers
+    share_group = sys.argv[3] if len(sys.argv) == 4 else None
 
     # Create and configure control center object
-    control_center = ControlCenter(http_ip, 83)
+    control_center = ControlCenter(http_ip, 83, share_group)
     # Connect to the MQTT broker
     control_center.connect(broker_ip, 1883)
     # Start both MQTT client and HTTP server
@@ -1,3 +1,5 @@
+import struct
+
 # Import utility functions from utils module (like int_to_var_bytes)
 from utils import * 
 
@@ -23,6 +25,8 @@ AUTH = 15
 
 # Class representing the fixed header of an MQTT packet
 class FixedHeader:
+    __slots__ = ("packet_type", "flags")           # No per-object __dict__, one is built for every packet
+
     def __init__(self, packet_type: int, flags: int = 0):
         self.packet_type = packet_type              # Store packet type (e.g., CONNECT, PUBLISH)
         
@@ -34,9 +38,8 @@ class FixedHeader:
         # Remaining length will be calculated later during encoding (not stored here)
 
     def encode(self):
-        # Combine packet type (high nibble) and flags (low nibble), then convert to single byte
-        encoded = (self.packet_type << 4 | self.flags).to_bytes(1, byteorder='big')
-        return encoded                              # Return the fixed header byte
+        # Combine packet type (high nibble) and flags (low nibble) into the shared single byte
+        return SINGLE_BYTES[self.packet_type << 4 | self.flags]
 
     @classmethod
     def decode(cls, encoded: bytes):
@@ -51,41 +54,117 @@ class FixedHeader:
 
 # Class representing the entire MQTT packet including fixed and variable parts
 class MQTTPacket:
+    __slots__ = ("fixed_header", "variable_data")
 
     def __init__(self, fixed_header: FixedHeader, variable_data = None):
         self.fixed_header = fixed_header                  # Store fixed header
 
         # Check if packet type requires variable header, and it hasn't been provided
         if(self.fixed_header.packet_type in variableheaders.variableHeaders
-           and variable_data == None):
+           and variable_data is None):
             raise ValueError("Variable data required for this packet type")  # Raise error
 
         self.variable_data = variable_data                # Store variable header / payload (if any)
 
     def encode(self):
-        encoded = b""                                     # Initialize empty byte string for encoded output
-
-        if(self.variable_data): 
-            encoded += self.variable_data.encode()        # Encode variable header and payload
+        variable_data = self.variable_data
+        if(variable_data is None):
+            return self.fixed_header.encode() + b'\x00'  # Remaining length 0
 
-        # Prepend remaining length using MQTT variable-length encoding
-        encoded = int_to_var_bytes(len(encoded)) + encoded
-
-        # Prepend fixed header at the beginning
-        encoded = self.fixed_header.encode() + encoded
+        # Encode variable header and payload; a PUBLISH keeps them apart so its payload is copied only once
+        if(isinstance(variable_data, variableheaders.PublishHeader)):
+            header, payload = variable_data.encode_parts()
+        else:
+            header, payload = variable_data.encode(), b""
 
-        return encoded                                     # Return full encoded packet
+        # Fixed header, remaining length (MQTT variable-length encoding) and body, joined in one allocation
+        return b"".join((self.fixed_header.encode(), int_to_var_bytes(len(header) + len(payload)), header, payload))
     
     @classmethod
-    def decode(cls, encoded: bytes):
-        # Decode fixed header from the first byte
+    def decode(cls, encoded: bytes | memoryview):
+        # Decode fixed header from the first byte; type 0 is reserved
         fixed_header = FixedHeader.decode(encoded)
+        if(not fixed_header.packet_type):
+            raise ValueError("Reserved packet type 0")
 
         variable_data = None
 
-        # If packet type requires variable header, decode it using corresponding decode class
-        if(fixed_header.packet_type in variableheaders.variableHeaders):
-            variable_data = variableheaders.variableHeaders[fixed_header.packet_type].decode(encoded)
+        # If packet type requires variable header, decode it in place using corresponding decode class,
+        # starting past the remaining length (decoded once, here)
+        decode_variable = variableheaders.variableHeaders.get(fixed_header.packet_type)
+        if(decode_variable is not None):
+            try:
+                remaining_len, start = decode_var_int(encoded, 1)
+                if(start + remaining_len > len(encoded)):
+                    raise ValueError("Truncated packet")
+                variable_data = decode_variable.decode(encoded, start)
+            except IndexError:
+                raise ValueError("Malformed packet")      # Fields running past the end of the packet
 
         # Return full decoded MQTTPacket object
         return MQTTPacket(fixed_header, variable_data= variable_data)
+
+    @classmethod
+    def decode_head(cls, encoded: bytes | memoryview):
+        # Decode the head of a streamed PUBLISH (see FrameReader): the remaining length also counts the
+        # payload still to come, so the decoded payload is empty
+        try:
+            _, start = decode_var_int(encoded, 1)
+            variable_data = variableheaders.LazyPublishVariableHeader(encoded, start)
+        except IndexError:
+            raise ValueError("Malformed packet")
+        return MQTTPacket(FixedHeader.decode(encoded), variable_data)
+
+
+# Encodes many packets into a single buffer, e.g. a batch of PUBLISHes sent with one syscall. Every part of every
+# packet goes into one join, so the buffer is allocated once at its final size, and remaining lengths are written
+# from the shared single byte table. If `ends` is given, the end offset of each frame is appended to it.
+def encode_many(packets: list[MQTTPacket], ends: list[int] | None = None):
+    parts = []
+    append = parts.append
+    offset = 0
+    for packet in packets:
+        variable_data = packet.variable_data
+        if(variable_data is None):
+            header, payload = b"", b""
+        elif(isinstance(variable_data, variableheaders.PublishHeader)):
+            header, payload = variable_data.encode_parts()
+        else:
+            header, payload = variable_data.encode(), b""
+        append(packet.fixed_header.encode())
+        length = len(header) + len(payload)
+        offset += length + 2
+        while(length >= 128):                                # Variable byte integer, 7 bits per byte
+            append(SINGLE_BYTES[length & 127 | 128])
+            length >>= 7
+            offset += 1
+        append(SINGLE_BYTES[length])
+        append(header)
+        append(payload)
+        if(ends is not None): ends.append(offset)
+    return b"".join(parts)
+
+
+# Head of a PUBLISH whose payload of payload_len bytes is sent separately, in chunks, right after it
+def publish_head(flags: int, topic_name: str, payload_len: int, packet_id: int | None = None,
+                 properties: dict | None = None):
+    header, _ = variableheaders.PublishVariableHeader(topic_name, b"", packet_id, properties).encode_parts()
+    return b"".join((FixedHeader(PUBLISH, flags).encode(), int_to_var_bytes(len(header) + payload_len), header))
+
+
+# Frames sent over and over, encoded once. Acknowledgements are packed from a precompiled layout with the
+# packet id filled in, without building and encoding packet objects.
+PINGREQ_PACKET = MQTTPacket(FixedHeader(PINGREQ)).encode()
+PINGRESP_PACKET = MQTTPacket(FixedHeader(PINGRESP)).encode()
+ACK_LAYOUT = struct.Struct(">BBHBB")                      # Type, remaining length 4, packet id, two single bytes
+
+# PUBACK: packet id, reason code, no properties
+def puback_packet(packet_id: int, reason_code: int = 0x00):
+    return ACK_LAYOUT.pack(PUBACK << 4, 4, packet_id, reason_code, 0)
+
+# SUBACK: packet id, no properties, one reason code per topic filter (the granted QoS or a failure code)
+def suback_packet(packet_id: int, reason_codes: list[int]):
+    if(len(reason_codes) == 1):
+        return ACK_LAYOUT.pack(SUBACK << 4, 4, packet_id, 0, reason_codes[0])
+    return b"".join((bytes((SUBACK << 4,)), int_to_var_bytes(3 + len(reason_codes)), packet_id.to_bytes(2), b"\x00",
+                     bytes(reason_codes)))
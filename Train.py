@@ -7,6 +7,10 @@ import threading
 import random
 import sys
 import math
+from utils import MESSAGE_EXPIRY_INTERVAL
+
+# Seconds a location update stays useful; older ones are dropped by the broker instead of delivered late
+LOCATION_EXPIRY = 10
 
 # Dictionary of major non-coastal cities in India with their [latitude, longitude]
 TOP_CITIES = {
@@ -69,8 +73,9 @@ class Train:
                 self.pos[0] = round(src_coords[0] + (dest_coords[0]-src_coords[0])/self.steps * self.current_steps, 4)
                 self.pos[1] = round(src_coords[1] + (dest_coords[1]-src_coords[1])/self.steps * self.current_steps, 4)
 
-                # Publish current location to the broker
-                self.client.publish(f"trains/{self.id}", f"location,{self.id},{self.pos[0]},{self.pos[1]}")
+                # Publish current location to the broker, retained so new subscribers get it straight away
+                self.client.publish(f"trains/{self.id}", f"location,{self.id},{self.pos[0]},{self.pos[1]}", 0b0001,
+                                    {MESSAGE_EXPIRY_INTERVAL: LOCATION_EXPIRY})
 
             else:
                 # Reached destination: set new source to old destination
@@ -84,15 +89,15 @@ class Train:
                 self.steps = int(math.sqrt((TOP_CITIES[self.dest][0] - TOP_CITIES[self.src][0])**2 
                                            + (TOP_CITIES[self.dest][1] - TOP_CITIES[self.src][1])**2) * 2)
 
-                # Publish route update message
-                self.client.publish(f"trains/{self.id}", f"route,{self.id},{self.src},{self.dest}")
+                # Publish route update message, retained on its own topic so it is not replaced by locations
+                self.client.publish(f"trains/{self.id}/route", f"route,{self.id},{self.src},{self.dest}", 0b0001)
 
             # Wait for 1 second between steps to simulate movement speed
             time.sleep(1)
 
     # Connect the train client to MQTT broker
     def connect(self, broker: str, port: int, keep_alive: int = 10):
-        self.client.connect(broker, port, keep_alive)        # Connect to broker
+        self.client.connect(broker, port, keep_alive, clean_start=False)   # Keep commands queued across reconnects
         self.client.loop()                                   # Start MQTT loop to handle messages
         self.client.subscribe(f"trains/{self.id}")           # Subscribe to its own topic for commands
 
@@ -0,0 +1,29 @@
+# Connection admission control: limits how fast the broker accepts CONNECTs during a reconnect storm
+import threading, time
+
+
+class TokenBucket:
+    '''
+    Token bucket rate limiter:
+    bucket.take(now): spends one token and returns True, or returns False when the bucket is empty.
+    Tokens refill at `rate` per second up to `burst`, so up to `burst` connections are accepted at once
+    and `rate` per second after that. Thread safe, the threaded engine admits clients from many threads.
+    '''
+    __slots__ = ("rate", "burst", "tokens", "updated", "lock")
+
+    def __init__(self, rate: float, burst: int | None = None):
+        self.rate = rate
+        self.burst = burst if burst else max(1, int(rate))    # Default: one second's worth of connections
+        self.tokens = float(self.burst)                         # Starts full
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, now: float | None = None):
+        if(now is None): now = time.monotonic()
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if(self.tokens < 1):
+                return False
+            self.tokens -= 1
+            return True
@@ -0,0 +1,46 @@
+# Microbenchmark: per-message codec cost of a PUBLISH payload handled as UTF-8 text vs as bytes
+# Run from the repository root: python -m benchmarks.binary_payloads [--sizes 16,256,4096,65536]
+import argparse, os
+from MQTTPacket import FixedHeader, MQTTPacket
+from variableheaders import *
+from utils import *
+from benchmarks.common import ns_per_call
+
+
+# Text: the payload is encoded to UTF-8 when sending and decoded back to a str on delivery
+def roundtrip_text(payload: str):
+    encoded = MQTTPacket(FixedHeader(PUBLISH, 0b0010), PublishVariableHeader("trains/train1", payload, 7)).encode()
+    return str(MQTTPacket.decode(encoded).variable_data.payload, 'utf-8')
+
+
+# Bytes: the payload goes into the packet as is and is delivered as a copy (Client's default payload_type)
+def roundtrip_bytes(payload: bytes):
+    encoded = MQTTPacket(FixedHeader(PUBLISH, 0b0010), PublishVariableHeader("trains/train1", payload, 7)).encode()
+    return bytes(MQTTPacket.decode(encoded).variable_data.payload)
+
+
+# Memoryview: as bytes, but delivered as a view of the packet (payload_type=memoryview)
+def roundtrip_view(payload: bytes):
+    encoded = MQTTPacket(FixedHeader(PUBLISH, 0b0010), PublishVariableHeader("trains/train1", payload, 7)).encode()
+    return MQTTPacket.decode(encoded).variable_data.payload
+
+
+if(__name__ == "__main__"):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="16,256,4096,65536", help="payload sizes in bytes")
+    parser.add_argument("--rounds", type=int, default=20000)
+    args = parser.parse_args()
+
+    print("QoS 1 PUBLISH encode + decode + delivery, per message")
+    print(f"{'payload B':>9} {'str us':>8} {'bytes us':>9} {'memoryview us':>14} {'time saved':>11}")
+    for size in map(int, args.sizes.split(",")):
+        binary = os.urandom(size)
+        text = "é" * (size // 2)                                    # Same size once UTF-8 encoded
+        assert roundtrip_bytes(binary) == binary and roundtrip_text(text) == text
+        rounds = max(100, args.rounds * 16 // max(size, 16))
+        text_time = ns_per_call(lambda: roundtrip_text(text), rounds)
+        bytes_time = ns_per_call(lambda: roundtrip_bytes(binary), rounds)
+        view_time = ns_per_call(lambda: roundtrip_view(binary), rounds)
+        print(f"{size:>9} {text_time/1e3:>8.2f} {bytes_time/1e3:>9.2f} {view_time/1e3:>14.2f} "
+              f"{1-bytes_time/text_time:>10.0%}")
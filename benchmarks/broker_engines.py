@@ -0,0 +1,127 @@
+# Benchmark comparing the threaded and selector broker engines
+# Run from the repository root: python -m benchmarks.broker_engines [--connections N] [--messages N]
+import argparse, resource, socket, subprocess, sys, threading, time
+from MQTTPacket import FixedHeader, MQTTPacket
+from variableheaders import *
+from utils import *
+from framereader import FrameReader
+
+
+# Open a raw socket and complete the CONNECT/CONNACK handshake
+def mqtt_connect(port: int, client_id: str, keep_alive: int = 600):
+    sock = socket.create_connection(("127.0.0.1", port), timeout=10)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.sendall(MQTTPacket(FixedHeader(CONNECT), ConnectVariableHeader(client_id, keep_alive)).encode())
+    connack = sock.recv(2)
+    if(len(connack) < 2 or connack[0] >> 4 != CONNACK):
+        raise ConnectionError(f"no CONNACK for {client_id}")
+    remaining = connack[1]                                            # CONNACK is short, one length byte
+    while remaining:
+        remaining -= len(sock.recv(remaining))                        # Flags, reason code and properties
+    return sock
+
+
+# Start broker.py in a subprocess and wait until it completes a handshake
+def start_broker(engine: str, port: int, *options: str):
+    proc = subprocess.Popen([sys.executable, "broker.py", "127.0.0.1", "--port", str(port), "--engine", engine, *options],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            sock = mqtt_connect(port, "probe")
+            sock.sendall(MQTTPacket(FixedHeader(DISCONNECT), DisconnectVariableHeader(0x00)).encode())
+            sock.close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError(f"{engine} broker did not start")
+
+
+# Count the PUBLISH packets arriving on a socket until `expected` are seen or the deadline passes
+def count_publishes(sock: socket.socket, expected: int, deadline: float, result: dict):
+    reader = FrameReader()
+    received = 0
+    sock.settimeout(0.5)
+    while received < expected and time.time() < deadline:
+        try:
+            if(not reader.recv_from(sock)): break
+        except socket.timeout:
+            continue
+        for frame in reader.frames():
+            if(frame[0] >> 4 == PUBLISH): received += 1
+    result["received"] = received
+    result["finished"] = time.time()
+
+
+# Hold as many idle connections as possible and report how many the broker accepted
+def bench_connections(port: int, count: int):
+    socks = []
+    start = time.time()
+    for i in range(count):
+        try:
+            socks.append(mqtt_connect(port, f"idle-{i}"))
+        except OSError:
+            break
+    elapsed = time.time() - start
+    return socks, elapsed
+
+
+# One subscriber on bench/#, several publishers pipelining QoS 0 publishes
+def bench_throughput(port: int, publishers: int, messages: int, payload_size: int):
+    sub = mqtt_connect(port, "bench-sub")
+    sub.sendall(MQTTPacket(FixedHeader(SUBSCRIBE), SubscribeVariableHeader(1, [("bench/#", 0)])).encode())
+    sub.recv(16)                                                      # SUBACK
+
+    pubs = [mqtt_connect(port, f"bench-pub-{i}") for i in range(publishers)]
+    payload = "x"*payload_size
+    expected = publishers*messages
+    result = dict()
+    counter = threading.Thread(target=count_publishes, args=(sub, expected, time.time()+60, result))
+    counter.start()
+
+    def publish_all(sock: socket.socket, i: int):
+        packet = MQTTPacket(FixedHeader(PUBLISH), PublishVariableHeader(f"bench/{i}", payload)).encode()
+        batch = packet*100
+        for _ in range(messages//100):
+            sock.sendall(batch)
+        sock.sendall(packet*(messages%100))
+
+    start = time.time()
+    threads = [threading.Thread(target=publish_all, args=(sock, i)) for i, sock in enumerate(pubs)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    counter.join()
+
+    for sock in pubs+[sub]: sock.close()
+    elapsed = result["finished"] - start
+    return result["received"], expected, elapsed
+
+
+if(__name__ == "__main__"):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connections", type=int, default=2000)
+    parser.add_argument("--publishers", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=20000, help="messages per publisher")
+    parser.add_argument("--payload", type=int, default=32)
+    parser.add_argument("--engines", default="threaded,selector")
+    args = parser.parse_args()
+
+    # Both ends need a file descriptor per connection
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    port = 18830
+    for engine in args.engines.split(","):
+        proc = start_broker(engine, port)
+        try:
+            socks, elapsed = bench_connections(port, args.connections)
+            print(f"{engine:>9}: held {len(socks)}/{args.connections} connections (connect took {elapsed:.2f}s)")
+            received, expected, elapsed = bench_throughput(port, args.publishers, args.messages, args.payload)
+            print(f"{engine:>9}: forwarded {received}/{expected} messages in {elapsed:.2f}s "
+                  f"({received/elapsed:,.0f} msgs/sec) with {len(socks)} idle connections open")
+            for sock in socks: sock.close()
+        finally:
+            proc.kill()
+            proc.wait()
+        port += 1
@@ -0,0 +1,98 @@
+# Microbenchmarks for the packet codec: decoding by slicing copies of the packet (the previous decoder, kept
+# here for comparison) vs in place by offsets, with lazily decoded PUBLISH fields.
+# Reports ns per packet and bytes allocated per packet (tracemalloc peak while decoding one packet).
+# Run from the repository root: python -m benchmarks.codec [--rounds 20000]
+import argparse
+from MQTTPacket import FixedHeader, MQTTPacket
+from variableheaders import *
+from utils import *
+from benchmarks.common import ns_per_call, allocated
+
+
+# Previous decoder: the fixed header is sliced off (copying the packet twice), then each field is sliced again
+def sliced_body(encoded: bytes):
+    encoded = encoded[1:]
+    _, i = decode_var_int(encoded, 0)
+    return encoded[i:]
+
+def sliced_publish(encoded: bytes):
+    var_header = sliced_body(encoded)
+    topic_name, topic_name_size = bytes_to_str(var_header)
+    i = topic_name_size+2
+    packet_id = None
+    if(encoded[0] & 0b0110):
+        packet_id = int.from_bytes(var_header[i:i+2])
+        i += 2
+    properties, props_size = decode_properties(var_header[i:])
+    i += props_size
+    payload = memoryview(encoded)[len(encoded)-len(var_header)+i:]
+    return PublishVariableHeader(topic_name, payload, packet_id, properties)
+
+def sliced_subscribe(encoded: bytes):
+    encoded = sliced_body(encoded)
+    packet_id = int.from_bytes(encoded[0:2])
+    properties, props_size = decode_properties(encoded[2:])
+    i = 2 + props_size
+    topics = []
+    while(i < len(encoded)):
+        topic_filter, topic_len = bytes_to_str(encoded[i:])
+        i += topic_len+2
+        topics.append((topic_filter, encoded[i]))
+        i += 1
+    return SubscribeVariableHeader(packet_id, topics, properties)
+
+def sliced_puback(encoded: bytes):
+    encoded = sliced_body(encoded)
+    packet_id = int.from_bytes(encoded[:2])
+    reason_code = encoded[2] if len(encoded) > 2 else 0x00
+    properties, _ = decode_properties(encoded[3:]) if len(encoded) > 3 else (None, 0)
+    return PubackVariableHeader(packet_id, reason_code, properties)
+
+SLICED = {PUBLISH: sliced_publish, SUBSCRIBE: sliced_subscribe, PUBACK: sliced_puback}
+
+
+# What each side reads from a decoded packet
+def route(publish):                                         # Broker: topic, packet id and properties
+    return publish.topic_name, publish.packet_id, publish.properties.get(MESSAGE_EXPIRY_INTERVAL)
+
+def deliver(publish):                                       # Client: properties (topic alias) and the payload
+    return publish.properties.get(TOPIC_ALIAS), bytes(publish.payload)
+
+def read_all(header):
+    if(isinstance(header, PublishHeader)): return route(header), deliver(header)
+    return [getattr(header, name) for name in header.__slots__]
+
+
+if(__name__ == "__main__"):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=20000, help="decodes per timed run (fewer for large packets)")
+    args = parser.parse_args()
+
+    location = b"location,train42,12.971599,77.594566"
+    cases = [
+        ("PUBLISH QoS 0, 36 B", MQTTPacket(FixedHeader(PUBLISH), PublishVariableHeader("trains/train42", location))),
+        ("PUBLISH QoS 1, 1 KiB", MQTTPacket(FixedHeader(PUBLISH, 0b0010),
+                                             PublishVariableHeader("trains/train42", b"x"*1024, 7))),
+        ("PUBLISH QoS 1, 64 KiB", MQTTPacket(FixedHeader(PUBLISH, 0b0010),
+                                              PublishVariableHeader("trains/train42", b"x"*65536, 7,
+                                                                    {MESSAGE_EXPIRY_INTERVAL: 10}))),
+        ("SUBSCRIBE, 3 filters", MQTTPacket(FixedHeader(SUBSCRIBE),
+                                            SubscribeVariableHeader(1, [("trains/#", 1), ("$SYS/#", 0), ("cc/+", 1)]))),
+        ("PUBACK", MQTTPacket(FixedHeader(PUBACK), PubackVariableHeader(7, 0x00))),
+    ]
+
+    print(f"{'packet':<22} {'use':<8} {'sliced ns':>10} {'in place ns':>12} {'sliced B':>9} {'in place B':>11}")
+    for name, packet in cases:
+        frame = packet.encode()
+        packet_type = frame[0] >> 4
+        sliced = lambda encoded: MQTTPacket(FixedHeader.decode(encoded), SLICED[encoded[0] >> 4](encoded)).variable_data
+        in_place = lambda encoded: MQTTPacket.decode(encoded).variable_data
+        uses = [("route", route), ("deliver", deliver), ("all", read_all)] if packet_type == PUBLISH else [("all", read_all)]
+        rounds = max(1000, args.rounds * 1024 // max(len(frame), 1024))
+        for use_name, use in uses:
+            old = lambda: use(sliced(frame))
+            new = lambda: use(in_place(frame))
+            old_ns, old_bytes = ns_per_call(old, rounds), allocated(old)
+            new_ns, new_bytes = ns_per_call(new, rounds), allocated(new)
+            print(f"{name:<22} {use_name:<8} {old_ns:>10,.0f} {new_ns:>12,.0f} {old_bytes:>9,} {new_bytes:>11,}")
@@ -0,0 +1,38 @@
+# Helpers shared by the benchmarks: timing a call, measuring what it allocates, and ending the process
+import os, sys, time, tracemalloc
+
+
+# Best nanoseconds per call of func() over `repeats` timed runs of `rounds` calls; the slower runs caught some noise.
+# Without rounds, the calls per run are doubled until one run takes at least min_time / repeats seconds.
+def ns_per_call(func, rounds: int | None = None, repeats: int = 5, min_time: float = 0.5):
+    if(rounds is None):
+        rounds = 1
+        while True:
+            start = time.perf_counter()
+            for _ in range(rounds): func()
+            if(time.perf_counter() - start >= min_time / repeats): break
+            rounds *= 2
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter_ns()
+        for _ in range(rounds): func()
+        best = min(best, (time.perf_counter_ns() - start) / rounds)
+    return best
+
+
+# Peak bytes allocated by one call of func() (tracemalloc)
+def allocated(func):
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak - before
+
+
+# End a benchmark that started Clients: their listener threads do not exit on their own, so the interpreter
+# would wait for them forever
+def shutdown(status: int = 0):
+    sys.stdout.flush()
+    os._exit(status)
@@ -0,0 +1,71 @@
+# Benchmark: a depot of trains reconnecting at once, with and without CONNECT rate limiting.
+# Silent connections that never send CONNECT are opened first, the broker must not let them hold up the rest.
+# Run from the repository root: python -m benchmarks.connect_storm [--trains 500] [--silent 20]
+import argparse, random, socket, threading, time
+from MQTTPacket import FixedHeader, MQTTPacket
+from variableheaders import *
+from utils import *
+from framereader import FrameReader
+from benchmarks.broker_engines import start_broker
+
+
+# Connect like a train after a power cycle: retry with a jittered backoff while the broker answers 0x9F
+def reconnect(port: int, client_id: str, backoff: float, result: dict):
+    start = time.perf_counter()
+    rng = random.Random(client_id)
+    attempts = 0
+    while True:
+        attempts += 1
+        sock = socket.create_connection(("127.0.0.1", port), timeout=30)
+        sock.sendall(MQTTPacket(FixedHeader(CONNECT), ConnectVariableHeader(client_id, 600)).encode())
+        connack = MQTTPacket.decode(FrameReader().read_frame(sock))
+        if(connack.variable_data.reason_code != 0x9F):            # 0x9F: Connection rate exceeded
+            break
+        sock.close()
+        time.sleep(backoff * (0.5 + rng.random()) * min(attempts, 8))
+    result[client_id] = (time.perf_counter() - start, attempts, connack.variable_data.reason_code, sock)
+
+
+def storm(engine: str, port: int, trains: int, silent: int, options: list[str], backoff: float):
+    proc = start_broker(engine, port, "--sys-interval", "0", *options)
+    idle = []
+    try:
+        for _ in range(silent):
+            idle.append(socket.create_connection(("127.0.0.1", port)))   # Connects, never sends CONNECT
+        result = dict()
+        threads = [threading.Thread(target=reconnect, args=(port, f"train{i}", backoff, result)) for i in range(trains)]
+        start = time.perf_counter()
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        for sock in idle: sock.close()
+        proc.kill(); proc.wait()
+    for _, _, _, sock in result.values(): sock.close()
+    latencies = sorted(latency for latency, _, _, _ in result.values())
+    accepted = sum(1 for _, _, reason_code, _ in result.values() if reason_code == 0x00)
+    rejected = sum(attempts-1 for _, attempts, _, _ in result.values())
+    return elapsed, accepted, rejected, latencies[len(latencies)//2], latencies[int(len(latencies)*0.99)]
+
+
+if(__name__ == "__main__"):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engine", choices=["threaded", "selector", "both"], default="both")
+    parser.add_argument("--port", type=int, default=18850)
+    parser.add_argument("--trains", type=int, default=500)
+    parser.add_argument("--silent", type=int, default=20, help="connections that never send CONNECT")
+    parser.add_argument("--connect-rate", type=float, default=200, help="CONNECTs per second for the limited run")
+    parser.add_argument("--connect-burst", type=int, default=50)
+    parser.add_argument("--backoff", type=float, default=0.1, help="base retry delay after CONNACK 0x9F, seconds")
+    args = parser.parse_args()
+
+    engines = ["threaded", "selector"] if args.engine == "both" else [args.engine]
+    print(f"{args.trains} trains reconnecting at once behind {args.silent} silent connections")
+    for engine in engines:
+        for name, options in (("unlimited", []),
+                              (f"{args.connect_rate:g}/s burst {args.connect_burst}",
+                               ["--connect-rate", str(args.connect_rate), "--connect-burst", str(args.connect_burst)])):
+            elapsed, accepted, rejected, p50, p99 = storm(engine, args.port, args.trains, args.silent, options, args.backoff)
+            print(f"{engine:>8} {name:>20}: all connected in {elapsed:6.2f}s, {accepted} accepted, "
+                  f"{rejected} CONNACK 0x9F, connect time p50 {p50*1000:7.1f} ms p99 {p99*1000:7.1f} ms")
@@ -0,0 +1,46 @@
+# Microbenchmark: preparing one PUBLISH for N subscribers, per-subscriber encode vs shared wire buffers
+# Run from the repository root: python -m benchmarks.fanout [--subscribers 10,100,1000]
+import argparse
+from MQTTPacket import FixedHeader, MQTTPacket
+from variableheaders import *
+from utils import *
+from broker import OutgoingPublish
+from benchmarks.common import ns_per_call, allocated
+
+
+# Old fan-out: re-encode the decoded packet for every QoS 1 subscriber
+def encode_per_subscriber(recv_packet: MQTTPacket, subscribers: int):
+    out = []
+    for packet_id in range(1, subscribers+1):
+        out.append(MQTTPacket(FixedHeader(PUBLISH, 0b0010),
+                              PublishVariableHeader(recv_packet.variable_data.topic_name,
+                                                    recv_packet.variable_data.payload, packet_id)).encode())
+    return out
+
+
+# New fan-out: one OutgoingPublish, per subscriber only the packet id buffer differs
+def shared_buffers(encoded_packet: bytes, subscribers: int):
+    outgoing = OutgoingPublish(encoded_packet)
+    return [outgoing.qos1(packet_id) for packet_id in range(1, subscribers+1)]
+
+
+if(__name__ == "__main__"):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--subscribers", default="10,100,1000")
+    parser.add_argument("--payload", type=int, default=256)
+    args = parser.parse_args()
+
+    encoded_packet = MQTTPacket(FixedHeader(PUBLISH, 0b0010),
+                                PublishVariableHeader("trains/Train A", "x"*args.payload, 7)).encode()
+    recv_packet = MQTTPacket.decode(encoded_packet)
+
+    print(f"QoS 1 fan-out of a {len(encoded_packet)} byte PUBLISH")
+    print(f"{'subscribers':>11} {'encode each us':>15} {'shared us':>10} {'encode each peak B':>19} {'shared peak B':>14}")
+    for subscribers in map(int, args.subscribers.split(",")):
+        rounds = max(1, 20000 // subscribers)
+        old = lambda: encode_per_subscriber(recv_packet, subscribers)
+        new = lambda: shared_buffers(encoded_packet, subscribers)
+        old_time, old_peak = ns_per_call(old, rounds), allocated(old)
+        new_time, new_peak = ns_per_call(new, rounds), allocated(new)
+        print(f"{subscribers:>11} {old_time/1e3:>15,.1f} {new_time/1e3:>10,.1f} {old_peak:>19,} {new_peak:>14,}")
@@ -0,0 +1,99 @@
+# Benchmark: framing pipelined small PUBLISH packets off a socket
+# Run from the repository root: python -m benchmarks.frame_reader [--packets N]
+import argparse, socket, threading, time
+from MQTTPacket import FixedHeader, MQTTPacket
+from variableheaders import *
+from utils import *
+from framereader import FrameReader
+
+
+# Old broker framing: recv(2), one recv(1) per extra length byte, then recv(packet_len)
+def old_read_frame(conn: socket.socket):
+    encoded = conn.recv(2)
+    if(not encoded): return None
+    decoded_len = 0; i = 0
+    while encoded[-1]&128:
+        decoded_len = (encoded[-1]-128)<<7*i|decoded_len
+        encoded += conn.recv(1)
+        i += 1
+    decoded_len = (encoded[-1])<<7*i|decoded_len
+    encoded += conn.recv(decoded_len)
+    return encoded
+
+
+# Write `count` copies of `packet` into one end of a socketpair from a background thread
+def start_writer(sock: socket.socket, packet: bytes, count: int):
+    def write():
+        batch = packet*256
+        for _ in range(count//256):
+            sock.sendall(batch)
+        sock.sendall(packet*(count%256))
+        sock.shutdown(socket.SHUT_WR)
+    thread = threading.Thread(target=write)
+    thread.start()
+    return thread
+
+
+# Count frames read until EOF, tracking recv syscalls
+class CountingSocket:
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.calls = 0
+    def recv(self, n):
+        self.calls += 1
+        return self.sock.recv(n)
+    def recv_into(self, buffer):
+        self.calls += 1
+        return self.sock.recv_into(buffer)
+
+
+# Old path: one packet per read_frame call
+def run_old(packet: bytes, count: int):
+    reader_end, writer_end = socket.socketpair()
+    counting = CountingSocket(reader_end)
+    writer = start_writer(writer_end, packet, count)
+    frames = 0; bad = 0
+    start = time.perf_counter()
+    while True:
+        frame = old_read_frame(counting)
+        if(not frame): break
+        frames += 1
+        if(len(frame) != len(packet)): bad += 1
+    elapsed = time.perf_counter() - start
+    writer.join()
+    reader_end.close(); writer_end.close()
+    return frames, bad, elapsed, counting.calls
+
+
+# New path: every complete packet from each recv, as memoryviews into the reusable buffer
+def run_frame_reader(packet: bytes, count: int):
+    reader_end, writer_end = socket.socketpair()
+    counting = CountingSocket(reader_end)
+    writer = start_writer(writer_end, packet, count)
+    reader = FrameReader()
+    frames = 0; bad = 0
+    start = time.perf_counter()
+    while reader.recv_from(counting):
+        for frame in reader.frames():
+            frames += 1
+            if(len(frame) != len(packet)): bad += 1
+    elapsed = time.perf_counter() - start
+    writer.join()
+    reader_end.close(); writer_end.close()
+    return frames, bad, elapsed, counting.calls
+
+
+if(__name__ == "__main__"):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--packets", type=int, default=200000)
+    args = parser.parse_args()
+
+    packet = MQTTPacket(FixedHeader(PUBLISH), PublishVariableHeader("trains/Train A", "location,Train A,28.7041,77.1025")).encode()
+    print(f"{len(packet)} byte PUBLISH x {args.packets} pipelined")
+
+    frames, bad, elapsed, calls = run_old(packet, args.packets)
+    print(f"  recv per packet : {frames/elapsed:>12,.0f} packets/sec, {calls/max(frames,1):.2f} recv calls/packet, {frames-bad}/{args.packets} framed correctly")
+
+    frames, bad, elapsed, calls = run_frame_reader(packet, args.packets)
+    print(f"  FrameReader     : {frames/elapsed:>12,.0f} packets/sec, {calls/max(frames,1):.4f} recv calls/packet, {frames-bad}/{args.packets} framed correctly")
@@ -0,0 +1,104 @@
+# Benchmark: sustained session journal write throughput, group commit vs one fsync per record
+# Run from the repository root: python -m benchmarks.journal [--records N] [--size BYTES] [--dir PATH]
+import argparse, os, shutil, tempfile, threading, time, zlib
+from journal import Journal, RECORD_HEADER
+from sessions import SessionStore
+
+
+# Baseline: every record written and fsynced on its own
+def fsync_per_record(directory: str, records: int, record: bytes):
+    framed = RECORD_HEADER.pack(len(record), zlib.crc32(record)) + record
+    start = time.perf_counter()
+    with open(os.path.join(directory, "baseline.log"), "ab") as log:
+        for _ in range(records):
+            log.write(framed)
+            log.flush()
+            os.fsync(log.fileno())
+    return time.perf_counter() - start, records
+
+
+# Writers that each wait for their record to be durable before the next one (a PUBACK that waits for disk)
+def group_commit(directory: str, records: int, record: bytes, writers: int, commit_interval: float):
+    journal = Journal(directory, commit_interval=commit_interval)
+    def writer():
+        for _ in range(records // writers):
+            journal.wait(journal.append(record))
+    threads = [threading.Thread(target=writer) for _ in range(writers)]
+    start = time.perf_counter()
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    elapsed = time.perf_counter() - start
+    journal.close()
+    return elapsed, journal.commits
+
+
+# Fire-and-forget appends as the broker does them, timed until the last one is on disk
+def streaming(directory: str, records: int, record: bytes, commit_interval: float):
+    journal = Journal(directory, commit_interval=commit_interval)
+    start = time.perf_counter()
+    for _ in range(records):
+        seq = journal.append(record)
+    journal.wait(seq)
+    elapsed = time.perf_counter() - start
+    journal.close()
+    return elapsed, journal.commits
+
+
+# Session workload with compaction: queue and acknowledge messages, then time the replay on restart
+def sessions_with_compaction(directory: str, records: int, record: bytes, compact_bytes: int):
+    store = SessionStore(directory, max_messages=1000, compact_bytes=compact_bytes)
+    for client in range(10):
+        store.open(f"train{client}")
+        store.subscribe(f"train{client}", f"cmd/train{client}", 1)
+    start = time.perf_counter()
+    for i in range(records // 2):
+        client_id = f"train{i % 10}"
+        packet_id = i % 60000 + 1
+        store.add_message(client_id, packet_id, record, False)
+        store.ack(client_id, packet_id)
+    store.journal.wait(store.journal.appended)
+    elapsed = time.perf_counter() - start
+    time.sleep(0.5)                                                   # Let a running compaction finish
+    store.close()
+    size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+    start = time.perf_counter()
+    restored = SessionStore(directory)
+    replay = time.perf_counter() - start
+    restored.close()
+    return elapsed, size, replay, len(restored)
+
+
+if(__name__ == "__main__"):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=20000)
+    parser.add_argument("--size", type=int, default=64, help="record size in bytes")
+    parser.add_argument("--baseline-records", type=int, default=2000, help="records for the fsync-per-record run")
+    parser.add_argument("--dir", default=None, help="directory on the disk to measure (default: a temp dir)")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(dir=args.dir)
+    record = b"M" + os.urandom(args.size - 1)
+    framed = RECORD_HEADER.size + args.size
+    def report(name: str, records: int, elapsed: float, fsyncs: int):
+        print(f"{name:<36} {records/elapsed:>12,.0f} rec/s {records*framed/elapsed/1e6:>8.2f} MB/s {fsyncs:>8} fsyncs")
+
+    try:
+        elapsed, fsyncs = fsync_per_record(root, args.baseline_records, record)
+        report("fsync per record", args.baseline_records, elapsed, fsyncs)
+        for writers in (1, 16, 64):
+            path = os.path.join(root, f"group-{writers}")
+            elapsed, fsyncs = group_commit(path, args.records, record, writers, 0.0)
+            report(f"group commit, {writers} waiting writers", args.records // writers * writers, elapsed, fsyncs)
+        for interval in (0.0, 0.001, 0.005):
+            path = os.path.join(root, f"stream-{interval}")
+            elapsed, fsyncs = streaming(path, args.records, record, interval)
+            report(f"streaming, {interval*1000:g} ms commit interval", args.records, elapsed, fsyncs)
+
+        path = os.path.join(root, "sessions")
+        elapsed, size, replay, sessions = sessions_with_compaction(path, args.records, record, 1 << 18)
+        print(f"sessions: {args.records} records in {elapsed:.2f}s ({args.records/elapsed:,.0f} rec/s), "
+              f"journal {size:,} bytes after compaction, replay of {sessions} sessions {replay*1000:.1f} ms")
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,65 @@
+# Microbenchmark: keep-alive bookkeeping for many connections, timing wheel vs the old once-a-second sweep
+# Run from the repository root: python -m benchmarks.keepalive [--connections 100000] [--seconds 60]
+import argparse, random, time
+from timerwheel import TimingWheel
+
+
+# Old selector engine behaviour: every second, look at every connection's last packet time
+def sweep(connections: int, seconds: int, active: float, keep_alive: int):
+    last_packet = {f"train{i}": 0.0 for i in range(connections)}
+    rng = random.Random(1)
+    now = 0.0; touch_time = 0.0; tick_time = 0.0; expired = 0
+    for _ in range(seconds):
+        now += 1
+        active_ids = rng.sample(list(last_packet), int(len(last_packet)*active))
+        start = time.perf_counter()
+        for client_id in active_ids:
+            last_packet[client_id] = now
+        touch_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        for client_id, last in list(last_packet.items()):
+            if(now - last >= keep_alive*1.5):                 # Same deadline as the wheel
+                del last_packet[client_id]
+                expired += 1
+        tick_time += time.perf_counter() - start
+    return touch_time, tick_time, expired
+
+
+# Timing wheel: one attribute write per packet, a tick only visits the entries in the slots it passes
+def wheel(connections: int, seconds: int, active: float, keep_alive: int):
+    timers = TimingWheel()
+    for i in range(connections):
+        timers.schedule(f"train{i}", keep_alive*1.5, 0.0)
+    rng = random.Random(1)
+    now = 0.0; touch_time = 0.0; tick_time = 0.0; expired = 0
+    for _ in range(seconds):
+        now += 1
+        active_ids = rng.sample(list(timers.timers), int(len(timers)*active))
+        start = time.perf_counter()
+        for client_id in active_ids:
+            timers.touch(client_id, now)
+        touch_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        expired += len(timers.expire(now))
+        tick_time += time.perf_counter() - start
+    return touch_time, tick_time, expired
+
+
+if(__name__ == "__main__"):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connections", type=int, default=100000)
+    parser.add_argument("--seconds", type=int, default=60, help="simulated seconds")
+    parser.add_argument("--active", type=float, default=0.2, help="fraction of connections sending a packet each second")
+    parser.add_argument("--keep-alive", type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"{args.connections} connections, keep-alive {args.keep_alive}s, {args.active:.0%} active per second, "
+          f"{args.seconds}s simulated")
+    for name, func in (("sweep", sweep), ("timing wheel", wheel)):
+        touch_time, tick_time, expired = func(args.connections, args.seconds, args.active, args.keep_alive)
+        touches = int(args.connections*args.active)*args.seconds
+        print(f"{name:>12}: {tick_time/args.seconds*1000:8.2f} ms per tick, "
+              f"{touch_time/max(touches, 1)*1e9:6.0f} ns per packet, {expired} expired")
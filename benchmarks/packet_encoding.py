@@ -0,0 +1,52 @@
+# Microbenchmark: encoding the packets the broker sends most, built from packet objects vs taken from the
+# constant and templated frames in MQTTPacket.py (PINGRESP, PUBACK, SUBACK) or encoded once (CONNACK).
+# Reports packets per second and bytes allocated per packet (tracemalloc peak while encoding one).
+# Run from the repository root: python -m benchmarks.packet_encoding [--rounds 100000]
+import argparse, sys
+from MQTTPacket import FixedHeader, MQTTPacket, PINGRESP_PACKET, puback_packet, suback_packet
+from variableheaders import *
+from utils import *
+from benchmarks.common import ns_per_call, allocated
+
+
+# Memory held by a packet object, its headers included
+def object_size(packet: MQTTPacket):
+    return sum(sys.getsizeof(obj) + (sys.getsizeof(obj.__dict__) if hasattr(obj, "__dict__") else 0)
+               for obj in (packet, packet.fixed_header, packet.variable_data))
+
+
+if(__name__ == "__main__"):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=100000, help="encodes per timed run (fewer for large packets)")
+    args = parser.parse_args()
+
+    properties = {TOPIC_ALIAS_MAXIMUM: 64, RECEIVE_MAXIMUM: 64}             # What the broker's CONNACK carries
+    connack = MQTTPacket(FixedHeader(CONNACK), ConnackVariableHeader(0, 0x00, properties)).encode()
+    cases = [
+        ("CONNACK", lambda: MQTTPacket(FixedHeader(CONNACK), ConnackVariableHeader(0, 0x00, properties)).encode(),
+                    lambda: connack),
+        ("PINGRESP", lambda: MQTTPacket(FixedHeader(PINGRESP)).encode(), lambda: PINGRESP_PACKET),
+        ("PUBACK", lambda: MQTTPacket(FixedHeader(PUBACK), PubackVariableHeader(1234, 0x00)).encode(),
+                   lambda: puback_packet(1234)),
+        ("SUBACK", lambda: MQTTPacket(FixedHeader(SUBACK), SubackVariableHeader(7, [0x01])).encode(),
+                   lambda: suback_packet(7, [0x01])),
+    ]
+    print(f"{'packet':<14} {'built pkt/s':>12} {'frame pkt/s':>12} {'built B':>8} {'frame B':>8}")
+    for name, built, frame in cases:
+        assert built() == frame()
+        built_rate, built_bytes = 1e9 / ns_per_call(built, args.rounds), allocated(built)
+        frame_rate, frame_bytes = 1e9 / ns_per_call(frame, args.rounds), allocated(frame)
+        print(f"{name:<14} {built_rate:>12,.0f} {frame_rate:>12,.0f} {built_bytes:>8,} {frame_bytes:>8,}")
+
+    # PUBLISHes have no template; the payload is copied once, into the frame
+    for size in (36, 1024, 65536):
+        payload = b"x" * size
+        encode = lambda: MQTTPacket(FixedHeader(PUBLISH, 0b0010), PublishVariableHeader("trains/train42", payload, 7)).encode()
+        rate = 1e9 / ns_per_call(encode, max(1000, args.rounds * 64 // max(size, 64)))
+        print(f"{'PUBLISH ' + str(size) + ' B':<14} {rate:>12,.0f} {'':>12} {allocated(encode):>8,}")
+
+    puback = MQTTPacket(FixedHeader(PUBACK), PubackVariableHeader(1234, 0x00))
+    publish = MQTTPacket.decode(MQTTPacket(FixedHeader(PUBLISH, 0b0010),
+                                           PublishVariableHeader("trains/train42", b"x" * 36, 7)).encode())
+    print(f"objects: PUBACK {object_size(puback)} B, decoded PUBLISH {object_size(publish)} B")
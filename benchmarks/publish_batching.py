@@ -0,0 +1,50 @@
+# Benchmark: pipelined PUBLISH ingestion routed one packet at a time vs in batches of every packet of a read,
+# reporting throughput and socket syscalls (recv + sendmsg on client sockets) per forwarded message.
+# Run from the repository root: python -m benchmarks.publish_batching [--publishers 4] [--messages 20000]
+import argparse, urllib.request
+from benchmarks.broker_engines import start_broker, bench_throughput
+
+
+def scrape(metrics_port: int):
+    body = urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics", timeout=5).read().decode()
+    return {name: float(value) for name, value in (line.split() for line in body.splitlines()
+                                                   if line and not line.startswith("#") and "{" not in line)}
+
+
+def run(engine: str, port: int, publish_batch: int, publishers: int, messages: int, payload: int):
+    metrics_port = port + 1000
+    proc = start_broker(engine, port, "--sys-interval", "0", "--metrics-port", str(metrics_port),
+                        "--publish-batch", str(publish_batch),
+                        "--queue-max-messages", str(publishers*messages), "--queue-max-bytes", str(256 << 20))
+    try:
+        before = scrape(metrics_port)                               # The startup probe's handshake
+        received, expected, elapsed = bench_throughput(port, publishers, messages, payload)
+        after = scrape(metrics_port)
+    finally:
+        proc.kill(); proc.wait()
+    reads = after["mqtt_socket_reads_total"] - before["mqtt_socket_reads_total"]
+    writes = after["mqtt_socket_writes_total"] - before["mqtt_socket_writes_total"]
+    return received, expected, elapsed, reads, writes
+
+
+if(__name__ == "__main__"):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engine", choices=["threaded", "selector", "both"], default="both")
+    parser.add_argument("--port", type=int, default=18870)
+    parser.add_argument("--publishers", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=20000, help="QoS 0 messages per publisher")
+    parser.add_argument("--payload", type=int, default=32)
+    parser.add_argument("--batch", type=int, default=256, help="--publish-batch of the batched run")
+    args = parser.parse_args()
+
+    engines = ["threaded", "selector"] if args.engine == "both" else [args.engine]
+    print(f"{args.publishers} publishers pipelining {args.messages} QoS 0 messages each to one subscriber")
+    for engine in engines:
+        for publish_batch in (1, args.batch):
+            received, expected, elapsed, reads, writes = run(engine, args.port, publish_batch, args.publishers,
+                                                             args.messages, args.payload)
+            label = "per packet" if publish_batch == 1 else f"batch {publish_batch}"
+            print(f"{engine:>8} {label:>10}: {received/elapsed:9,.0f} msg/s ({received}/{expected}), "
+                  f"{reads/received:.3f} reads + {writes/received:.3f} writes = "
+                  f"{(reads+writes)/received:.3f} syscalls per message")
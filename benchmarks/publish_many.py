@@ -0,0 +1,91 @@
+# Benchmark: a gateway publishing the positions of a whole fleet every tick, one Client.publish per message vs
+# one Client.publish_many per tick, and the encoding cost alone (MQTTPacket.encode per packet vs encode_many).
+# Run from the repository root: python -m benchmarks.publish_many [--trains 1000] [--ticks 20]
+import argparse, threading, time
+from MQTTPacket import FixedHeader, MQTTPacket, encode_many
+from variableheaders import *
+from utils import *
+from client import Client
+from benchmarks.broker_engines import start_broker, mqtt_connect, count_publishes
+from benchmarks.common import shutdown
+
+
+def positions(trains: int, tick: int):
+    return [(f"trains/train{i}", f"location,train{i},{12.9 + tick/1000:.6f},{77.5 + i/1000:.6f}".encode())
+            for i in range(trains)]
+
+
+def encode_cost(trains: int, rounds: int = 20):
+    packets = [MQTTPacket(FixedHeader(PUBLISH), PublishVariableHeader(topic, payload))
+               for topic, payload in positions(trains, 0)]
+    assert encode_many(packets) == b"".join(packet.encode() for packet in packets)
+    timings = []
+    for encode in (lambda: [packet.encode() for packet in packets], lambda: encode_many(packets)):
+        best = float("inf")
+        for _ in range(rounds):
+            start = time.perf_counter()
+            encode()
+            best = min(best, time.perf_counter() - start)
+        timings.append(best / trains)
+    return timings
+
+
+# One gateway client publishing every position of every tick to a raw subscriber counting deliveries
+def run(engine: str, port: int, trains: int, ticks: int, flags: int, batched: bool):
+    proc = start_broker(engine, port, "--sys-interval", "0", "--receive-maximum", "1024",
+                        "--queue-max-messages", str(trains*ticks), "--queue-max-bytes", str(256 << 20))
+    gateway = None
+    try:
+        sub = mqtt_connect(port, "bench-sub")
+        sub.sendall(MQTTPacket(FixedHeader(SUBSCRIBE), SubscribeVariableHeader(1, [("trains/#", 0)])).encode())
+        sub.recv(16)                                                  # SUBACK
+        result = dict()
+        counter = threading.Thread(target=count_publishes, args=(sub, trains*ticks, time.time()+60, result))
+        counter.start()
+
+        gateway = Client("gateway")
+        gateway.connect("127.0.0.1", port)
+        gateway.loop()
+        ticks_positions = [positions(trains, tick) for tick in range(ticks)]
+        start = time.time()
+        for messages in ticks_positions:
+            if(batched):
+                gateway.publish_many(messages, flags, wait=False)
+            else:
+                for topic_name, payload in messages:
+                    gateway.publish(topic_name, payload, flags, wait=False)
+        sent = time.time() - start
+        gateway.wait_for_acks(60)
+        counter.join()
+        delivered = result["finished"] - start
+    finally:
+        if(gateway is not None):
+            gateway.connected = False
+            gateway.conn.close()
+        proc.kill(); proc.wait()
+    return sent, delivered, result["received"]
+
+
+if(__name__ == "__main__"):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engine", choices=["threaded", "selector", "both"], default="selector")
+    parser.add_argument("--port", type=int, default=18880)
+    parser.add_argument("--trains", type=int, default=1000, help="positions published per tick")
+    parser.add_argument("--ticks", type=int, default=20)
+    args = parser.parse_args()
+
+    per_packet, batched = encode_cost(args.trains)
+    print(f"encoding {args.trains} positions: {per_packet*1e9:,.0f} ns per message one packet at a time, "
+          f"{batched*1e9:,.0f} ns with encode_many")
+
+    engines = ["threaded", "selector"] if args.engine == "both" else [args.engine]
+    expected = args.trains * args.ticks
+    for engine in engines:
+        for flags, qos in ((0b0000, "QoS 0"), (0b0010, "QoS 1")):
+            for batch in (False, True):
+                sent, delivered, received = run(engine, args.port, args.trains, args.ticks, flags, batch)
+                label = "publish_many" if batch else "publish"
+                print(f"{engine:>8} {qos} {label:>12}: {expected/sent:9,.0f} msg/s sent, "
+                      f"{received/delivered:9,.0f} msg/s delivered ({received}/{expected})")
+    shutdown()
@@ -0,0 +1,59 @@
+# Benchmark: QoS 1 publish throughput when waiting for each PUBACK vs pipelining up to the broker's Receive Maximum
+# Run from the repository root: python -m benchmarks.receive_maximum [--messages 5000] [--receive-maximum 64]
+import argparse, time
+from client import Client
+from benchmarks.broker_engines import start_broker
+from benchmarks.common import shutdown
+
+
+# One publisher sends QoS 1 messages to a subscriber that advertises its own Receive Maximum
+def run(engine: str, port: int, messages: int, receive_maximum: int, pipelined: bool):
+    proc = start_broker(engine, port, "--sys-interval", "0", "--receive-maximum", str(receive_maximum))
+    clients = []
+    try:
+        received = []
+        subscriber = Client("subscriber")
+        subscriber.on_message = received.append
+        subscriber.connect("127.0.0.1", port, 0, True, receive_maximum=receive_maximum)
+        subscriber.loop()
+        clients.append(subscriber)
+        subscriber.subscribe([("bench/#", 1)])
+        publisher = Client("publisher")
+        publisher.connect("127.0.0.1", port)
+        publisher.loop()
+        clients.append(publisher)
+
+        start = time.perf_counter()
+        for i in range(messages):
+            publisher.publish("bench/qos1", f"message {i}", 0b0010, wait=not pipelined)
+        publisher.wait_for_acks(60)
+        acked = time.perf_counter() - start
+        deadline = time.time() + 60
+        while len(received) < messages and time.time() < deadline:
+            time.sleep(0.001)
+        delivered = time.perf_counter() - start
+    finally:
+        for client in clients:
+            client.connected = False
+            client.conn.close()
+        proc.kill(); proc.wait()
+    return acked, delivered, len(received)
+
+
+if(__name__ == "__main__"):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engine", choices=["threaded", "selector", "both"], default="both")
+    parser.add_argument("--port", type=int, default=18840)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--receive-maximum", type=int, default=64, help="window advertised by broker and subscriber")
+    args = parser.parse_args()
+
+    engines = ["threaded", "selector"] if args.engine == "both" else [args.engine]
+    print(f"{args.messages} QoS 1 messages, Receive Maximum {args.receive_maximum}")
+    for engine in engines:
+        for pipelined in (False, True):
+            acked, delivered, received = run(engine, args.port, args.messages, args.receive_maximum, pipelined)
+            print(f"{engine:>8} {'pipelined' if pipelined else 'stop-and-wait':>13}: {args.messages/acked:8.0f} msg/s "
+                  f"acknowledged, {received/delivered:8.0f} msg/s delivered ({received} received)")
+    shutdown()
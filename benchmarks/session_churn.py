@@ -0,0 +1,111 @@
+# Stress test: concurrent connect / subscribe / disconnect churn, against the session registry alone and
+# against a running broker, checking that no client state is leaked or torn down twice.
+# Run from the repository root: python -m benchmarks.session_churn [--threads 32] [--cycles 200]
+import argparse, random, socket, threading, time, urllib.request
+from MQTTPacket import FixedHeader, MQTTPacket
+from variableheaders import *
+from utils import *
+from framereader import FrameReader
+from registry import ClientSession, SessionRegistry
+from benchmarks.broker_engines import start_broker
+
+
+# Raw connect with Clean Start = 1, so nothing of the client outlives its connection
+def clean_connect(port: int, client_id: str):
+    sock = socket.create_connection(("127.0.0.1", port), timeout=10)
+    sock.sendall(MQTTPacket(FixedHeader(CONNECT), ConnectVariableHeader(client_id, 600, 0x02)).encode())
+    reader = FrameReader()
+    if(reader.read_frame(sock) is None):
+        raise ConnectionError(f"no CONNACK for {client_id}")
+    return sock, reader
+
+
+# Registry alone: threads racing to register, look up and tear down an overlapping set of client ids.
+# Every successful add must be matched by exactly one successful remove.
+def registry_churn(shards: int, threads: int, operations: int, ids: int):
+    registry = SessionRegistry(shards)
+    counts = [[0, 0] for _ in range(threads)]                 # Per thread: [adds, removes] that succeeded
+
+    def worker(index: int):
+        rng = random.Random(index)
+        for _ in range(operations):
+            client_id = f"train{rng.randrange(ids)}"
+            if(rng.random() < 0.5):
+                counts[index][0] += registry.add(ClientSession(client_id, None, None))
+            elif(registry.get(client_id) is not None and registry.remove(client_id) is not None):
+                counts[index][1] += 1
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for thread in workers: thread.start()
+    for thread in workers: thread.join()
+    elapsed = time.perf_counter() - start
+    adds = sum(count[0] for count in counts)
+    removes = sum(count[1] for count in counts)
+    return elapsed, adds, removes, len(registry)
+
+
+# Broker: each thread connects, subscribes to a few filters and disconnects (cleanly or by dropping the socket)
+def broker_churn(engine: str, port: int, threads: int, cycles: int):
+    metrics_port = port + 1000
+    proc = start_broker(engine, port, "--sys-interval", "0", "--metrics-port", str(metrics_port))
+    errors = []
+    try:
+        def worker(index: int):
+            rng = random.Random(index)
+            for cycle in range(cycles):
+                try:
+                    sock, reader = clean_connect(port, f"train{index}-{cycle}")
+                    filters = [(f"t/{rng.randrange(50)}/#", 1) for _ in range(rng.randint(1, 4))]
+                    sock.sendall(MQTTPacket(FixedHeader(SUBSCRIBE), SubscribeVariableHeader(1, filters)).encode())
+                    reader.read_frame(sock)                           # SUBACK
+                    if(rng.random() < 0.5):
+                        sock.sendall(MQTTPacket(FixedHeader(DISCONNECT), DisconnectVariableHeader(0x00)).encode())
+                    sock.close()
+                except OSError as e:
+                    errors.append(e)
+
+        workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+        start = time.perf_counter()
+        for thread in workers: thread.start()
+        for thread in workers: thread.join()
+        elapsed = time.perf_counter() - start
+
+        # Subscriptions of departed clients must be gone: a publish now reaches only the checker
+        checker, reader = clean_connect(port, "checker")
+        checker.sendall(MQTTPacket(FixedHeader(SUBSCRIBE), SubscribeVariableHeader(1, [("t/#", 0)])).encode())
+        reader.read_frame(checker)
+        publisher, _ = clean_connect(port, "publisher")
+        for i in range(50):
+            publisher.sendall(MQTTPacket(FixedHeader(PUBLISH), PublishVariableHeader(f"t/{i}/x", "ping")).encode())
+        time.sleep(0.5)
+        body = urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics", timeout=5).read().decode()
+        values = dict(line.split() for line in body.splitlines() if line and not line.startswith("#"))
+    finally:
+        proc.kill(); proc.wait()
+    return elapsed, len(errors), int(float(values["mqtt_clients_connected"])), int(values["mqtt_messages_sent_total"])
+
+
+if(__name__ == "__main__"):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engine", choices=["threaded", "selector", "both"], default="both")
+    parser.add_argument("--port", type=int, default=18860)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--cycles", type=int, default=200, help="connect/subscribe/disconnect cycles per thread")
+    parser.add_argument("--operations", type=int, default=20000, help="registry operations per thread")
+    args = parser.parse_args()
+
+    for shards in (1, 16):
+        elapsed, adds, removes, left = registry_churn(shards, args.threads, args.operations, 1000)
+        ok = "ok" if adds - removes == left else "MISMATCH"
+        print(f"registry, {shards:2} shards: {args.threads*args.operations/elapsed:9.0f} ops/s, "
+              f"{adds} adds - {removes} removes = {left} registered ({ok})")
+
+    engines = ["threaded", "selector"] if args.engine == "both" else [args.engine]
+    for engine in engines:
+        elapsed, errors, connected, routed = broker_churn(engine, args.port, args.threads, args.cycles)
+        # Only the checker and the publisher remain, and the 50 publishes reach the checker alone
+        ok = "ok" if connected == 2 and routed == 50 and not errors else "LEAK"
+        print(f"broker {engine:>8}: {args.threads*args.cycles/elapsed:7.0f} connect/subscribe/disconnect cycles/s, "
+              f"{errors} errors, {connected} clients left, {routed} copies routed for 50 publishes ({ok})")
@@ -0,0 +1,82 @@
+# Benchmark: forwarding one large PUBLISH (a firmware image for a train) with the broker buffering the whole
+# frame (--stream-threshold 0) vs streaming it, reporting the time until the subscriber has it all and the
+# broker's peak resident memory (VmHWM) over its idle footprint. The buffered broker gets a queue limit large
+# enough for the frame, with the default 1 MiB its copy would be dropped.
+# Run from the repository root: python -m benchmarks.streaming [--sizes 4,16,64] (MiB)
+import argparse, os, threading, time
+from MQTTPacket import FixedHeader, MQTTPacket, publish_head
+from variableheaders import *
+from utils import *
+from client import Client
+from benchmarks.broker_engines import start_broker, mqtt_connect
+from benchmarks.common import shutdown
+
+BLOCK = os.urandom(1 << 16)
+
+
+def peak_rss(pid: int):
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if(line.startswith("VmHWM")): return int(line.split()[1]) * 1024
+
+
+# Read everything sent to a raw subscriber until `expected` bytes arrived
+def drain(sock, expected: int, result: dict):
+    received = 0
+    while received < expected:
+        data = sock.recv(1 << 20)
+        if(not data): break
+        received += len(data)
+    result["received"] = received
+    result["finished"] = time.time()
+
+
+def run(engine: str, port: int, size: int, threshold: int):
+    queue_bytes = 1 << 20 if threshold else 2*size
+    proc = start_broker(engine, port, "--sys-interval", "0", "--stream-threshold", str(threshold),
+                        "--queue-max-bytes", str(queue_bytes))
+    publisher = None
+    try:
+        idle = peak_rss(proc.pid)
+        sub = mqtt_connect(port, "bench-sub")
+        sub.sendall(MQTTPacket(FixedHeader(SUBSCRIBE), SubscribeVariableHeader(1, [("firmware/#", 0)])).encode())
+        sub.recv(16)                                                  # SUBACK
+        head_len = len(publish_head(0, "firmware/train42", size))      # The subscriber's QoS 0 copy
+        result = dict()
+        reader = threading.Thread(target=drain, args=(sub, head_len + size, result))
+        reader.start()
+
+        publisher = Client("bench-pub")
+        publisher.connect("127.0.0.1", port)
+        publisher.loop()
+        chunks = (BLOCK[:min(len(BLOCK), size - sent)] for sent in range(0, size, len(BLOCK)))
+        start = time.time()
+        publisher.publish_stream("firmware/train42", chunks, size, 0b0010)    # Acknowledged after the last chunk
+        reader.join(60)
+        elapsed = result.get("finished", time.time()) - start
+        peak = peak_rss(proc.pid) - idle
+    finally:
+        if(publisher is not None):
+            publisher.connected = False
+            publisher.conn.close()
+        proc.kill(); proc.wait()
+    return elapsed, peak, result.get("received", 0) >= head_len + size
+
+
+if(__name__ == "__main__"):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engine", choices=["threaded", "selector", "both"], default="both")
+    parser.add_argument("--port", type=int, default=18890)
+    parser.add_argument("--sizes", default="4,16,64", help="payload sizes in MiB")
+    args = parser.parse_args()
+
+    engines = ["threaded", "selector"] if args.engine == "both" else [args.engine]
+    print(f"{'engine':>8} {'payload':>8} {'mode':>9} {'seconds':>8} {'MB/s':>8} {'broker peak MiB':>16}")
+    for engine in engines:
+        for size in (int(mib) << 20 for mib in args.sizes.split(",")):
+            for label, threshold in (("buffered", 0), ("streamed", 1 << 20)):
+                elapsed, peak, complete = run(engine, args.port, size, threshold)
+                print(f"{engine:>8} {size >> 20:>6}Mi {label:>9} {elapsed:>8.2f} {size/elapsed/1e6:>8.1f} "
+                      f"{peak / (1 << 20):>16.1f}" + ("" if complete else "  (incomplete)"))
+    shutdown()
@@ -0,0 +1,267 @@
+# Benchmark suite with machine-readable results, to compare commits:
+#   codec      encode and decode ns/op per packet type (decoding includes reading every field)
+#   match      subscription trie match ns/op vs number of filters
+#   e2e        QoS 0/1 throughput and p50/p99 latency through a localhost broker vs subscribers and payload size
+# Results are written as JSON, by default to benchmark_results/<commit>.json:
+# {"meta": {commit, time, python, ...}, "results": {name: {"value", "unit", "better"}}}.
+# --compare OLD.json prints the change of every result and exits with 1 if one got worse by more than
+# --threshold, so a run can gate a change.
+# Run from the repository root: python -m benchmarks.suite [--quick] [--compare benchmark_results/<commit>.json]
+import argparse, json, os, platform, selectors, struct, subprocess, threading, time
+from MQTTPacket import FixedHeader, MQTTPacket, puback_packet
+from variableheaders import *
+from utils import *
+from client import Client
+from framereader import FrameReader
+from topictrie import TopicTrie
+from benchmarks.broker_engines import start_broker, mqtt_connect
+from benchmarks.common import ns_per_call, shutdown
+from benchmarks.topic_match import make_filters, make_topics
+
+TIMESTAMP = struct.Struct(">d")                              # perf_counter() at publish, first bytes of each payload
+
+
+class Results:
+    '''
+    Collected benchmark results:
+    results.add(name, value, unit, better): records a result, better is "lower" or "higher", and prints it.
+    results.save(path, meta): writes them as JSON.
+    results.compare(path, threshold): prints the change against an earlier run, returns the names of
+    results that got worse by more than threshold (a fraction).
+    '''
+
+    def __init__(self):
+        self.results: dict[str, dict] = dict()
+
+    def add(self, name: str, value: float, unit: str, better: str = "lower"):
+        self.results[name] = {"value": value, "unit": unit, "better": better}
+        print(f"{name:<52} {value:>14,.1f} {unit}")
+
+    def save(self, path: str, meta: dict):
+        with open(path, "w") as file:
+            json.dump({"meta": meta, "results": self.results}, file, indent=2)
+
+    def compare(self, path: str, threshold: float):
+        with open(path) as file:
+            old = json.load(file)
+        print(f"\ncompared with {path} ({old['meta'].get('commit')}, {old['meta'].get('time')})")
+        regressions = []
+        for name, result in self.results.items():
+            before = old["results"].get(name)
+            if(before is None or not before["value"]): continue
+            change = result["value"] / before["value"] - 1
+            worse = change if result["better"] == "lower" else -change
+            flag = "REGRESSION" if worse > threshold else ("improved" if worse < -threshold else "")
+            if(worse > threshold): regressions.append(name)
+            print(f"{name:<52} {before['value']:>14,.1f} -> {result['value']:>14,.1f} {change:>+8.1%} {flag}")
+        return regressions
+
+
+# Reads every field of a decoded packet, PUBLISH fields being decoded on first use
+def read_fields(packet: MQTTPacket):
+    variable_data = packet.variable_data
+    if(variable_data is None): return None
+    if(isinstance(variable_data, PublishHeader)):
+        return variable_data.topic_name, variable_data.packet_id, variable_data.properties, bytes(variable_data.payload)
+    return [getattr(variable_data, name) for name in variable_data.__slots__]
+
+
+def bench_codec(results: Results, min_time: float):
+    properties = {TOPIC_ALIAS_MAXIMUM: 64, RECEIVE_MAXIMUM: 64}
+    packets = {
+        "CONNECT": MQTTPacket(FixedHeader(CONNECT), ConnectVariableHeader("train42", 60, 0x02, properties)),
+        "CONNACK": MQTTPacket(FixedHeader(CONNACK), ConnackVariableHeader(0, 0x00, properties)),
+        "PUBLISH_qos0_32B": MQTTPacket(FixedHeader(PUBLISH), PublishVariableHeader("trains/train42", b"x"*32)),
+        "PUBLISH_qos1_1KiB": MQTTPacket(FixedHeader(PUBLISH, 0b0010),
+                                        PublishVariableHeader("trains/train42", b"x"*1024, 7)),
+        "PUBLISH_qos1_64KiB": MQTTPacket(FixedHeader(PUBLISH, 0b0010),
+                                         PublishVariableHeader("trains/train42", b"x"*65536, 7,
+                                                               {MESSAGE_EXPIRY_INTERVAL: 10})),
+        "PUBACK": MQTTPacket(FixedHeader(PUBACK), PubackVariableHeader(7, 0x00)),
+        "SUBSCRIBE_3": MQTTPacket(FixedHeader(SUBSCRIBE),
+                                  SubscribeVariableHeader(1, [("trains/#", 1), ("$SYS/#", 0), ("cc/+", 1)])),
+        "SUBACK": MQTTPacket(FixedHeader(SUBACK), SubackVariableHeader(1, [0x01])),
+        "UNSUBSCRIBE_3": MQTTPacket(FixedHeader(UNSUBSCRIBE), UnsubscribeVariableHeader(2, ["trains/#", "$SYS/#", "cc/+"])),
+        "PINGREQ": MQTTPacket(FixedHeader(PINGREQ)),
+        "DISCONNECT": MQTTPacket(FixedHeader(DISCONNECT), DisconnectVariableHeader(0x00)),
+    }
+    for name, packet in packets.items():
+        frame = packet.encode()
+        results.add(f"codec/encode/{name}", ns_per_call(packet.encode, min_time=min_time), "ns/op")
+        results.add(f"codec/decode/{name}", ns_per_call(lambda: read_fields(MQTTPacket.decode(frame)), min_time=min_time), "ns/op")
+
+
+def bench_match(results: Results, counts: list[int], samples: int):
+    for count in counts:
+        trie = TopicTrie()
+        for i, topic_filter in enumerate(make_filters(count)):
+            trie.insert(topic_filter, f"client{i%1000}")
+        topics = make_topics(count, samples)
+        best = float("inf")
+        for _ in range(3):
+            start = time.perf_counter_ns()
+            for topic in topics: trie.match(topic)
+            best = min(best, (time.perf_counter_ns() - start) / len(topics))
+        results.add(f"match/filters{count}", best, "ns/op")
+
+
+# Raw subscriber sockets read by one thread: counts deliveries, acknowledges QoS 1 ones and records the
+# latency of those whose payload starts with a timestamp marker
+class Subscribers:
+
+    def __init__(self, port: int, count: int, topic_filter: str, qos: int):
+        self.socks = []
+        self.selector = selectors.DefaultSelector()
+        for i in range(count):
+            sock = mqtt_connect(port, f"suite-sub-{i}")
+            sock.sendall(MQTTPacket(FixedHeader(SUBSCRIBE), SubscribeVariableHeader(1, [(topic_filter, qos)])).encode())
+            reader = FrameReader()
+            reader.read_frame(sock)                             # SUBACK
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ, reader)
+            self.socks.append(sock)
+        self.received = 0
+        self.latencies: list[float] = []
+        self.running = True
+        self.thread = threading.Thread(target=self.__read, daemon=True)
+        self.thread.start()
+
+    def __read(self):
+        while self.running:
+            for key, _ in self.selector.select(0.1):
+                sock, reader = key.fileobj, key.data
+                try:
+                    if(not reader.recv_from(sock)):
+                        self.selector.unregister(sock)          # Closed by the broker
+                        continue
+                except BlockingIOError:
+                    continue
+                acks = []
+                for frame in reader.frames():
+                    if(frame[0] >> 4 != PUBLISH): continue
+                    self.received += 1
+                    publish = MQTTPacket.decode(frame).variable_data
+                    if(publish.packet_id is not None): acks.append(puback_packet(publish.packet_id))
+                    payload = publish.payload
+                    if(payload[0] == 1):                        # Timed message
+                        self.latencies.append(time.perf_counter() - TIMESTAMP.unpack_from(payload, 1)[0])
+                if(acks):
+                    sock.setblocking(True)
+                    sock.sendall(b"".join(acks))
+                    sock.setblocking(False)
+
+    def wait_for(self, expected: int, timeout: float = 60):
+        deadline = time.time() + timeout
+        while self.received < expected and time.time() < deadline:
+            time.sleep(0.001)
+        return self.received
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        for sock in self.socks: sock.close()
+
+
+def percentile(values: list[float], fraction: float):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float("nan")
+
+
+# Throughput: `messages` publishes as fast as the client sends them. Latency: `timed` publishes paced
+# `interval` seconds apart, each carrying its send time.
+def bench_e2e(results: Results, engine: str, port: int, subscriber_counts: list[int], payload_sizes: list[int],
+              messages: int, timed: int, interval: float):
+    proc = start_broker(engine, port, "--sys-interval", "0", "--queue-max-messages", "1000000",
+                        "--queue-max-bytes", str(1 << 30))
+    try:
+        run = 0
+        for qos, flags in ((0, 0b0000), (1, 0b0010)):
+            for subscribers in subscriber_counts:
+                for size in payload_sizes:
+                    run += 1
+                    topic = f"suite/{run}"
+                    subs = Subscribers(port, subscribers, topic, qos)
+                    publisher = Client(f"suite-pub-{run}")
+                    publisher.connect("127.0.0.1", port)
+                    publisher.loop()
+                    try:
+                        padding = b"x" * max(0, size - 1 - TIMESTAMP.size)
+                        untimed = [(topic, b"\x00" + TIMESTAMP.pack(0.0) + padding)] * messages
+                        start = time.perf_counter()
+                        publisher.publish_many(untimed, flags, wait=False)
+                        received = subs.wait_for(messages * subscribers)
+                        elapsed = time.perf_counter() - start
+
+                        for _ in range(timed):
+                            publisher.publish(topic, b"\x01" + TIMESTAMP.pack(time.perf_counter()) + padding, flags,
+                                              wait=False)
+                            time.sleep(interval)
+                        subs.wait_for((messages + timed) * subscribers)
+                        publisher.wait_for_acks(60)
+                    finally:
+                        publisher.connected = False
+                        publisher.conn.close()
+                        subs.close()
+                    name = f"e2e/{engine}/qos{qos}/subs{subscribers}/payload{size}"
+                    results.add(f"{name}/throughput", received / elapsed, "deliveries/s", "higher")
+                    results.add(f"{name}/latency_p50", percentile(subs.latencies, 0.50) * 1e6, "us")
+                    results.add(f"{name}/latency_p99", percentile(subs.latencies, 0.99) * 1e6, "us")
+                    if(received < messages * subscribers):
+                        print(f"  only {received}/{messages * subscribers} deliveries arrived")
+    finally:
+        proc.kill(); proc.wait()
+
+
+def run_metadata(args: argparse.Namespace):
+    def git(*command: str):
+        try:
+            return subprocess.run(["git", *command], capture_output=True, text=True, timeout=10).stdout.strip()
+        except OSError:
+            return None
+    return {"commit": git("rev-parse", "--short", "HEAD"), "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "python": platform.python_version(),
+            "platform": platform.platform(), "cpus": os.cpu_count(), "args": vars(args)}
+
+
+if(__name__ == "__main__"):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--only", default="codec,match,e2e", help="comma-separated sections to run")
+    parser.add_argument("--quick", action="store_true", help="smaller sizes, for a fast smoke run")
+    parser.add_argument("--engine", choices=["threaded", "selector", "both"], default="selector")
+    parser.add_argument("--port", type=int, default=18890)
+    parser.add_argument("--subscribers", default="1,10,50")
+    parser.add_argument("--payloads", default="32,4096", help="payload sizes in bytes, at least 9")
+    parser.add_argument("--messages", type=int, default=2000, help="publishes per throughput run")
+    parser.add_argument("--timed", type=int, default=200, help="paced publishes per latency run")
+    parser.add_argument("--interval", type=float, default=0.002, help="seconds between paced publishes")
+    parser.add_argument("--filters", default="1000,10000,100000")
+    parser.add_argument("--output", default=None, help="results file (default: benchmark_results/<commit>.json)")
+    parser.add_argument("--compare", default=None, help="earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="change counted as a regression")
+    args = parser.parse_args()
+    if(args.quick):
+        args.subscribers, args.payloads, args.messages, args.timed, args.filters = "1,10", "32", 500, 50, "1000,10000"
+
+    sections = args.only.split(",")
+    results = Results()
+    if("codec" in sections):
+        bench_codec(results, 0.05 if args.quick else 0.25)
+    if("match" in sections):
+        bench_match(results, [int(count) for count in args.filters.split(",")], 10000 if args.quick else 50000)
+    if("e2e" in sections):
+        engines = ["threaded", "selector"] if args.engine == "both" else [args.engine]
+        for engine in engines:
+            bench_e2e(results, engine, args.port, [int(count) for count in args.subscribers.split(",")],
+                      [int(size) for size in args.payloads.split(",")], args.messages, args.timed, args.interval)
+
+    meta = run_metadata(args)
+    if(args.output is None):
+        os.makedirs("benchmark_results", exist_ok=True)
+        args.output = f"benchmark_results/{meta['commit'] or 'results'}{'-dirty' if meta['dirty'] else ''}.json"
+    results.save(args.output, meta)
+    print(f"results written to {args.output}")
+    regressions = results.compare(args.compare, args.threshold) if args.compare else []
+    if(regressions):
+        print(f"{len(regressions)} regressions over {args.threshold:.0%}")
+    shutdown(1 if regressions else 0)
@@ -0,0 +1,76 @@
+# Benchmark: bytes on the wire for train location updates with and without MQTT 5 topic aliases
+# Run from the repository root: python -m benchmarks.topic_aliases [--trains 200] [--updates 20]
+import argparse, random, time, urllib.request
+from client import Client
+from benchmarks.broker_engines import start_broker
+from benchmarks.common import shutdown
+
+
+# Read the broker's byte counters from its metrics endpoint
+def wire_bytes(metrics_port: int):
+    body = urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics", timeout=5).read().decode()
+    values = dict(line.split() for line in body.splitlines() if line.startswith("mqtt_bytes_"))
+    return int(values["mqtt_bytes_received_total"]), int(values["mqtt_bytes_sent_total"])
+
+
+# Trains publish retained locations as Train.__move does, one control center subscribes to trains/#
+def run(engine: str, port: int, trains: int, updates: int, aliases: bool):
+    metrics_port = port + 1000
+    proc = start_broker(engine, port, "--metrics-port", str(metrics_port), "--sys-interval", "0",
+                        "--topic-alias-maximum", "64" if aliases else "0")
+    clients = []
+    try:
+        received = []
+        center = Client("control-center")
+        center.on_message = received.append
+        center.connect("127.0.0.1", port, 0, True, topic_alias_maximum=1024 if aliases else 0)
+        center.loop()
+        clients.append(center)
+        center.subscribe("trains/#")
+        fleet = []
+        for i in range(trains):
+            train = Client(f"train{i}")
+            train.connect("127.0.0.1", port)
+            clients.append(train)
+            fleet.append(train)
+
+        rng = random.Random(1)
+        before = wire_bytes(metrics_port)
+        for _ in range(updates):
+            for i, train in enumerate(fleet):
+                train.publish(f"trains/train{i}", f"location,train{i},{rng.uniform(12, 29):.4f},{rng.uniform(72, 81):.4f}",
+                              0b0001)
+        deadline = time.time() + 30
+        while len(received) < trains*updates and time.time() < deadline:
+            time.sleep(0.05)
+        after = wire_bytes(metrics_port)
+    finally:
+        for client in clients:
+            client.connected = False
+            client.conn.close()
+        proc.kill(); proc.wait()
+    messages = trains*updates
+    return (after[0]-before[0]) / messages, (after[1]-before[1]) / messages, len(received)
+
+
+if(__name__ == "__main__"):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engine", choices=["threaded", "selector"], default="selector")
+    parser.add_argument("--port", type=int, default=18830)
+    parser.add_argument("--trains", type=int, default=200)
+    parser.add_argument("--updates", type=int, default=20, help="location updates per train")
+    args = parser.parse_args()
+
+    # Train.__move publishes one location per train per second
+    results = dict()
+    for aliases in (False, True):
+        inbound, outbound, received = run(args.engine, args.port, args.trains, args.updates, aliases)
+        results[aliases] = (inbound, outbound)
+        print(f"topic aliases {'on ' if aliases else 'off'}: {inbound:6.1f} bytes/update train->broker, "
+              f"{outbound:6.1f} bytes/update broker->control center ({received} delivered)")
+    saved = [off - on for off, on in zip(results[False], results[True])]
+    print(f"saved {saved[0]:.1f} + {saved[1]:.1f} bytes per update "
+          f"({(saved[0]+saved[1]) / sum(results[False]):.0%}), "
+          f"{(saved[0]+saved[1])*args.trains/1024:.1f} KiB/s at one update per second for {args.trains} trains")
+    shutdown()
@@ -0,0 +1,76 @@
+# Microbenchmark: trie subscription matching vs. the old per-publish "prefix/#" expansion
+# Run from the repository root: python -m benchmarks.topic_match [--filters 1000,10000,100000]
+import argparse, random, time
+from topictrie import TopicTrie
+from benchmarks.common import ns_per_call
+
+
+# Old broker behaviour: build every "prefix/#" string for the topic and probe a dict of exact filters
+def expansion_match(topics: dict[str, set[str]], topic_name: str):
+    topic_filter = topic_name.split('/')
+    topic_names = ["/".join(topic_filter[:i])+"/#" for i in range(1,len(topic_filter))]
+    topic_names.extend([topic_name, "#"])
+    matched = set()
+    for name in topic_names:
+        if(topics.get(name)):
+            matched |= topics[name]
+    return matched
+
+
+# Filters shaped like the train network: exact train topics, per-region wildcards and per-train '+' filters
+def make_filters(count: int):
+    filters = []
+    for i in range(count):
+        kind = i % 4
+        if(kind == 0): filters.append(f"trains/train{i}")
+        elif(kind == 1): filters.append(f"regions/r{i%500}/trains/#")
+        elif(kind == 2): filters.append(f"trains/+/status/s{i}")
+        else: filters.append(f"depots/d{i%200}/trains/train{i}/#")
+    return filters
+
+
+def make_topics(count: int, samples: int):
+    rng = random.Random(1)
+    topics = []
+    for _ in range(samples):
+        i = rng.randrange(count)
+        topics.append(rng.choice([f"trains/train{i}", f"regions/r{i%500}/trains/train{i}",
+                                  f"trains/train{i}/status/s{i}", f"depots/d{i%200}/trains/train{i}/location"]))
+    return topics
+
+
+# Best ns per call of `func(topic)`, timed over whole passes through the sample topics
+def ns_per_match(func, topics: list[str]):
+    def run():
+        for topic in topics:
+            func(topic)
+    return ns_per_call(run, rounds=1, repeats=3) / len(topics)
+
+
+if(__name__ == "__main__"):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--filters", default="1000,10000,100000")
+    parser.add_argument("--samples", type=int, default=50000)
+    args = parser.parse_args()
+
+    print(f"{'filters':>8} {'trie ns/match':>14} {'expansion ns/match':>19} {'trie insert s':>14}")
+    for count in map(int, args.filters.split(",")):
+        filters = make_filters(count)
+
+        trie = TopicTrie()
+        start = time.perf_counter()
+        for i, topic_filter in enumerate(filters):
+            trie.insert(topic_filter, f"client{i%1000}")
+        insert_time = time.perf_counter() - start
+
+        exact: dict[str, set[str]] = dict()
+        for i, topic_filter in enumerate(filters):
+            exact.setdefault(topic_filter, set()).add(f"client{i%1000}")
+
+        topics = make_topics(count, args.samples)
+        trie_ns = ns_per_match(trie.match, topics)
+        expansion_ns = ns_per_match(lambda topic: expansion_match(exact, topic), topics)
+        print(f"{count:>8} {trie_ns:>14,.0f} {expansion_ns:>19,.0f} {insert_time:>14.3f}")
+
+    print("note: the expansion path cannot match '+' filters, so it does less work than the trie")
@@ -0,0 +1,68 @@
+# Benchmark: aggregate QoS 0 throughput of the selector broker run as 1, 2, 4... SO_REUSEPORT worker processes
+# Run from the repository root: python -m benchmarks.workers [--workers 1,2,4] [--pairs 8] [--messages N]
+import argparse, multiprocessing, os, resource, threading, time
+from MQTTPacket import FixedHeader, MQTTPacket
+from variableheaders import *
+from utils import *
+from benchmarks.broker_engines import mqtt_connect, start_broker, count_publishes
+
+
+# One load generator process: a subscriber and a publisher on their own topic. Each connection lands on
+# whichever worker the kernel picks, so most pairs are routed across workers once there are several.
+def publisher_pair(port: int, pair: int, messages: int, payload_size: int, results):
+    topic = f"bench/{pair}"
+    sub = mqtt_connect(port, f"bench-sub-{pair}")
+    sub.sendall(MQTTPacket(FixedHeader(SUBSCRIBE), SubscribeVariableHeader(1, [(topic, 0)])).encode())
+    sub.recv(16)                                                      # SUBACK
+    pub = mqtt_connect(port, f"bench-pub-{pair}")
+    time.sleep(0.5)                                                   # Let the subscription reach every worker
+
+    result = dict()
+    counter = threading.Thread(target=count_publishes, args=(sub, messages, time.time()+60, result))
+    counter.start()
+    packet = MQTTPacket(FixedHeader(PUBLISH), PublishVariableHeader(topic, "x"*payload_size)).encode()
+    start = time.time()
+    for _ in range(messages//100):
+        pub.sendall(packet*100)
+    pub.sendall(packet*(messages%100))
+    counter.join()
+    results.put((result["received"], result["finished"] - start))
+    pub.close(); sub.close()
+
+
+def bench_workers(port: int, workers: int, pairs: int, messages: int, payload_size: int):
+    proc = start_broker("selector", port, "--workers", str(workers))
+    try:
+        results = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=publisher_pair, args=(port, pair, messages, payload_size, results))
+                 for pair in range(pairs)]
+        for p in procs: p.start()
+        outcomes = [results.get(timeout=120) for _ in procs]
+        for p in procs: p.join()
+    finally:
+        proc.terminate()                                              # Parent stops its workers on SIGTERM
+        proc.wait()
+    received = sum(count for count, _ in outcomes)
+    elapsed = max(seconds for _, seconds in outcomes)
+    return received, pairs*messages, elapsed
+
+
+if(__name__ == "__main__"):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--pairs", type=int, default=8, help="publisher/subscriber pairs, one load process each")
+    parser.add_argument("--messages", type=int, default=20000, help="messages per publisher")
+    parser.add_argument("--payload", type=int, default=32)
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    print(f"{os.cpu_count()} CPUs; load generators share them with the broker")
+    port = 18850
+    for workers in map(int, args.workers.split(",")):
+        received, expected, elapsed = bench_workers(port, workers, args.pairs, args.messages, args.payload)
+        print(f"{workers:>2} workers: forwarded {received}/{expected} messages in {elapsed:.2f}s "
+              f"({received/elapsed:,.0f} msgs/sec)")
+        port += 1
@@ -1,238 +1,1620 @@
 # Importing necessary modules
-import socket, threading, time
+import socket, threading, time, selectors, os, signal, sys, math, zlib
+from collections import deque
+from functools import partial
+from queue import Queue
 from MQTTPacket import FixedHeader, MQTTPacket       # Custom classes for MQTT packets
+from MQTTPacket import PINGRESP_PACKET, puback_packet, suback_packet, publish_head   # Constant and templated frames
 from variableheaders import *                        # Importing various MQTT variable header classes
 from utils import *                                  # Importing utility functions
-import sys                                           # For accessing command-line arguments
-
-# Function to receive fixed header and remaining length from socket
-def recv_fixed_header(conn: socket.socket):
-    encoded = conn.recv(2)                           # Receive first 2 bytes (may include remaining length partially)
-    if(encoded):
-        if(encoded == b'\x00'): return 0             # Check for invalid/empty packet
-        decoded_len = 0; i=1                         # Initialize decoded length and shift count
-        while encoded[-1]&128:                       # While the most significant bit (MSB) is 1 (more bytes to read)
-            decoded_len = (encoded[-1]-128)<<7*i|decoded_len
-            encoded += conn.recv(1)                  # Keep receiving until remaining length is fully read
-            i+=1
-        decoded_len = (encoded[-1])<<7*i|decoded_len
-        return encoded, decoded_len                  # Return fixed header and decoded length
+from topictrie import TopicTrie, valid_filter        # Subscription index with wildcard matching
+from inflight import InflightTable                   # QoS 1 messages awaiting PUBACK from subscribers
+from outqueue import OutboundQueue, POLICIES, DROP_NEWEST, MAX_IOV   # Bounded per-client outbound queues
+from framereader import FrameReader                  # Buffered packet framing for socket reads
+from retained import RetainedStore                   # Last RETAIN publish per topic
+from sessions import Session, SessionStore, SESSION_EXPIRY   # Clean Start = 0 sessions, journaled to disk
+from timerwheel import TimingWheel                   # Keep-alive deadlines
+from metrics import BrokerMetrics                    # Counters, histograms, $SYS topics and the scrape endpoint
+from sharedsubs import SharedSubscriptions, SHARE_POLICIES, SHARE_PREFIX, split_share   # "$share/<group>/<filter>"
+from admission import TokenBucket                    # CONNECT rate limiting
+from registry import ClientSession, SessionRegistry  # Per-connection client state
+import argparse                                      # For parsing command-line arguments
+
+CONFLATE_PREFIX = "$conflate/"                       # "$conflate/<filter>": keep only the latest pending message per topic
+SUB_CONFLATE = 0x100                                 # Broker-internal subscription option bit (above the wire byte)
+CONNECTION_BUFFER = 4096                             # Initial receive buffer per selector connection, grows for large packets
+PEER_PREFIX = "$peer"                                # Client id prefix of links to sibling worker processes
+PEER_QUEUE_LIMITS = (100000, 64 << 20, DROP_NEWEST)  # Worker links carry every client's traffic, so get a larger queue
+REJECTED_PACKET = MQTTPacket(FixedHeader(CONNACK), ConnackVariableHeader(0, 0x82)).encode()        # Repeat CONNECT
+RATE_EXCEEDED_PACKET = MQTTPacket(FixedHeader(CONNACK), ConnackVariableHeader(0, 0x9F)).encode()   # Over the connect rate
+RECEIVE_EXCEEDED_PACKET = MQTTPacket(FixedHeader(DISCONNECT), DisconnectVariableHeader(0x93)).encode()
+ALIAS_INVALID_PACKET = MQTTPacket(FixedHeader(DISCONNECT), DisconnectVariableHeader(0x94)).encode()
+TOPIC_ALIAS_LIMIT = 64                               # Default number of topic aliases a client may define towards us
+RECEIVE_LIMIT = 64                                   # Default Receive Maximum: unacknowledged QoS 1 PUBLISHes we accept per client
+LISTEN_BACKLOG = 1024                                # Default listen backlog, room for a whole depot reconnecting at once
+CONNECT_TIMEOUT = 10.0                               # Default seconds a new connection has to send its CONNECT
+PUBLISH_BATCH = 256                                  # Default PUBLISHes of one read routed together, 1: one at a time
+FLUSH_BYTES = 1 << 16                                # Output queued for a client within a batch before it is written early
+STREAM_THRESHOLD = 1 << 20                           # Default size above which a PUBLISH is forwarded while it arrives
+STREAM_STALL = 10.0                                  # Seconds a subscriber may hold up a streamed PUBLISH before it is dropped
+
+# Outgoing copies of one received PUBLISH, built once and shared by every subscriber
+class OutgoingPublish:
+
+    def __init__(self, encoded_packet: bytes | memoryview):
+        self.frame = bytes(encoded_packet)          # Single copy out of the receive buffer
+        view = memoryview(self.frame)
+        self.flags = self.frame[0] & 0x0f
+        self.qos = (self.flags & 0b0110) >> 1
+
+        # Locate the topic and the properties+payload without decoding them
+        i = 1
+        while self.frame[i] & 128: i += 1
+        header_end = i+1                            # End of fixed header and remaining length
+        topic_end = header_end + 2 + int.from_bytes(self.frame[header_end:header_end+2])
+        self.topic = view[header_end:topic_end]     # Length-prefixed topic name
+        self.tail = view[topic_end+2 if self.qos else topic_end:]   # Properties and payload, shared by all copies
+        self.body_len = len(self.topic) + len(self.tail)             # Remaining length without a packet id
+        self.retain = bool(self.flags & 0b0001)
+
+        self.qos0_packets = [None, None]            # Indexed by the RETAIN flag of the copy
+        self.qos1_heads = [None, None]
+        self.name = None
+        self.expires_at = None                      # Message Expiry Interval deadline (time.time()), if any
+
+    # Topic name as a string, decoded on first use
+    @property
+    def topic_name(self):
+        if(self.name is None):
+            self.name = str(self.topic[2:], 'utf-8')
+        return self.name
+
+    # Offset of the properties and of the payload in tail
+    def __split_tail(self):
+        props_len, i = decode_var_int(self.tail, 0)
+        return i, i + props_len
+
+    # A RETAIN publish with an empty payload clears the retained message for its topic
+    def empty_payload(self):
+        return self.__split_tail()[1] == len(self.tail)
+
+    # Message Expiry Interval from the properties, None when the message does not expire
+    def message_expiry(self):
+        return decode_properties(self.tail)[0].get(MESSAGE_EXPIRY_INTERVAL)
+
+    # Copy whose Message Expiry Interval is the time left at `now`, for a delivery that was held back
+    # (retained replay, offline session). Keeps the packet id of a QoS 1 frame.
+    def restamped(self, now: float):
+        properties, payload_start = decode_properties(self.tail)
+        properties[MESSAGE_EXPIRY_INTERVAL] = max(0, math.ceil(self.expires_at - now))
+        packet_id = self.frame[len(self.frame)-len(self.tail)-2:len(self.frame)-len(self.tail)] if self.qos else b''
+        body = bytes(self.topic) + packet_id + encode_properties(properties) + bytes(self.tail[payload_start:])
+        copy = OutgoingPublish(bytes([PUBLISH << 4 | self.flags]) + int_to_var_bytes(len(body)) + body)
+        copy.expires_at = self.expires_at
+        return copy
+
+    # Buffers for a QoS 0 delivery: the original frame when it already is one.
+    # RETAIN is only kept when asked for (retained replays, Retain As Published subscriptions).
+    def qos0(self, retain: bool = False):
+        retain = retain and self.retain
+        if(self.qos0_packets[retain] is None):
+            if(self.qos == 0 and not self.flags & 0x08 and self.retain == retain):
+                self.qos0_packets[retain] = (self.frame,)
+            else:
+                head = bytes([PUBLISH << 4 | retain]) + int_to_var_bytes(self.body_len)
+                self.qos0_packets[retain] = (head, self.topic, self.tail)
+        return self.qos0_packets[retain]
+
+    # Buffers for a QoS 1 delivery; only the 2 byte packet id differs between subscribers
+    def qos1(self, packet_id: int, retain: bool = False):
+        retain = retain and self.retain
+        if(self.qos1_heads[retain] is None):
+            self.qos1_heads[retain] = bytes([PUBLISH << 4 | retain | 0b0010]) + int_to_var_bytes(self.body_len+2)
+        return (self.qos1_heads[retain], self.topic, packet_id.to_bytes(2), self.tail)
+
+    # Buffers for a delivery using one of the subscriber's topic aliases: the topic name only goes out
+    # with the first use of the alias, later copies carry an empty topic. The payload is still shared.
+    def aliased(self, alias: int, send_topic: bool, packet_id: int | None = None, retain: bool = False):
+        retain = retain and self.retain
+        props_start, payload_start = self.__split_tail()
+        props = (int_to_var_bytes(payload_start-props_start+3) + bytes(self.tail[props_start:payload_start])
+                 + bytes([TOPIC_ALIAS]) + alias.to_bytes(2))
+        payload = self.tail[payload_start:]
+        topic = self.topic if send_topic else b'\x00\x00'
+        if(packet_id is None):
+            head = bytes([PUBLISH << 4 | retain]) + int_to_var_bytes(len(topic) + len(props) + len(payload))
+            return (head, topic, props, payload)
+        head = bytes([PUBLISH << 4 | retain | 0b0010]) + int_to_var_bytes(len(topic) + 2 + len(props) + len(payload))
+        return (head, topic, packet_id.to_bytes(2), props, payload)
+
+
+# A PUBLISH too large to buffer whole, forwarded chunk by chunk as its payload arrives. Every subscriber
+# gets a QoS 0 copy; targets holds (ClientSession, open OutboundQueue entry) for each of them.
+class PublishStream:
+
+    def __init__(self, recv_packet: MQTTPacket, payload_len: int):
+        publish = recv_packet.variable_data
+        self.qos = (recv_packet.fixed_header.flags & 0b0110) >> 1
+        self.retain = bool(recv_packet.fixed_header.flags & 0b0001)
+        self.packet_id = publish.packet_id
+        self.topic_name = publish.topic_name
+        self.properties = publish.properties        # Without the publisher's Topic Alias
+        self.payload_len = payload_len
+        self.targets: list[tuple[ClientSession, list]] = []
+        self.heads = [None, None]                   # Indexed by the RETAIN flag of the copy
+
+    # Head of a subscriber's copy; RETAIN is only kept for Retain As Published subscriptions
+    def head(self, retain: bool = False):
+        retain = retain and self.retain
+        if(self.heads[retain] is None):
+            self.heads[retain] = publish_head(int(retain), self.topic_name, self.payload_len, None, self.properties)
+        return self.heads[retain]
+
+    # Subscribers more than their queue limit behind
+    def slow(self):
+        return [target for target, _ in self.targets
+                if(not target.queue.closed and target.queue.bytes > target.queue.max_bytes)]
+
+
+# Per-socket state used by the selector engine
+class Connection:
+
+    def __init__(self, sock: socket.socket, stream_threshold: int | None = None):
+        self.sock = sock
+        self.client_id: str | None = None           # Set once the CONNECT packet has been accepted
+        self.reader = FrameReader(CONNECTION_BUFFER, stream_threshold=stream_threshold)   # Bytes not yet parsed
+        self.writing = False                        # Whether the socket is registered for EVENT_WRITE
+        self.paused = False                         # Unregistered while a slow subscriber holds up its stream
+        self.closed = False
+        self.peer = False                           # Link to a sibling worker rather than an MQTT client
 
 
 # MQTT Broker class
 class Broker:
 
-    def __init__(self, broker_ip: str):
+    def __init__(self, broker_ip: str, port: int = 1883, engine: str = "threaded", retry_interval: float = 5.0,
+                 queue_max_messages: int = 1000, queue_max_bytes: int = 1 << 20, queue_policy: str = "drop-oldest",
+                 reuse_port: bool = False, retained_file: str | None = None, retained_max_messages: int | None = None,
+                 retained_max_bytes: int | None = None, snapshot_interval: float = 30.0, session_dir: str | None = None,
+                 sys_interval: float = 10.0, metrics_port: int = 0, share_policy: str = "round-robin",
+                 topic_alias_maximum: int = TOPIC_ALIAS_LIMIT, receive_maximum: int = RECEIVE_LIMIT,
+                 listen_backlog: int = LISTEN_BACKLOG, connect_timeout: float = CONNECT_TIMEOUT, connect_rate: float = 0,
+                 connect_burst: int | None = None, publish_batch: int = PUBLISH_BATCH,
+                 stream_threshold: int = STREAM_THRESHOLD, session_expiry: int = SESSION_EXPIRY):
+        assert engine in ("threaded", "selector")
+        self.engine = engine                        # "threaded": thread per client, "selector": single event loop
+
         # Create and configure server socket
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server_socket.bind((broker_ip, 1883))  # Bind broker to port 1883 (MQTT standard)
-        self.server_socket.listen(5)                # Start listening for incoming connections
+        if(reuse_port):
+            # Several worker processes bind the same port, the kernel spreads new connections between them
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.server_socket.bind((broker_ip, port))  # Bind broker to port (1883 is the MQTT standard)
+        self.server_socket.listen(listen_backlog)   # Start listening for incoming connections
+
+        # Admission control: a deadline for the CONNECT packet and a limit on the rate of accepted CONNECTs
+        self.connect_timeout = connect_timeout
+        self.handshakes = TimingWheel()                     # Maps selector Connection -> deadline for its CONNECT
+        self.admission = TokenBucket(connect_rate, connect_burst) if connect_rate else None
 
         # Client data tracking
-        self.client_sockets = dict()                # Maps client_id -> socket
-        self.client_subs = dict()                   # Maps client_id -> set of subscribed topics
-        self.topics = dict()                        # Maps topic -> set of client_ids subscribed
-        self.client_locks = dict()                  # Locks for thread-safe communication with clients
+        self.clients = SessionRegistry()            # Maps client_id -> ClientSession (socket, queue, subscriptions...)
+        self.topics = TopicTrie()                   # Topic filter trie -> client_ids subscribed
+        self.topics_lock = threading.Lock()         # Guards the trie against concurrent subscribe/publish
+        self.shared = SharedSubscriptions(share_policy)     # Shared subscription groups, also under topics_lock
+        self.queue_limits = (queue_max_messages, queue_max_bytes, queue_policy)
         self.verbosity = 0                          # Verbosity flag for debugging
 
-        self.waiting_clients: dict[int, set[str]] = dict()  # Maps packet_id -> set of clients awaiting PUBACK
+        self.inflight = InflightTable(retry_interval)       # Maps (client_id, packet_id) -> message awaiting PUBACK
+        self.keepalive = TimingWheel()                      # Maps client_id -> deadline for its next packet
+
+        # Topic aliases and Receive Maximum flow control; their per-connection state is in each ClientSession
+        self.topic_alias_maximum = topic_alias_maximum      # Aliases each client may define, 0 disables them
+        self.alias_lock = threading.RLock()                 # Keeps alias definition and use in order in the queue
+        self.receive_maximum = receive_maximum              # QoS 1 PUBLISHes a client may leave unacknowledged
+        self.window_lock = threading.RLock()                # Makes the slot check and the send one step
+
+        # Successful CONNACKs only depend on the settings above, so both are encoded once (index: Session Present)
+        connack_properties = dict()
+        if(self.topic_alias_maximum):
+            connack_properties[TOPIC_ALIAS_MAXIMUM] = self.topic_alias_maximum
+        if(self.receive_maximum < 65535):
+            connack_properties[RECEIVE_MAXIMUM] = self.receive_maximum
+        self.connack_packets = tuple(MQTTPacket(FixedHeader(CONNACK),           # 0x00: Connection Accepted
+                                                ConnackVariableHeader(session_present, 0x00, connack_properties)).encode()
+                                     for session_present in (0, 1))
+
+        # Monitoring
+        self.metrics = BrokerMetrics()
+        self.sys_interval = sys_interval                    # Seconds between $SYS publishes, 0 disables them
+        self.sys_prefix = "$SYS/broker"
+        self.next_sys = time.time() + sys_interval
+        self.last_sys = (time.time(), 0, 0)                 # (time, messages received, messages sent) at the last publish
+        self.metrics_port = metrics_port                    # Local Prometheus scrape port, 0 disables it
+
+        # Retained messages, restored from the last snapshot
+        self.retained = RetainedStore(retained_max_messages, retained_max_bytes)
+        self.retained_file = retained_file
+        self.snapshot_interval = snapshot_interval          # Seconds between snapshots, 0 disables them
+        if(retained_file):
+            loaded = self.retained.load(retained_file, self.__decode_retained)
+            print(f"Loaded {loaded} retained messages from {retained_file}")
+
+        # Batched ingestion: the PUBLISHes of one read are routed together, and the selector engine writes
+        # what they queued once per pass of the event loop instead of once per packet
+        self.publish_batch = max(1, publish_batch)
+        self.unflushed: set[Connection] = set()             # Selector connections with output queued since the last write
+
+        # Streaming: larger PUBLISHes are forwarded while their payload arrives, never buffered whole
+        self.stream_threshold = stream_threshold or None    # None: every packet is read whole
+        self.stalled: dict[Connection, float] = dict()      # Selector publishers paused by a slow subscriber -> since
+
+        # Selector engine state
+        self.selector = selectors.DefaultSelector()
 
+        # Routing between worker processes (see run_workers)
+        self.peers: dict[str, Connection] = dict()          # Maps peer id -> link to a sibling worker
+        self.worker_id: str | None = None                   # This worker's peer id, as its siblings know it
+        self.peer_topics = TopicTrie()                      # Filters subscribed on sibling workers, keyed by peer id,
+                                                            #   and shared subscriptions keyed by share name
+        self.peer_filters: dict[str, set[str]] = dict()     # Maps peer id -> filters it announced
+        self.peer_shares: dict[str, set[str]] = dict()      # Maps share name -> peer ids with members in the group
+        self.filter_refs: dict[str, int] = dict()           # Maps local filter or share name -> local subscribers
 
-    # Function to accept and listen for incoming client connections
+        # Persistent sessions; their subscriptions stay in the trie while the client is offline, for at most
+        # session_expiry seconds
+        self.sessions = SessionStore(session_dir, queue_max_messages, max_expiry=session_expiry)
+        for session in self.sessions.sessions.values():
+            for topic_filter, sub_options in session.subs.items():
+                self.__insert_subscription(topic_filter, session.client_id, sub_options)
+                self.__add_interest(topic_filter)
+        if(session_dir):
+            print(f"Restored {len(self.sessions)} sessions from {session_dir}")
+
+
+    # Function to accept and listen for incoming client connections; the CONNECT is read in the client's
+    # own thread so a slow or silent connection never holds up the ones behind it
     def __listen_for_clients(self):
         while True:
             client_socket, _ = self.server_socket.accept()         # Accept connection
-            encoded_packet, packet_len = recv_fixed_header(client_socket)
-            encoded_packet += client_socket.recv(packet_len)       # Receive full packet
-            recv_packet = MQTTPacket.decode(encoded_packet)        # Decode the received MQTT packet
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)   # Small packets go out at once
+            thread = threading.Thread(target = self.__handshake, args=(client_socket,))
+            thread.start()                                         # Handle each client in a new thread
 
-            # Validate it's a CONNECT packet
-            assert recv_packet.encode() == encoded_packet
-            if(recv_packet.fixed_header.packet_type == CONNECT):
-                thread = threading.Thread(target = self.__handle_connect, args=(recv_packet, client_socket))
-                thread.start()                                     # Handle each client in a new thread
 
+    # Threaded engine: wait up to connect_timeout for the CONNECT packet, then serve the client
+    def __handshake(self, client_socket: socket.socket):
+        reader = FrameReader(stream_threshold=self.stream_threshold)   # Kept for the client, may hold pipelined packets
+        client_socket.settimeout(self.connect_timeout or None)
+        try:
+            encoded_packet = reader.read_frame(client_socket)      # Receive full packet
+        except TimeoutError:
+            self.metrics.handshake_timeouts += 1
+            encoded_packet = None
+        except (OSError, ValueError):
+            encoded_packet = None
+        if(encoded_packet is None):
+            client_socket.close()                                  # Closed, silent or malformed before CONNECT
+            return
+        client_socket.settimeout(None)
 
-    # Start broker's main loop
+        # Validate it's a CONNECT packet (checked first, a streamed PUBLISH's head does not decode as a packet)
+        if(encoded_packet[0] >> 4 != CONNECT):
+            client_socket.close()
+            return
+        try:
+            recv_packet = MQTTPacket.decode(encoded_packet)        # Decode the received MQTT packet
+        except ValueError:
+            client_socket.close()                                  # Malformed, or not MQTT 5
+            return
+        self.__handle_connect(recv_packet, client_socket, reader)
+
+
+    # Start broker's main loop, returns the thread running it
     def loop(self, verbosity = 0):
         self.verbosity = verbosity
+        if(self.retained_file and self.snapshot_interval):
+            threading.Thread(target=self.__snapshot_loop, daemon=True).start()
+        if(self.metrics_port):
+            self.metrics.serve(self.metrics_port, self.gauges, self.queue_stats)
+        if(self.engine == "selector"):
+            loop_thread = threading.Thread(target=self.__event_loop)
+            loop_thread.start()
+            return loop_thread
         wait_for_client_thread = threading.Thread(target=self.__listen_for_clients)
         wait_for_client_thread.start()
+        retransmit_thread = threading.Thread(target=self.__retransmit_loop, daemon=True)
+        retransmit_thread.start()
+        return wait_for_client_thread
 
 
-    # Handle a client's CONNECT request
-    def __handle_connect(self, conn_packet: MQTTPacket, client_socket: socket.socket):
-        client_id = conn_packet.variable_data.client_id
+    # Periodically write the retained store to disk so a restarted broker comes back with it
+    def __snapshot_loop(self):
+        while True:
+            time.sleep(self.snapshot_interval)
+            if(self.retained.dirty):
+                try:
+                    self.retained.save(self.retained_file)
+                except OSError as e:
+                    print(f"Retained snapshot failed: {e}")
+
+
+    # Snapshot entry -> (topic_name, message, size) for RetainedStore.load
+    @staticmethod
+    def __decode_retained(frame: bytes, expires_at: float | None):
+        outgoing = OutgoingPublish(frame)
+        if(expires_at is None):
+            expiry = outgoing.message_expiry()
+            if(expiry is not None):
+                expires_at = time.time() + expiry               # Snapshot from before expiry times were saved
+        outgoing.expires_at = expires_at
+        return outgoing.topic_name, outgoing, len(outgoing.frame)
+
+
+    # Attach a link to a sibling worker process (selector engine, before loop() is called)
+    def add_peer(self, peer_id: str, sock: socket.socket):
+        assert self.engine == "selector" and peer_id.startswith(PEER_PREFIX)
+        sock.setblocking(False)
+        conn = Connection(sock)
+        conn.client_id = peer_id
+        conn.peer = True
+        self.peers[peer_id] = conn
+        self.peer_filters[peer_id] = set()
+        link = ClientSession(peer_id, sock, OutboundQueue(*PEER_QUEUE_LIMITS), conn)
+        self.clients.add(link)
+        self.selector.register(sock, selectors.EVENT_READ, conn)
+        if(self.filter_refs):
+            # Filters already subscribed (restored sessions)
+            packet = MQTTPacket(FixedHeader(SUBSCRIBE), SubscribeVariableHeader(1, [(f, 0) for f in self.filter_refs]))
+            link.queue.put(packet.encode(), droppable=False)
+
+
+    # Threaded engine: resend unacknowledged QoS 1 messages and drop idle clients when their timers expire
+    def __retransmit_loop(self):
+        while True:
+            next_deadline = self.inflight.next_deadline()
+            tick = self.keepalive.tick
+            time.sleep(min(tick, max(0.01, next_deadline-time.time())) if next_deadline else tick)
+            now = time.time()
+            self.__retransmit(now)
+            self.__expire_idle(now)
+            self.__expire_sessions(now)
+            self.__publish_sys(now)
+
+
+    # Current values of the broker's gauges, as {name: (help, value)}
+    def gauges(self):
+        clients = [client for client in self.clients.sessions() if client.client_id not in self.peers]
+        queues = [client.queue for client in clients]
+        return {
+            "clients_connected": ("Connected clients", len(clients)),
+            "inflight_messages": ("QoS 1 messages awaiting PUBACK", self.inflight.count()),
+            "held_messages": ("QoS 1 messages waiting for a slot in a client's Receive Maximum",
+                              sum(len(client.held) for client in clients if client.held)),
+            "queued_messages": ("Packets waiting in outbound queues", sum(len(queue) for queue in queues)),
+            "queued_bytes": ("Bytes waiting in outbound queues", sum(queue.bytes for queue in queues)),
+            "queue_depth_max": ("Deepest outbound queue", max((len(queue) for queue in queues), default=0)),
+            "messages_dropped": ("Packets dropped by outbound queue overflow", sum(queue.dropped for queue in queues)),
+            "messages_expired": ("Packets discarded unsent after their Message Expiry Interval",
+                                 sum(queue.expired for queue in queues)),
+            "retained_messages": ("Retained messages", len(self.retained)),
+            "sessions": ("Persistent sessions", len(self.sessions)),
+        }
+
+
+    # Publish broker statistics on $SYS topics (retained) every sys_interval seconds
+    def __publish_sys(self, now: float):
+        if(not self.sys_interval or now < self.next_sys): return
+        self.next_sys = now + self.sys_interval
+        metrics = self.metrics
+        last_time, last_received, last_sent = self.last_sys
+        self.last_sys = (now, metrics.messages_received, metrics.messages_sent)
+        elapsed = max(now - last_time, 1e-9)
+
+        values = {name: value for name, (_, value) in self.gauges().items()}
+        values.update({
+            "messages/received": metrics.messages_received,
+            "messages/sent": metrics.messages_sent,
+            "messages/received/rate": round((metrics.messages_received-last_received) / elapsed, 1),
+            "messages/sent/rate": round((metrics.messages_sent-last_sent) / elapsed, 1),
+            "bytes/received": metrics.bytes_received,
+            "bytes/sent": metrics.bytes_sent,
+            "fanout/avg": round(metrics.fanout.sum / metrics.fanout.count, 2) if metrics.fanout.count else 0,
+            "latency/p50": metrics.latency.quantile(0.5),
+            "latency/p99": metrics.latency.quantile(0.99),
+        })
+        for name, value in values.items():
+            # Built rather than decoded, __handle_publish only needs the header fields
+            packet = MQTTPacket(FixedHeader(PUBLISH, 0b0001), PublishVariableHeader(f"{self.sys_prefix}/{name}", str(value)))
+            self.__handle_publish(packet, packet.encode(), "$SYS", count=False)
+
+
+    # Drop clients that sent nothing for 1.5 times their keep-alive
+    def __expire_idle(self, now: float):
+        for client_id in self.keepalive.expire(now):
+            print(f"Timeout {client_id}")
+            self.__drop_client(client_id)
+
+
+    # Discard the persistent sessions whose client stayed away longer than their Session Expiry Interval
+    def __expire_sessions(self, now: float):
+        for session in self.sessions.expire(now, self.clients.__contains__):
+            if self.verbosity > 0: print(f"Session of {session.client_id} expired")
+            self.__remove_session_subscriptions(session)
 
-        # If client is new
-        if(client_id not in self.client_sockets):
-            self.client_sockets[client_id] = client_socket
-            self.client_subs[client_id] = set()
-            self.client_locks[client_id] = threading.Lock()
+
+    # Selector engine: close connections that did not send their CONNECT within connect_timeout
+    def __expire_handshakes(self, now: float):
+        for conn in self.handshakes.expire(now):
+            if(conn.client_id is None and not conn.closed):
+                self.metrics.handshake_timeouts += 1
+                self.__close_connection(conn)
+
+
+    # Resend every inflight message whose retransmission timer has expired; its next timer starts once the copy
+    # has been written
+    def __retransmit(self, now: float):
+        for message in self.inflight.expired(now):
+            if(message.client_id in self.clients):
+                if self.verbosity > 0: print(f"Resending packet {message.packet_id} to {message.client_id}")
+                self.__send(message.client_id, message.packet, droppable=True,
+                            on_dequeued=partial(self.inflight.sent, message))
+
+
+    # Selector engine: multiplex the listening socket and every client socket on one thread
+    def __event_loop(self):
+        self.server_socket.setblocking(False)
+        self.selector.register(self.server_socket, selectors.EVENT_READ, None)
+
+        while True:
+            # Wake up for the next keep-alive tick, or sooner for a QoS 1 retransmission
+            timeout = self.keepalive.tick
+            next_deadline = self.inflight.next_deadline()
+            if(next_deadline is not None):
+                timeout = min(timeout, max(0, next_deadline-time.time()))
+
+            for key, mask in self.selector.select(timeout=timeout):
+                if(key.data is None):
+                    self.__accept_clients()
+                    continue
+                conn: Connection = key.data
+                if(mask & selectors.EVENT_READ):
+                    self.__read_connection(conn)
+                if(mask & selectors.EVENT_WRITE and not conn.closed):
+                    self.__flush_connection(conn)
+
+            now = time.time()
+            self.__retransmit(now)
+            self.__expire_idle(now)
+            self.__expire_sessions(now)
+            self.__expire_handshakes(now)
+            self.__publish_sys(now)
+            self.__flush_unflushed()
+            if(self.stalled): self.__resume_streams(now)
+
+
+    # Accept every pending connection on the listening socket
+    def __accept_clients(self):
+        while True:
+            try:
+                client_socket, _ = self.server_socket.accept()
+            except BlockingIOError:
+                return
+            client_socket.setblocking(False)
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = Connection(client_socket, self.stream_threshold)
+            self.selector.register(client_socket, selectors.EVENT_READ, conn)
+            if(self.connect_timeout):
+                self.handshakes.schedule(conn, self.connect_timeout, time.time())
+
+
+    # Read whatever is available on a client socket and dispatch complete packets
+    def __read_connection(self, conn: Connection):
+        try:
+            received = conn.reader.recv_from(conn.sock)
+        except BlockingIOError:
+            return
+        except OSError:
+            received = 0
+        if(not received):                                       # Peer closed the connection
+            self.__close_connection(conn)
+            return
+
+        if(conn.client_id is not None): self.keepalive.touch(conn.client_id, time.time())
+        self.metrics.bytes_received += received
+        self.metrics.socket_reads += 1
+        received_at = time.perf_counter()
+        batch = []                                              # PUBLISHes waiting to be routed together
+        reader = conn.reader
+        try:
+            while True:
+                # Every complete packet in the buffer, as memoryviews decoded in place
+                for encoded_packet in reader.frames():
+                    if(reader.payload_left):
+                        # Head of a PUBLISH too large to buffer: forwarded as it arrives, after earlier PUBLISHes
+                        if(batch):
+                            self.__handle_publishes(batch, conn.client_id, received_at, from_peer=conn.peer)
+                            batch = []
+                        if(conn.client_id is None or not self.__open_stream(conn.client_id, encoded_packet,
+                                                                            reader.payload_left)):
+                            self.__close_connection(conn)
+                            return
+                        continue
+                    recv_packet = MQTTPacket.decode(encoded_packet)
+                    if(recv_packet.fixed_header.packet_type == PUBLISH and conn.client_id is not None):
+                        if(not conn.peer):
+                            encoded_packet = self.__resolve_topic_alias(conn.client_id, recv_packet, encoded_packet)
+                            if(encoded_packet is None): break   # Unknown alias, client dropped
+                        batch.append((recv_packet, encoded_packet))
+                        if(len(batch) >= self.publish_batch):
+                            self.__handle_publishes(batch, conn.client_id, received_at, from_peer=conn.peer)
+                            batch = []
+                        continue
+                    if(batch and recv_packet.fixed_header.packet_type not in (PUBACK, PINGREQ)):
+                        # Route earlier PUBLISHes before a SUBSCRIBE or DISCONNECT takes effect
+                        self.__handle_publishes(batch, conn.client_id, received_at, from_peer=conn.peer)
+                        batch = []
+                    self.__dispatch(conn, recv_packet, encoded_packet, received_at)
+                    if(conn.closed): return
+                if(batch):
+                    self.__handle_publishes(batch, conn.client_id, received_at, from_peer=conn.peer)
+                    batch = []
+
+                # The received part of a streamed payload; once it is complete, packets after it may be buffered
+                if(not reader.payload_left or conn.closed): return
+                client = self.clients.get(conn.client_id)
+                if(client is None or client.conn is not conn): return
+                self.__stream_payload(reader, client)
+                if(reader.payload_left or conn.closed): return
+        except ValueError:
+            self.__close_connection(conn)                       # Malformed packet (fields are decoded on use)
+
+
+    # Handle one decoded packet other than a PUBLISH for the selector engine
+    def __dispatch(self, conn: Connection, recv_packet: MQTTPacket, encoded_packet: memoryview, received_at: float):
+        packet_type = recv_packet.fixed_header.packet_type
+
+        if(conn.peer):
+            self.__dispatch_peer(conn, recv_packet, encoded_packet, received_at)
+            return
+
+        # First packet on a connection must be CONNECT
+        if(conn.client_id is None):
+            self.handshakes.cancel(conn)
+            if(packet_type != CONNECT or not self.__admit(conn.sock)):
+                self.__close_connection(conn)
+                return
+            client_id = recv_packet.variable_data.client_id
+            if(not self.__register_client(client_id, conn.sock, conn)):
+                self.__close_connection(conn)
+                return
+            conn.client_id = client_id
+            self.__accept_client(client_id, recv_packet.variable_data)
+            return
+
+        if(packet_type == CONNECT):
+            # Invalid repeat connect
+            print(f"Repeat connect from {conn.client_id}")
+            self.__send(conn.client_id, REJECTED_PACKET)
+            self.__drop_client(conn.client_id)
+
+        elif(packet_type == PUBACK):
+            self.__handle_ack(recv_packet, conn.client_id)
+
+        elif(packet_type == SUBSCRIBE):
+            self.__handle_subscribe(recv_packet, conn.client_id)
+
+        elif(packet_type == PINGREQ):
+            self.__send(conn.client_id, PINGRESP_PACKET)
+
+        elif(packet_type == DISCONNECT):
+            self.__drop_client(conn.client_id)
+
+
+    # Handle a subscription interest change from a sibling worker (its forwarded PUBLISHes are batched)
+    def __dispatch_peer(self, conn: Connection, recv_packet: MQTTPacket, encoded_packet: memoryview, received_at: float):
+        packet_type = recv_packet.fixed_header.packet_type
+        if(packet_type == SUBSCRIBE):
+            for topic_filter, _ in recv_packet.variable_data.topics:
+                self.peer_filters[conn.client_id].add(topic_filter)
+                self.__insert_peer_interest(topic_filter, conn.client_id)
+        elif(packet_type == UNSUBSCRIBE):
+            for topic_filter in recv_packet.variable_data.topics:
+                self.peer_filters[conn.client_id].discard(topic_filter)
+                self.__remove_peer_interest(topic_filter, conn.client_id)
+
+
+    # A sibling worker's filter is keyed by its peer id; a shared subscription is keyed by its share name, once
+    # whatever the number of workers with members, and peer_shares records which workers those are
+    def __insert_peer_interest(self, topic_filter: str, peer_id: str):
+        group, inner = split_share(topic_filter)
+        if(group is None):
+            self.peer_topics.insert(topic_filter, peer_id)
+            return
+        self.peer_shares.setdefault(topic_filter, set()).add(peer_id)
+        self.peer_topics.insert(inner, topic_filter)
+
+    def __remove_peer_interest(self, topic_filter: str, peer_id: str):
+        group, inner = split_share(topic_filter)
+        if(group is None):
+            self.peer_topics.remove(topic_filter, peer_id)
+            return
+        workers = self.peer_shares.get(topic_filter, set())
+        workers.discard(peer_id)
+        if(not workers):
+            self.peer_shares.pop(topic_filter, None)
+            self.peer_topics.remove(inner, topic_filter)
+
+
+    # Worker that serves a shared subscription: every worker hashes the share name over the workers with
+    # members of the group, so they agree on one and each message goes to one member. Without siblings, this one.
+    def __share_owner(self, share_name: str):
+        if(not self.peers): return self.worker_id
+        workers = set(self.peer_shares.get(share_name, ()))
+        if(share_name in self.shared.groups): workers.add(self.worker_id)
+        if(not workers): return None
+        return sorted(workers)[zlib.crc32(share_name.encode()) % len(workers)]
+
+
+    # Sibling workers a PUBLISH goes to: those with a matching subscriber, and the owners of matching shared
+    # subscriptions that are not served here
+    def __peer_targets(self, topic_name: str):
+        targets = set()
+        for key in self.peer_topics.match(topic_name):
+            if(key.startswith(SHARE_PREFIX)):
+                key = self.__share_owner(key)
+                if(key is None or key == self.worker_id): continue
+            targets.add(key)
+        return targets
+
+
+    # Tell sibling workers that a filter gained its first or lost its last local subscriber
+    def __announce_interest(self, topic_filter: str, subscribed: bool):
+        if(subscribed):
+            packet = MQTTPacket(FixedHeader(SUBSCRIBE), SubscribeVariableHeader(1, [(topic_filter, 0)]))
         else:
-            # Duplicate connect: send error CONNACK and disconnect
-            print(f'Repeat connect for {client_id}')
-            connack_fixed_header = FixedHeader(CONNACK)
-            connack_var_header = ConnackVariableHeader(0, 0x82)     # 0x82: Identifier Rejected
-            connack_packet = MQTTPacket(connack_fixed_header, connack_var_header)
-            client_socket.sendall(connack_packet.encode())
+            packet = MQTTPacket(FixedHeader(UNSUBSCRIBE), UnsubscribeVariableHeader(1, [topic_filter]))
+        encoded = packet.encode()
+        for peer_id in self.peers:
+            self.__send(peer_id, encoded)
+
+
+    # Count local subscribers per filter, announcing changes to sibling workers
+    def __add_interest(self, topic_filter: str):
+        refs = self.filter_refs.get(topic_filter, 0)
+        self.filter_refs[topic_filter] = refs + 1
+        if(not refs and self.peers): self.__announce_interest(topic_filter, True)
+
+    def __remove_interest(self, topic_filter: str):
+        refs = self.filter_refs.pop(topic_filter, 0) - 1
+        if(refs > 0):
+            self.filter_refs[topic_filter] = refs
+        elif(self.peers):
+            self.__announce_interest(topic_filter, False)
+
+
+    # Write as much of the queued output as the socket accepts
+    def __flush_connection(self, conn: Connection, client: ClientSession | None = None):
+        if(client is None): client = self.clients.get(conn.client_id)
+        if(client is None): return
+        queue = client.queue
+        while True:
+            buffers = queue.pending()
+            if(not buffers): break
+            try:
+                sent = conn.sock.sendmsg(buffers)               # Scatter-gather write of queued packets
+            except BlockingIOError:
+                break
+            except OSError:
+                self.__close_connection(conn)
+                return
+            queue.consume(sent)
+            self.metrics.bytes_sent += sent
+            self.metrics.socket_writes += 1
+            if(not queue.writable() or sent < sum(map(len, buffers))): break   # Drained, or kernel buffer full
+
+        # Only watch for writability while something can be written (not a stream waiting for its next chunk)
+        if(queue.writable() != conn.writing):
+            conn.writing = not conn.writing
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE if conn.writing else selectors.EVENT_READ
+            if(not conn.paused): self.selector.modify(conn.sock, events, conn)
+
+
+    # Write everything queued during this pass of the event loop, one sendmsg per connection
+    def __flush_unflushed(self):
+        while self.unflushed:
+            conn = self.unflushed.pop()
+            if(not conn.closed and not conn.writing):           # A backed up socket waits for EVENT_WRITE
+                self.__flush_connection(conn)
+
+
+    # Unregister and close a selector engine connection, dropping its client state
+    def __close_connection(self, conn: Connection):
+        if(conn.closed): return
+        conn.closed = True
+        self.unflushed.discard(conn)
+        self.handshakes.cancel(conn)
+        if(conn.paused):
+            self.stalled.pop(conn, None)                        # Not registered while paused
+        else:
+            self.selector.unregister(conn.sock)
+        conn.sock.close()
+        if(conn.peer):
+            # Sibling worker exited: stop routing to it
+            print(f"Lost link to worker {conn.client_id}")
+            self.peers.pop(conn.client_id, None)
+            for topic_filter in self.peer_filters.pop(conn.client_id, set()):
+                self.__remove_peer_interest(topic_filter, conn.client_id)
+        client = self.clients.get(conn.client_id) if conn.client_id is not None else None
+        if(client is not None and client.conn is conn):
+            self.__drop_client(conn.client_id, client)
+
+
+    # Queue data for a client; the I/O layer (event loop or per-client writer thread) drains the queue
+    def __send(self, client_id: str, data: bytes | tuple, droppable: bool = False, conflate_key: str | None = None,
+               expires_at: float | None = None, on_dequeued = None):
+        client = self.clients.get(client_id)
+        if(client is None): return                              # Client already gone
+        if(not client.queue.put(data, droppable, conflate_key, expires_at, on_dequeued)):
+            print(f"Outbound queue overflow for {client_id}, disconnecting")
+            self.__drop_client(client_id, client)
+            return
+
+        # Selector engine writes at the end of the event loop pass, or straight away when not batching or once
+        # a pass has queued a full sendmsg's worth; a backed up socket is written on EVENT_WRITE
+        if(client.conn is not None and not client.conn.writing):
+            queue = client.queue
+            if(self.publish_batch > 1 and len(queue) < MAX_IOV and queue.bytes < FLUSH_BYTES):
+                self.unflushed.add(client.conn)
+            else:
+                self.__flush_connection(client.conn, client)
+
+
+    # Threaded engine: per-client writer thread draining the outbound queue with blocking writes
+    def __drain_queue(self, client_socket: socket.socket, queue: OutboundQueue):
+        while queue.wait_pending():
+            buffers = queue.pending()
+            if(not buffers): continue
+            try:
+                sent = client_socket.sendmsg(buffers)
+            except OSError:
+                return
+            queue.consume(sent)
+            self.metrics.bytes_sent += sent
+            self.metrics.socket_writes += 1
+
+
+    # Per-client outbound queue depths and drop counters, served as labelled series on the metrics endpoint
+    def queue_stats(self):
+        return {client.client_id: {"messages": len(queue), "bytes": queue.bytes, "high_water": queue.high_water,
+                                   "enqueued": queue.enqueued, "dropped": queue.dropped, "conflated": queue.conflated}
+                for client, queue in ((client, client.queue) for client in self.clients.sessions())
+                if client.client_id not in self.peers}
+
+
+    # Connection rate limit: over it a CONNECT is answered with CONNACK 0x9F (Connection rate exceeded),
+    # before any state is set up for the client, and the caller closes the socket
+    def __admit(self, client_socket: socket.socket):
+        if(self.admission is None or self.admission.take()):
+            return True
+        self.metrics.connections_rejected += 1
+        try:
+            client_socket.sendall(RATE_EXCEEDED_PACKET)
+        except OSError:
+            pass                                                # Includes a full non-blocking socket
+        return False
+
+
+    # Add a new client to the broker state, rejecting duplicate client ids
+    def __register_client(self, client_id: str, client_socket: socket.socket, conn: Connection | None = None):
+        client = ClientSession(client_id, client_socket, OutboundQueue(*self.queue_limits), conn)
+        if(self.clients.add(client)):
+            if(self.engine == "threaded"):
+                threading.Thread(target=self.__drain_queue, args=(client_socket, client.queue), daemon=True).start()
+            return True
+
+        # Duplicate connect: send error CONNACK and disconnect
+        print(f'Repeat connect for {client_id}')
+        try:
+            client_socket.sendall(REJECTED_PACKET)              # 0x82: Identifier Rejected
+        except BlockingIOError:
+            pass
+        if(self.engine == "threaded"):
             client_socket.close()
 
-            # Clean up any existing state for this client
-            self.client_sockets.pop(client_id)
-            self.client_locks.pop(client_id)
-            for topic in self.client_subs[client_id]:
-                self.topics[topic].discard(client_id)
-            self.client_subs[client_id].discard(client_id)
+        # Clean up any existing state for this client
+        self.__drop_client(client_id)
+        return False
+
+
+    # Remove all state kept for a client and close its socket. Unregistering first makes whichever thread
+    # gets here first the only one tearing the client down; the cost is one pass over its subscriptions.
+    def __drop_client(self, client_id: str, client: ClientSession | None = None):
+        client = self.clients.remove(client_id, client)
+        if(client is None): return                              # Already dropped
+        if(client.conn is not None):
+            if(client.conn in self.unflushed):
+                self.__flush_connection(client.conn, client)    # Last packets, e.g. a DISCONNECT with its reason code
+            self.__close_connection(client.conn)
+        else:
+            try:
+                client.sock.shutdown(socket.SHUT_RDWR)          # Wakes a reader thread blocked in recv
+            except OSError:
+                pass
+            client.sock.close()
+        client.queue.close()
+        if(client.stream is not None):
+            # Copies cut off mid-packet can never be completed, the subscribers getting one go too
+            stream, client.stream = client.stream, None
+            for target, _ in stream.targets:
+                if(not target.queue.closed):
+                    print(f"Streamed publish from {client_id} cut off, disconnecting {target.client_id}")
+                    self.__drop_client(target.client_id, target)
+        self.__park_held(client)
+        self.inflight.drop_client(client_id)
+        self.keepalive.cancel(client_id)
+        topic_filters = client.subs
+        if(self.sessions.detach(client_id, time.time())):
+            return                                              # Persistent session: keep subscribing while offline
+        with self.topics_lock:
+            for topic in topic_filters:
+                self.__remove_subscription(topic, client_id)
+        for topic in topic_filters:
+            self.__remove_interest(topic)                       # Outside the lock, may write to sibling workers
+
+
+    # Add a subscription to the trie (topics_lock held); a shared subscription joins its group instead
+    # and the group is in the trie once, keyed by its "$share/<group>/<filter>" name
+    def __insert_subscription(self, topic_filter: str, client_id: str, sub_options: int):
+        group, inner = split_share(topic_filter)
+        if(group is None):
+            self.topics.insert(topic_filter, client_id, sub_options)
+        elif(self.shared.join(topic_filter, client_id, sub_options)):
+            self.topics.insert(inner, topic_filter)
+
+    def __remove_subscription(self, topic_filter: str, client_id: str):
+        group, inner = split_share(topic_filter)
+        if(group is None):
+            self.topics.remove(topic_filter, client_id)
+        elif(self.shared.leave(topic_filter, client_id)):
+            self.topics.remove(inner, topic_filter)
+
+
+    # Packets a client has yet to work through, used to pick the least loaded shared subscription member
+    def __backlog(self, client_id: str):
+        client = self.clients.get(client_id)
+        if(client is None): return self.inflight.count(client_id)
+        return len(client.queue) + self.inflight.count(client_id) + len(client.held or ())
+
+
+    # Start or resume the client's session according to the CONNECT Clean Start flag, returns Session Present
+    def __open_session(self, client: ClientSession, connect_data: ConnectVariableHeader):
+        client_id = client.client_id
+        if(connect_data.flags & 0x02):
+            # Clean Start: discard any previous session along with its subscriptions
+            session = self.sessions.end(client_id)
+            if(session is not None):
+                self.__remove_session_subscriptions(session)
+            return 0
+        session, present = self.sessions.open(client_id, connect_data.properties.get(SESSION_EXPIRY_INTERVAL))
+        client.subs = set(session.subs)                         # Already in the trie
+        return int(present)
+
+
+    # Remove the subscriptions a discarded persistent session kept in the trie
+    def __remove_session_subscriptions(self, session: Session):
+        with self.topics_lock:
+            for topic_filter in session.subs:
+                self.__remove_subscription(topic_filter, session.client_id)
+        for topic_filter in session.subs:
+            self.__remove_interest(topic_filter)
+
+
+    # Send the QoS 1 messages a resumed session holds, DUP set on those sent before.
+    # They count against the client's Receive Maximum like any other delivery.
+    def __resume_session(self, client: ClientSession):
+        client_id = client.client_id
+        now = time.time()
+        for packet_id, frame, sent, expires_at in self.sessions.resume(client_id):
+            if(sent): frame = bytes([frame[0] | 0x08]) + frame[1:]
+            stored = OutgoingPublish(frame)
+            stored.expires_at = expires_at
+            if(expires_at is not None):
+                stored = stored.restamped(now)                  # Only the time left of the Message Expiry Interval
+            self.__deliver_qos1(client, stored, 0b0001, False, packet_id)
+
+
+    # Handle a client's CONNECT request
+    def __handle_connect(self, conn_packet: MQTTPacket, client_socket: socket.socket, reader: FrameReader):
+        client_id = conn_packet.variable_data.client_id
+        if(not self.__admit(client_socket)):
+            client_socket.close()
             return
-        
-        # Send successful CONNACK
-        connack_fixed_header = FixedHeader(CONNACK)
-        connack_var_header = ConnackVariableHeader(0, 0x00)         # 0x00: Connection Accepted
-        connack_packet = MQTTPacket(connack_fixed_header, connack_var_header)
-        client_socket.send(connack_packet.encode())
+
+        # Reject duplicate client ids
+        if(not self.__register_client(client_id, client_socket)):
+            return
+        self.__accept_client(client_id, conn_packet.variable_data)
+
+        # Start listening for incoming packets from this client; one thread routes its PUBLISHes in arrival order
+        routes = Queue()
+        threading.Thread(target=self.__route_publishes, args=(routes, client_id), daemon=True).start()
+        try:
+            self.__recv_packets(client_socket, reader, client_id, routes)
+        finally:
+            routes.put(None)
+
+
+    # Set up a registered client: session, topic aliases, CONNACK, queued session messages and keep-alive
+    def __accept_client(self, client_id: str, connect_data: ConnectVariableHeader):
+        client = self.clients.get(client_id)
+        if(client is None): return                              # Dropped meanwhile
+        self.metrics.connections += 1
+        session_present = self.__open_session(client, connect_data)
+
+        # Topic aliases the client accepts from us; we accept topic_alias_maximum from it
+        client.alias_maximum = connect_data.properties.get(TOPIC_ALIAS_MAXIMUM, 0)
+
+        # Receive Maximum: how many QoS 1 PUBLISHes each side may leave unacknowledged (absent means 65535)
+        client.send_window = connect_data.properties.get(RECEIVE_MAXIMUM) or None
+        if(self.engine == "threaded"):
+            client.receive_window = threading.Semaphore(self.receive_maximum)
+
+        # Send successful CONNACK, flagging a resumed session
+        self.__send(client_id, self.connack_packets[session_present])
         print(f'Connected to {client_id}')
+        self.__resume_session(client)
+        self.__start_keepalive(client_id, connect_data.keep_alive)
+
+
+    # Start the client's keep-alive timer (0 disables keep-alive)
+    def __start_keepalive(self, client_id: str, keep_alive: int):
+        if(keep_alive):
+            self.keepalive.schedule(client_id, keep_alive*1.5, time.time())
+
+
+    # Loop to receive packets from client; the keep-alive timer closes the socket of an idle client.
+    # Every complete packet of a read is handled before reading again, and its PUBLISHes go to the routing thread.
+    def __recv_packets(self, client_socket, reader: FrameReader, client_id: str, routes: Queue):
+        received_at = time.perf_counter()                   # Packets that came in with the CONNECT
+        while True:
+            batch = []                                      # PUBLISHes waiting to be routed together
+            try:
+                for encoded_recv_packet in reader.frames():
+                    packet_type = encoded_recv_packet[0] >> 4
+
+                    if(reader.payload_left):
+                        # Head of a PUBLISH too large to buffer: forwarded here as it arrives, once earlier
+                        # PUBLISHes have been routed
+                        self.__route_batch(routes, batch, received_at)
+                        batch = []
+                        routes.join()
+                        if(not self.__open_stream(client_id, encoded_recv_packet, reader.payload_left)):
+                            return                                  # Client dropped
+                        continue
+
+                    if(packet_type == PUBLISH):
+                        # Decoded from a copy: the routing thread outlives the reader's buffer
+                        publish = self.__take_publish(client_id, bytes(encoded_recv_packet))
+                        if(publish is None):
+                            self.__route_batch(routes, batch, received_at)
+                            return                                  # Client dropped
+                        batch.append(publish)
+                        if(len(batch) >= self.publish_batch):
+                            self.__route_batch(routes, batch, received_at)
+                            batch = []
+                        continue
+                    if(packet_type not in (PUBACK, PINGREQ)):
+                        # A SUBSCRIBE or DISCONNECT takes effect once earlier PUBLISHes, including those of
+                        # previous reads still queued, have been routed
+                        self.__route_batch(routes, batch, received_at)
+                        batch = []
+                        routes.join()
+                    recv_packet = MQTTPacket.decode(encoded_recv_packet)
+
+                    # Handle packet types
+                    if(packet_type == CONNECT):
+                        # Invalid repeat connect
+                        print(f"Repeat connect from {client_id}")
+                        client_socket.sendall(REJECTED_PACKET)
+                        self.__drop_client(client_id)
+                        return
+
+                    elif(packet_type == PUBACK):
+                        self.__handle_ack(recv_packet, client_id)
+
+                    elif(packet_type == SUBSCRIBE):
+                        self.__handle_subscribe(recv_packet, client_id)
+
+                    elif(packet_type == PINGREQ):
+                        self.__send(client_id, PINGRESP_PACKET)
+
+                    elif(packet_type == DISCONNECT):
+                        self.__drop_client(client_id)
+                        return
+            except ValueError:
+                self.__route_batch(routes, batch, received_at)
+                self.__drop_client(client_id)                   # Malformed packet
+                return
+            self.__route_batch(routes, batch, received_at)
+
+            # The received part of a streamed payload; once it is complete, packets after it may be buffered
+            if(reader.payload_left):
+                client = self.clients.get(client_id)
+                if(client is None): return                      # Dropped meanwhile
+                self.__stream_payload(reader, client)
+                if(not reader.payload_left): continue
+
+            try:
+                received = reader.recv_from(client_socket)
+            except OSError:
+                return                                          # Socket closed by __drop_client
+            if(not received):
+                self.__drop_client(client_id)                   # Peer closed the connection
+                return
+            received_at = time.perf_counter()
+            self.keepalive.touch(client_id, time.time())
+            self.metrics.bytes_received += received
+            self.metrics.socket_reads += 1
+
 
-        # Start listening for incoming packets from this client
-        self.__recv_packets(client_socket, conn_packet.variable_data.keep_alive, client_id)
+    # Threaded engine: decode an incoming PUBLISH (copied out of the reader's buffer) and check it in arrival order
+    # (topic alias, Receive Maximum) for the thread routing it. Returns None once the client has been dropped.
+    def __take_publish(self, client_id: str, frame: bytes):
+        recv_packet = MQTTPacket.decode(frame)
+        recv_packet.variable_data.topic_name                    # Decoded here, a malformed one drops the client
+        frame = self.__resolve_topic_alias(client_id, recv_packet, frame)
+        if(frame is None):
+            return None
+        # Each QoS 1 PUBLISH holds a slot of our Receive Maximum until its PUBACK is sent
+        client = self.clients.get(client_id)
+        if(client is None):
+            return None                                         # Dropped meanwhile (keep-alive timeout)
+        if(recv_packet.fixed_header.flags & 0b0110 == 0b0010
+           and not client.receive_window.acquire(blocking=False)):
+            print(f"Receive Maximum exceeded by {client_id}")
+            self.__send(client_id, RECEIVE_EXCEEDED_PACKET)
+            self.__drop_client(client_id)                       # 0x93: Receive Maximum exceeded
+            return None
+        return recv_packet, frame
 
 
-    # Loop to receive packets from client
-    def __recv_packets(self, client_socket, keep_alive: int, client_id: str):
+    # Threaded engine: hand a batch of PUBLISHes to the client's routing thread, so the reader goes on reading
+    def __route_batch(self, routes: Queue, batch: list, received_at: float):
+        if(batch): routes.put((batch, received_at))
 
-        last_packet_time = time.time()
 
+    # Threaded engine: route a client's PUBLISH batches one after the other until the reader puts None,
+    # so subscribers get them in the order they were published
+    def __route_publishes(self, routes: Queue, client_id: str):
         while True:
-            data = recv_fixed_header(client_socket)
-            
-            # Check for keep_alive timeout
-            if(time.time()-last_packet_time > keep_alive*1.5):
-                client_socket.close()
-                self.client_sockets.pop(client_id)
-                self.client_locks.pop(client_id)
-                for topic in self.client_subs[client_id]:
-                    self.topics[topic].discard(client_id)
-                self.client_subs[client_id].discard(client_id)
-                print(f"Timeout {client_id}")
+            item = routes.get()
+            if(item is None): return
+            try:
+                self.__handle_publishes(item[0], client_id, item[1])
+            except Exception as e:
+                print(f"Routing PUBLISHes from {client_id} failed: {e}")
+            routes.task_done()
+
+
+    # Replace a Topic Alias in an incoming PUBLISH by its topic name, so what is forwarded stands on its own.
+    # Returns the frame to forward, or None after disconnecting a client that used an unknown alias.
+    def __resolve_topic_alias(self, client_id: str, recv_packet: MQTTPacket, encoded_packet: bytes | memoryview):
+        publish = recv_packet.variable_data
+        alias = publish.properties.pop(TOPIC_ALIAS, None)
+        if(alias is None): return encoded_packet
+        client = self.clients.get(client_id)
+        if(client is None): return None                             # Client already gone
+        aliases = client.inbound_aliases
+        if(0 < alias <= self.topic_alias_maximum and publish.topic_name):
+            aliases[alias] = publish.topic_name                     # Define (or redefine) the alias
+        elif(alias in aliases and not publish.topic_name):
+            publish.topic_name = aliases[alias]
+        else:
+            print(f"Invalid topic alias {alias} from {client_id}")
+            self.__send(client_id, ALIAS_INVALID_PACKET)
+            self.__drop_client(client_id, client)                   # 0x94: Topic Alias invalid
+            return None
+        return recv_packet.encode()
+
+
+    # Topic alias for a delivery to the client as (alias, first use), or None to send the topic name.
+    # Aliases are handed out until the client's Topic Alias Maximum is reached (alias_lock held).
+    def __topic_alias(self, client: ClientSession, topic_name: str):
+        aliases = client.outbound_aliases
+        alias = aliases.get(topic_name)
+        if(alias is not None): return alias, False
+        if(len(aliases) >= client.alias_maximum): return None
+        alias = aliases[topic_name] = len(aliases) + 1
+        return alias, True
+
+
+    # Handles an incoming PUBLISH message and forwards it to subscribers
+    def __handle_publish(self, recv_packet: MQTTPacket, encoded_packet: bytes | memoryview, src_client_id: str,
+                         received_at: float = 0.0, from_peer: bool = False, count: bool = True):
+        self.__handle_publishes([(recv_packet, encoded_packet)], src_client_id, received_at, from_peer, count)
+
+
+    # Handles a batch of (packet, frame) PUBLISHes from one sender, in order: PUBACKs for the whole batch,
+    # one pass under the trie lock matching each distinct topic once, then delivery message by message
+    def __handle_publishes(self, batch: list, src_client_id: str, received_at: float = 0.0, from_peer: bool = False,
+                           count: bool = True):
+
+        for recv_packet, _ in batch:
+            if self.verbosity > 0: print("Received publish packet from", src_client_id)
+            if self.verbosity > 0: print(recv_packet.encode().hex(' '))
+            if self.verbosity > 0: print(bytes(recv_packet.variable_data.payload))
+
+            # If QoS 1, send PUBACK to publisher (a sibling worker has already acknowledged it). The Receive
+            # Maximum slot is freed first: the publisher may send its next PUBLISH as soon as it sees the PUBACK
+            if(recv_packet.fixed_header.flags & 0b0110 == 0b0010 and not from_peer):
+                if self.verbosity > 0: print(recv_packet.variable_data.packet_id)
+                client = self.clients.get(src_client_id)
+                if(client is not None and client.receive_window is not None): client.receive_window.release()
+                self.__send(src_client_id, puback_packet(recv_packet.variable_data.packet_id))
+        if(count): self.metrics.messages_received += len(batch)    # $SYS updates are not counted
+
+        # Find every subscriber with a matching filter in one walk of the trie per topic
+        # and hand each matching shared subscription to one member of its group
+        routes = []
+        with self.topics_lock:
+            matches = dict()                                    # Topic name -> subscribers, for repeated topics
+            for recv_packet, _ in batch:
+                topic_name = recv_packet.variable_data.topic_name
+                subscribers = matches.get(topic_name)
+                if(subscribers is None):
+                    subscribers = matches[topic_name] = self.topics.match(topic_name)
+                subscribers = dict(subscribers)                 # Trimmed below, the cached match stays whole
+                routes.append((subscribers, self.__pick_shared(subscribers)))
+
+        for (recv_packet, encoded_packet), (subscribers, picks) in zip(batch, routes):
+            self.__route_publish(recv_packet, encoded_packet, subscribers, picks, src_client_id, received_at,
+                                 from_peer, count)
+
+
+    # Hand each shared subscription in a copy of the trie's match to one member of its group (topics_lock held).
+    # The shared subscriptions are removed from subscribers, the members picked are returned. With sibling
+    # workers, only the groups this worker serves are picked from.
+    def __pick_shared(self, subscribers: dict):
+        picks = []
+        if(self.shared.groups):
+            for share_name in [key for key in subscribers if key.startswith(SHARE_PREFIX)]:
+                del subscribers[share_name]
+                if(self.peers and self.__share_owner(share_name) != self.worker_id): continue
+                member = self.shared.pick(share_name, self.clients.__contains__, self.__backlog)
+                if(member is not None): picks.append(member)
+        return picks
+
+
+    # Forward one PUBLISH to its matching subscribers, sibling workers and the retained store
+    def __route_publish(self, recv_packet: MQTTPacket, encoded_packet: bytes | memoryview, subscribers: dict,
+                        picks: list, src_client_id: str, received_at: float, from_peer: bool, count: bool):
+        subscribers.pop(src_client_id, None)
+        retain = recv_packet.fixed_header.flags & 0b0001
+        if(count):
+            self.metrics.fanout.observe(len(subscribers) + len(picks))
+            self.metrics.messages_sent += len(subscribers) + len(picks)
+
+        # Workers with matching subscribers or serving a matching shared subscription get the frame as received;
+        # they only deliver it locally. Retained publishes go to every worker so each one holds the whole
+        # retained store.
+        peers = ()
+        if(self.peers and not from_peer):
+            peers = list(self.peers) if retain else self.__peer_targets(recv_packet.variable_data.topic_name)
+        if(not subscribers and not picks and not peers and not retain): return
+
+        # Wire buffers shared by every subscriber, no per-subscriber encode
+        outgoing = OutgoingPublish(encoded_packet)
+        expiry = recv_packet.variable_data.properties.get(MESSAGE_EXPIRY_INTERVAL)
+        if(expiry is not None):
+            outgoing.expires_at = time.time() + expiry          # Copies still queued after this are discarded
+        for peer_id in peers:
+            self.__send(peer_id, (outgoing.frame,), droppable=True)
+        if(retain):
+            if(outgoing.empty_payload()):
+                self.retained.delete(outgoing.topic_name)
+            else:
+                self.retained.set(outgoing.topic_name, outgoing, len(outgoing.frame))
+
+        # Forward to all subscribers at min(publish QoS, granted QoS), RETAIN only for Retain As Published
+        for client_id, sub_options in [*subscribers.items(), *picks]:
+            self.__deliver(client_id, outgoing, sub_options, bool(sub_options & 0b1000))
+        if(count and (subscribers or picks) and received_at):
+            self.metrics.latency.observe(time.perf_counter() - received_at)
+
+
+    # Start forwarding a PUBLISH whose payload is still arriving (see stream_threshold). Copies go at QoS 0 to
+    # the subscribers connected now. The payload is never held whole, so a streamed message is not retained,
+    # not kept for offline sessions, not resent and not forwarded to sibling workers. The publisher's PUBACK
+    # follows the last chunk. Returns False once the client has been dropped.
+    def __open_stream(self, client_id: str, head: memoryview, payload_len: int):
+        recv_packet = MQTTPacket.decode_head(head)
+        recv_packet.variable_data.topic_name                    # Decoded here, a malformed one drops the client
+        if(self.__resolve_topic_alias(client_id, recv_packet, head) is None):
+            return False
+        client = self.clients.get(client_id)
+        if(client is None):
+            return False                                        # Dropped meanwhile (keep-alive timeout)
+        if(recv_packet.fixed_header.flags & 0b0110 == 0b0010 and client.receive_window is not None
+           and not client.receive_window.acquire(blocking=False)):
+            print(f"Receive Maximum exceeded by {client_id}")
+            self.__send(client_id, RECEIVE_EXCEEDED_PACKET)
+            self.__drop_client(client_id, client)               # 0x93: Receive Maximum exceeded
+            return False
+        if self.verbosity > 0: print(f"Streaming publish from {client_id}, {payload_len} byte payload")
+
+        stream = PublishStream(recv_packet, payload_len)
+        with self.topics_lock:
+            subscribers = dict(self.topics.match(stream.topic_name))
+            picks = self.__pick_shared(subscribers)
+        subscribers.pop(client_id, None)
+        for target_id, sub_options in [*subscribers.items(), *picks]:
+            target = self.clients.get(target_id)
+            if(target is None): continue                        # Offline, nothing is kept for it
+            head = stream.head(bool(sub_options & 0b1000))
+            entry = target.queue.open_stream(head, len(head) + payload_len)
+            if(entry is not None): stream.targets.append((target, entry))
+        client.stream = stream
+        self.metrics.messages_received += 1
+        self.metrics.publishes_streamed += 1
+        self.metrics.fanout.observe(len(stream.targets))
+        self.metrics.messages_sent += len(stream.targets)
+        return True
+
+
+    # Forward the received part of a streamed payload, copied once out of the read buffer and shared by every
+    # subscriber. A subscriber more than its queue limit behind holds the publisher back: the threaded engine
+    # waits for its writer thread, the selector engine stops reading from the publisher (see __resume_streams).
+    # One still behind after STREAM_STALL seconds is disconnected, its copy could never be completed.
+    def __stream_payload(self, reader: FrameReader, client: ClientSession):
+        stream = client.stream
+        for chunk in reader.payload():
+            if(stream is None): continue                        # Publisher dropped, the rest is skipped
+            chunk = bytes(chunk)
+            for target, entry in stream.targets:
+                target.queue.feed_stream(entry, chunk)
+                if(target.conn is not None and not target.conn.writing and not target.conn.closed):
+                    self.__flush_connection(target.conn, target)
+            if(client.conn is None):
+                for target in stream.slow():
+                    if(not target.queue.wait_below(target.queue.max_bytes, STREAM_STALL)):
+                        print(f"{target.client_id} fell behind a streamed publish, disconnecting")
+                        self.__drop_client(target.client_id, target)
+        if(stream is None or client.stream is not stream): return
+        if(not reader.payload_left):
+            # Forwarded whole: acknowledged like any other publish (see __handle_publishes)
+            client.stream = None
+            if(stream.qos == 1):
+                if(client.receive_window is not None): client.receive_window.release()
+                self.__send(client.client_id, puback_packet(stream.packet_id))
+        elif(client.conn is not None and stream.slow()):
+            client.conn.paused = True                           # Until __resume_streams registers it again
+            self.selector.unregister(client.conn.sock)
+            self.stalled[client.conn] = time.time()
+
+
+    # Selector engine: read again from publishers paused by a slow subscriber once all of their subscribers are
+    # back under their queue limit, disconnecting those still over it after STREAM_STALL seconds
+    def __resume_streams(self, now: float):
+        for conn, since in list(self.stalled.items()):
+            client = self.clients.get(conn.client_id)
+            stream = client.stream if client is not None else None
+            slow = stream.slow() if stream is not None else ()
+            if(slow and now < since + STREAM_STALL): continue
+            for target in slow:
+                print(f"{target.client_id} fell behind a streamed publish, disconnecting")
+                self.__drop_client(target.client_id, target)
+            self.stalled.pop(conn, None)
+            if(not conn.closed):
+                conn.paused = False
+                events = selectors.EVENT_READ | selectors.EVENT_WRITE if conn.writing else selectors.EVENT_READ
+                self.selector.register(conn.sock, events, conn)
+
+
+    # Queue one PUBLISH for a subscriber at min(publish QoS, granted QoS)
+    def __deliver(self, client_id: str, outgoing: OutgoingPublish, sub_options: int, retain: bool):
+        client = self.clients.get(client_id)
+        if(min(outgoing.qos, sub_options & 0b11) == 0):
+            if(client is None): return                              # Offline, QoS 0 is not kept
+            if(client.alias_maximum and not sub_options & SUB_CONFLATE):
+                self.__deliver_aliased(client, outgoing, None, retain)
                 return
-            
-            if(data):
-                last_packet_time = time.time()
-                encoded_recv_packet,packet_len = data
-                encoded_recv_packet += client_socket.recv(packet_len)
-                recv_packet = MQTTPacket.decode(encoded_recv_packet)
-
-                # Handle packet types
-                if(recv_packet.fixed_header.packet_type == CONNECT):
-                    # Invalid repeat connect
-                    print(f"Repeat connect from {client_id}")
-                    connack_fixed_header = FixedHeader(CONNACK)
-                    connack_var_header = ConnackVariableHeader(0, 0x82)
-                    connack_packet = MQTTPacket(connack_fixed_header, connack_var_header)
-                    client_socket.sendall(connack_packet.encode())
-                    client_socket.close()
-                    self.client_sockets.pop(client_id)
-                    self.client_locks.pop(client_id)
-                    for topic in self.client_subs[client_id]:
-                        self.topics[topic].discard(client_id)
-                    self.client_subs[client_id].discard(client_id)
-                    return
-
-                elif(recv_packet.fixed_header.packet_type == PUBLISH):
-                    publishthread = threading.Thread(target = self.__handle_publish, args=(recv_packet, client_socket, client_id))
-                    publishthread.start()
-
-                elif(recv_packet.fixed_header.packet_type == PUBACK):
-                    self.__handle_ack(recv_packet, client_id)
-
-                elif(recv_packet.fixed_header.packet_type == SUBSCRIBE):
-                    self.__handle_subscribe(recv_packet, client_socket, client_id)
-
-                elif(recv_packet.fixed_header.packet_type == DISCONNECT):
-                    client_socket.close()
-                    self.client_sockets.pop(client_id)
-                    self.client_locks.pop(client_id)
-                    for topic in self.client_subs[client_id]:
-                        self.topics[topic].discard(client_id)
-                    self.client_subs[client_id].discard(client_id)
-                    return
-    
+            conflate_key = outgoing.topic_name if sub_options & SUB_CONFLATE else None
+            self.__send(client_id, outgoing.qos0(retain), droppable=True, conflate_key=conflate_key,
+                        expires_at=outgoing.expires_at)
+            return
+
+        # Offline client with a persistent session: keep the message until it reconnects
+        if(client is None):
+            packet_id = self.sessions.next_packet_id(client_id)
+            if(packet_id is not None):
+                self.sessions.add_message(client_id, packet_id, b"".join(outgoing.qos1(packet_id, retain)), False,
+                                          outgoing.expires_at)
+            return
+        self.__deliver_qos1(client, outgoing, sub_options, retain)
+
+
+    # Send a QoS 1 copy now if the client's Receive Maximum has a free slot, otherwise hold it until a PUBACK
+    # frees one. Held copies go out in order, nothing overtakes them. packet_id is given for a message
+    # already stored in the client's session, outgoing.frame is then sent as it is.
+    def __deliver_qos1(self, client: ClientSession, outgoing: OutgoingPublish, sub_options: int, retain: bool,
+                       packet_id: int | None = None):
+        if(client.send_window is None):
+            self.__send_qos1(client, outgoing, sub_options, retain, packet_id)
+            return
+        with self.window_lock:
+            limit = client.send_window                              # None once the client has been dropped
+            if(limit is None or (client.held is None and self.inflight.count(client.client_id) < limit)):
+                self.__send_qos1(client, outgoing, sub_options, retain, packet_id)
+                return
+            if(client.held is None):
+                client.held = deque()
+            elif(len(client.held) >= self.queue_limits[0]):
+                self.__discard_held(client, client.held.popleft())     # Same bound as the outbound queue
+                client.queue.dropped += 1
+            client.held.append((outgoing, sub_options, retain, packet_id))
+
+
+    # Send held QoS 1 copies while the client's Receive Maximum has free slots
+    def __release_held(self, client: ClientSession):
+        with self.window_lock:
+            held = client.held
+            now = time.time()
+            while held and self.inflight.count(client.client_id) < client.send_window:
+                outgoing, sub_options, retain, packet_id = entry = held.popleft()
+                if(outgoing.expires_at is not None):
+                    if(outgoing.expires_at <= now):
+                        self.__discard_held(client, entry)
+                        client.queue.expired += 1
+                        continue
+                    outgoing = outgoing.restamped(now)              # Only the time left after waiting here
+                self.__send_qos1(client, outgoing, sub_options, retain, packet_id)
+            if(not held):
+                client.held = None
+
+
+    # A held copy that will never be sent; a stored session message is removed from the session too
+    def __discard_held(self, client: ClientSession, entry: tuple):
+        packet_id = entry[3]
+        if(packet_id is not None):
+            self.sessions.ack(client.client_id, packet_id)
+
+
+    # When a client goes away its held copies join its persistent session, or are dropped with it
+    def __park_held(self, client: ClientSession):
+        with self.window_lock:
+            held, client.held, client.send_window = client.held or (), None, None
+        if(self.sessions.get(client.client_id) is None): return
+        for outgoing, sub_options, retain, packet_id in held:
+            if(packet_id is None):                                  # Messages from the session are still in it
+                self.__deliver(client.client_id, outgoing, sub_options, retain)
 
-    # Handles incoming PUBLISH messages and forwards to subscribers
-    def __handle_publish(self, recv_packet: MQTTPacket, client_socket: socket.socket, src_client_id: str):
-
-        encoded_recv_packet = recv_packet.encode()
-
-        if self.verbosity > 0: print("Received publish packet from", src_client_id)
-        if self.verbosity > 0: print(encoded_recv_packet.hex(' '))
-        if self.verbosity > 0: print(recv_packet.variable_data.payload)
-
-        QoS = (recv_packet.fixed_header.flags & 0b0110) >> 1         # Extract QoS
-
-        # If QoS 1, send PUBACK to publisher
-        if(QoS == 1):
-            print(recv_packet.variable_data.packet_id)
-            puback_fixed_header = FixedHeader(PUBACK)
-            puback_variable_header = PubackVariableHeader(recv_packet.variable_data.packet_id, 0x00)
-            puback_packet = MQTTPacket(puback_fixed_header, puback_variable_header)
-            client_socket.sendall(puback_packet.encode())
-
-        # Generate list of all topic filters
-        topic_filter = recv_packet.variable_data.topic_name.split('/')
-        topic_names = ["/".join(topic_filter[:i])+"/#" for i in range(1,len(topic_filter))]
-        topic_names.extend([recv_packet.variable_data.topic_name, "#"])
-
-        packet_id = recv_packet.variable_data.packet_id
-
-        # Forward to all subscribers
-        for topic_name in topic_names:
-            if(self.topics.get(topic_name)):
-                for client_id in self.topics[topic_name]:
-                    if(client_id != src_client_id):
-                        with self.client_locks[client_id]:    # Thread-safe send
-                            self.client_sockets[client_id].sendall(encoded_recv_packet)
-                            if(QoS == 1): 
-                                self.waiting_clients.setdefault(packet_id, set()).add(client_id)
-
-        # Wait for PUBACKs from all clients
-        if(QoS == 1):
-            while(len(self.waiting_clients[packet_id])):
-                pass
+
+    # QoS 1: every subscriber gets its own broker-assigned packet id
+    def __send_qos1(self, client: ClientSession, outgoing: OutgoingPublish, sub_options: int, retain: bool,
+                    packet_id: int | None):
+        client_id = client.client_id
+        if(packet_id is not None):
+            packet = (outgoing.frame,)
+            message = self.inflight.add(client_id, packet_id, packet, self.__on_delivered, outgoing.expires_at)
+            self.__send(client_id, packet, droppable=True, expires_at=outgoing.expires_at,
+                        on_dequeued=partial(self.inflight.sent, message))
+            return
+        session = self.sessions.get(client_id)
+        if(session is not None):
+            # The session holds every id in flight and those of held session messages not sent yet
+            packet_id = self.sessions.next_packet_id(client_id)
+        else:
+            packet_id = self.inflight.next_packet_id(client_id)
+        if(packet_id is None): return                               # No free packet id, drop for this client
+        packet = outgoing.qos1(packet_id, retain)
+        if(session is not None):
+            # Stored without an alias: the next connection starts with no aliases defined
+            self.sessions.add_message(client_id, packet_id, b"".join(packet), True, outgoing.expires_at)
+        if(client.alias_maximum and not sub_options & SUB_CONFLATE):
+            self.__deliver_aliased(client, outgoing, packet_id, retain)
+            return
+        message = self.inflight.add(client_id, packet_id, packet, self.__on_delivered, outgoing.expires_at)
+        self.__send(client_id, packet, droppable=True, expires_at=outgoing.expires_at,
+                    on_dequeued=partial(self.inflight.sent, message))
+
+
+    # Queue a PUBLISH using a topic alias. The copy that defines the alias is never dropped by the queue
+    # policy, otherwise the copies after it would name an alias the client never saw.
+    def __deliver_aliased(self, client: ClientSession, outgoing: OutgoingPublish, packet_id: int | None, retain: bool):
+        with self.alias_lock:
+            alias = self.__topic_alias(client, outgoing.topic_name)
+            if(alias is None):
+                packet = outgoing.qos0(retain) if packet_id is None else outgoing.qos1(packet_id, retain)
+                droppable = True
+            else:
+                packet = outgoing.aliased(alias[0], alias[1], packet_id, retain)
+                droppable = not alias[1]
+            on_dequeued = None
+            if(packet_id is not None):
+                message = self.inflight.add(client.client_id, packet_id, packet, self.__on_delivered,
+                                            outgoing.expires_at)
+                on_dequeued = partial(self.inflight.sent, message)
+            # The copy defining an alias is kept even once expired, later copies rely on it
+            self.__send(client.client_id, packet, droppable=droppable,
+                        expires_at=outgoing.expires_at if droppable else None, on_dequeued=on_dequeued)
+
+
+    # Completion callback for QoS 1 messages sent to subscribers
+    def __on_delivered(self, client_id: str, packet_id: int, delivered: bool):
+        if self.verbosity > 0: print(f"Packet {packet_id} to {client_id}", "acknowledged" if delivered else "abandoned")
+        client = self.clients.get(client_id)
+        if(client is not None and client.held):
+            self.__release_held(client)                             # A slot of its Receive Maximum is free
 
     
     # Handle PUBACK from subscriber
     def __handle_ack(self, recv_packet: MQTTPacket, src_client_id: str):
-        packet_id = recv_packet.variable_data.packet_id
-        if(packet_id in self.waiting_clients):
-            self.waiting_clients[packet_id].remove(src_client_id)
-        if(len(self.waiting_clients[packet_id]) == 0):
-            self.waiting_clients.pop(packet_id)
+        self.inflight.ack(src_client_id, recv_packet.variable_data.packet_id)
+        if(self.sessions.get(src_client_id) is not None):
+            self.sessions.ack(src_client_id, recv_packet.variable_data.packet_id)
         
 
     # Handle SUBSCRIBE requests
-    def __handle_subscribe(self, recv_packet: MQTTPacket, client_socket: socket.socket, src_client_id: str):
+    def __handle_subscribe(self, recv_packet: MQTTPacket, src_client_id: str):
         if self.verbosity > 0: print("Received subscribe packet from", src_client_id)
+        client = self.clients.get(src_client_id)
+        if(client is None): return                      # Dropped meanwhile
+
+        reason_codes = []                               # One per filter: the granted QoS, or why it was refused
+        new_filters = []
+        replays = []                                    # (filter, options) that get the matching retained messages
+        with self.topics_lock:
+            for topic_filter, sub_options in recv_packet.variable_data.topics:
+                # Conflated subscriptions are delivered at QoS 0 so replaced messages never need a PUBACK
+                if(topic_filter.startswith(CONFLATE_PREFIX)):
+                    topic_filter = topic_filter[len(CONFLATE_PREFIX):]
+                    sub_options = sub_options & ~0b11 | SUB_CONFLATE
+                try:
+                    group, inner = split_share(topic_filter)    # Shared subscription: "$share/<group>/<filter>"
+                except ValueError:
+                    group, inner = None, ""                     # Malformed share name
+                if(not valid_filter(inner)):
+                    reason_codes.append(0x8F)           # 0x8F: Topic Filter invalid
+                    continue
+                new = topic_filter not in client.subs
+                if(new):
+                    client.subs.add(topic_filter)
+                    new_filters.append(topic_filter)
+                self.__insert_subscription(topic_filter, src_client_id, sub_options)
+                self.sessions.subscribe(src_client_id, topic_filter, sub_options)
+                reason_codes.append(min(sub_options & 0b11, 1)) # QoS 2 is delivered at QoS 1
 
-        for topic in recv_packet.variable_data.topics:
-            self.client_subs[src_client_id].add(topic[0])
-            if(topic[0] not in self.topics):
-                self.topics[topic[0]] = set()
-            self.topics[topic[0]].add(src_client_id)    
+                # Retain Handling: 0 always send retained messages, 1 only for a new subscription, 2 never.
+                # Shared subscriptions never get retained messages.
+                retain_handling = (sub_options >> 4) & 0b11
+                if(group is None and (retain_handling == 0 or (retain_handling == 1 and new))):
+                    replays.append((topic_filter, sub_options))
+        for topic_filter in new_filters:
+            self.__add_interest(topic_filter)
 
         # Send SUBACK to client
-        suback_fixed_header = FixedHeader(SUBACK)
-        suback_variable_header = SubackVariableHeader(recv_packet.variable_data.packet_id, 0x00)
-        suback_packet = MQTTPacket(suback_fixed_header, suback_variable_header)
-        client_socket.sendall(suback_packet.encode())
+        self.__send(src_client_id, suback_packet(recv_packet.variable_data.packet_id, reason_codes))
+
+        # Bring the new subscriber up to date with the last known value of every matching topic
+        for topic_filter, sub_options in replays:
+            now = time.time()
+            for outgoing in self.retained.match(topic_filter):
+                if(outgoing.expires_at is not None):
+                    if(outgoing.expires_at <= now):
+                        self.retained.delete(outgoing.topic_name)      # Expired retained message
+                        continue
+                    outgoing = outgoing.restamped(now)
+                self.__deliver(src_client_id, outgoing, sub_options, True)
+
+
+# Run the selector engine in `workers` forked processes sharing one port through SO_REUSEPORT.
+# Every pair of workers is joined by a socketpair; a worker forwards a PUBLISH to the siblings that
+# announced a matching filter, so publishers and subscribers may land on different workers.
+def run_workers(workers: int, broker_ip: str, port: int = 1883, verbosity: int = 0, **options):
+    if(options.get("session_dir")):
+        # Sessions live in the worker a client last connected to, a reconnect may land on another one
+        raise ValueError("session_dir cannot be used with several workers")
+    links = {(a, b): socket.socketpair() for a in range(workers) for b in range(a+1, workers)}
+    pids = []
+    for worker in range(workers):
+        pid = os.fork()
+        if(pid == 0):
+            try:
+                broker = Broker(broker_ip, port, "selector", reuse_port=True, **options)
+                if(worker): broker.snapshot_interval = 0     # Workers share the retained store, one writes it
+                broker.sys_prefix = f"$SYS/broker/worker{worker}"
+                broker.worker_id = f"{PEER_PREFIX}{worker}"
+                if(broker.metrics_port): broker.metrics_port += worker
+                for (a, b), (sock_a, sock_b) in links.items():
+                    if(a == worker): broker.add_peer(f"{PEER_PREFIX}{b}", sock_a)
+                    elif(b == worker): broker.add_peer(f"{PEER_PREFIX}{a}", sock_b)
+                    else:
+                        sock_a.close(); sock_b.close()
+                print(f"Worker {worker} (pid {os.getpid()}) listening on {broker_ip}:{port}")
+                broker.loop(verbosity).join()
+            finally:
+                os._exit(0)                                 # Never return into the parent's code
+        pids.append(pid)
+
+    for sock_a, sock_b in links.values():
+        sock_a.close(); sock_b.close()
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))  # Stopping the parent stops the workers too
+    try:
+        for pid in pids:
+            os.waitpid(pid, 0)
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
 
 
 # Entry point
 if(__name__ == "__main__"):
 
-    if len(sys.argv) != 2:
-        print("Usage: python broker.py <BrokerIP>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(usage="python broker.py <BrokerIP> [--port PORT] [--engine threaded|selector] [options]")
+    parser.add_argument("broker_ip")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--engine", choices=["threaded", "selector"], default="threaded")
+    parser.add_argument("--retry-interval", type=float, default=5.0, help="seconds after it is written before an unacknowledged QoS 1 message is resent, doubling with each resend")
+    parser.add_argument("--queue-max-messages", type=int, default=1000, help="outbound queue limit per client (messages)")
+    parser.add_argument("--queue-max-bytes", type=int, default=1 << 20, help="outbound queue limit per client (bytes)")
+    parser.add_argument("--queue-policy", choices=POLICIES, default="drop-oldest", help="what to do when a client's outbound queue is full")
+    parser.add_argument("--workers", type=int, default=1, help="selector engine worker processes sharing the port")
+    parser.add_argument("--retained-file", help="snapshot file for retained messages, loaded at startup")
+    parser.add_argument("--retained-max-messages", type=int, help="retained topics kept before evicting the stalest")
+    parser.add_argument("--retained-max-bytes", type=int, help="retained bytes kept before evicting the stalest")
+    parser.add_argument("--snapshot-interval", type=float, default=30.0, help="seconds between retained snapshots")
+    parser.add_argument("--session-dir", help="journal directory so Clean Start = 0 sessions survive restarts")
+    parser.add_argument("--session-expiry", type=int, default=SESSION_EXPIRY,
+                        help="longest a Clean Start = 0 session is kept after its client disconnects (seconds), "
+                             "also when the client asks for longer or sent no Session Expiry Interval")
+    parser.add_argument("--sys-interval", type=float, default=10.0, help="seconds between $SYS statistics publishes, 0 disables")
+    parser.add_argument("--metrics-port", type=int, default=0, help="serve Prometheus metrics on 127.0.0.1:PORT (one port per worker)")
+    parser.add_argument("--topic-alias-maximum", type=int, default=TOPIC_ALIAS_LIMIT,
+                        help="topic aliases each client may define, 0 disables them")
+    parser.add_argument("--receive-maximum", type=int, default=RECEIVE_LIMIT,
+                        help="unacknowledged QoS 1 PUBLISHes each client may have outstanding (1-65535)")
+    parser.add_argument("--listen-backlog", type=int, default=LISTEN_BACKLOG, help="pending TCP connections the kernel queues")
+    parser.add_argument("--connect-timeout", type=float, default=CONNECT_TIMEOUT,
+                        help="seconds a new connection has to send CONNECT, 0 waits forever")
+    parser.add_argument("--connect-rate", type=float, default=0,
+                        help="CONNECTs accepted per second, others get CONNACK 0x9F; 0 disables the limit")
+    parser.add_argument("--connect-burst", type=int, help="CONNECTs accepted at once before --connect-rate applies")
+    parser.add_argument("--publish-batch", type=int, default=PUBLISH_BATCH,
+                        help="PUBLISHes from one read routed and flushed together, 1 handles each on its own")
+    parser.add_argument("--stream-threshold", type=int, default=STREAM_THRESHOLD,
+                        help="PUBLISHes larger than this many bytes are forwarded in chunks as they arrive, 0 disables")
+    parser.add_argument("--share-policy", choices=SHARE_POLICIES, default="round-robin",
+                        help="how $share/<group>/<filter> messages are spread across the group")
+    args = parser.parse_args()
+    retained_options = dict(retained_file=args.retained_file, retained_max_messages=args.retained_max_messages,
+                            retained_max_bytes=args.retained_max_bytes, snapshot_interval=args.snapshot_interval,
+                            session_dir=args.session_dir, sys_interval=args.sys_interval, metrics_port=args.metrics_port,
+                            share_policy=args.share_policy, topic_alias_maximum=args.topic_alias_maximum,
+                            receive_maximum=args.receive_maximum, listen_backlog=args.listen_backlog,
+                            connect_timeout=args.connect_timeout, connect_rate=args.connect_rate,
+                            connect_burst=args.connect_burst, publish_batch=args.publish_batch,
+                            stream_threshold=args.stream_threshold, session_expiry=args.session_expiry)
+    if(args.workers > 1 and args.engine != "selector"):
+        parser.error("--workers requires --engine selector")
+    if(args.workers > 1 and args.session_dir):
+        # A reconnecting client may land on any worker, which would not have its session
+        parser.error("--session-dir cannot be combined with --workers")
+    if(not 0 <= args.session_expiry <= 0xFFFFFFFF):
+        parser.error("--session-expiry must be between 0 and 4294967295")
+    if(not 0 < args.receive_maximum <= 65535):
+        parser.error("--receive-maximum must be between 1 and 65535")
 
-    mqttb = Broker(sys.argv[1])  # Create broker with given IP
-    mqttb.loop()                 # Start broker loop
+    if(args.workers > 1):
+        run_workers(args.workers, args.broker_ip, args.port, retry_interval=args.retry_interval,
+                    queue_max_messages=args.queue_max_messages, queue_max_bytes=args.queue_max_bytes,
+                    queue_policy=args.queue_policy, **retained_options)
+    else:
+        mqttb = Broker(args.broker_ip, args.port, args.engine, args.retry_interval,
+                       args.queue_max_messages, args.queue_max_bytes, args.queue_policy,
+                       **retained_options)                  # Create broker with given IP
+        mqttb.loop()                                        # Start broker loop
@@ -1,69 +1,115 @@
 import socket, threading, time
 import random, string
-from MQTTPacket import FixedHeader, MQTTPacket
+from MQTTPacket import FixedHeader, MQTTPacket, PINGREQ_PACKET, puback_packet, encode_many, publish_head
 from variableheaders import *
 from utils import *
+from framereader import FrameReader
 
-# Function to receive fixed header and return it with the value.
-def recv_fixed_header(conn: socket.socket):
-    encoded = conn.recv(2)
-    if(encoded == b'\x00\x00'): return 0
-    multiplier = 1
-    value = encoded[-1]&127
-    while(encoded[-1] & 128 != 0):
-        encoded += conn.recv(1)
-        value += (encoded[-1] & 127) * multiplier
-        multiplier *= 128
-    return encoded, value
+STREAM_THRESHOLD = 1 << 20  # PUBLISHes received larger than this are read in chunks
 
 # MQTT Client class
 class Client:
     '''
     MQTT client class with essential functionalities:
-    client.connect(broker, port, keep_alive): connects to a broker.
-    client.loop(): starts listening for packets.
-    client.subscribe(topics): subscribes to a topic or list of topics.
-    client.publish(topic_name, payload, flags): publishes to a topic.
+    client.connect(broker, port, keep_alive, clean_start, topic_alias_maximum, receive_maximum): connects to a broker;
+        clean_start=False resumes a session, topic_alias_maximum is how many topic aliases the broker may use towards
+        us and receive_maximum how many QoS 1 messages it may send us before we acknowledge them.
+    client.loop(): starts listening for packets, and pinging the broker when the link is idle.
+    client.subscribe(topics): subscribes to a topic or list of topics and returns the SUBACK reason codes, one per
+        topic: the granted QoS, or 0x80 and above when the broker refused it.
+    client.publish(topic_name, payload, flags, properties, wait): publishes to a topic, through a topic alias when the
+        broker allows it; properties are MQTT 5 PUBLISH properties such as {MESSAGE_EXPIRY_INTERVAL: seconds}.
+        A QoS 1 publish with wait=False returns once sent, so up to the broker's Receive Maximum are in flight.
+    client.publish_many(messages, flags, properties, wait): publishes a list of (topic_name, payload) with the same
+        flags and properties, encoded into one buffer and sent with one sendall (QoS 1: one per window of the
+        broker's Receive Maximum); wait=True blocks until every message is acknowledged.
+    client.publish_stream(topic_name, chunks, length, flags, properties, wait): publishes a payload of `length`
+        bytes given as an iterable of chunks, sent as they come, so it never has to be in memory whole. It is not
+        resent after a reconnect, and the broker forwards it at QoS 0 without retaining or storing it.
+    client.wait_for_acks(timeout): blocks until every QoS 1 publish has been acknowledged.
+    Payloads are binary: publish() takes bytes, bytearray or memoryview as is (a str is sent UTF-8 encoded), and
+    on_message(payload) gets the type given as payload_type: bytes (default), str (UTF-8 decoded, invalid bytes
+    replaced) or memoryview (no copy at all, a view of the receive buffer only valid until on_message returns).
+    Messages larger than stream_threshold are read in chunks: with on_payload_chunk(chunk, offset, total) set,
+    each chunk is handed to it as it arrives (bytes, or a memoryview with payload_type=memoryview) and on_message
+    is not called; otherwise the chunks are put back together for on_message.
     '''
     
-    def __init__(self, client_id: str = ""):
+    def __init__(self, client_id: str = "", payload_type: type = bytes, stream_threshold: int = STREAM_THRESHOLD):
+        assert payload_type in (bytes, str, memoryview)
         if(client_id == ""):
             self.client_id = ''.join([random.choice(string.ascii_letters+string.digits) for _ in range(64)])
         else:
             self.client_id = client_id
         self.conn: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.stream_threshold = stream_threshold  # larger messages are received in chunks
+        self.reader = FrameReader(stream_threshold=stream_threshold)  # splits the byte stream from the broker into packets
         self.connected: bool = False
         self.broker: str = ""
         self.port: int = 8000
         self.keep_alive: int = 0
+        self.session_present: bool = False  # set from CONNACK when the broker resumed our session
         self.last_packet_time: float = 0.0
+        self.last_send_time: float = 0.0  # keep-alive counts packets we send, pings only fill the gaps
+        self.ping_outstanding: bool = False
         self.packet_id: int = 1
-        self.waiting_acks : dict[int, bytes] = dict()  # stores packet_id with waiting acks
-        self.ack_reason_code: int = 0
+        self.waiting_acks : dict[int, bytes | memoryview] = dict()  # stores packet_id with waiting acks
+        self.ack_reason_code: int | list[int] = 0  # of the last ack, a list for a SUBACK
+        self.acks = threading.Condition()  # guards waiting_acks, notified whenever an ack arrives
+        self.inflight_publishes: set[int] = set()  # QoS 1 publishes awaiting PUBACK
+        self.receive_maximum: int = 0  # QoS 1 messages the broker may leave unacknowledged towards us, 0: no limit
+        self.send_quota: int = 65535  # QoS 1 publishes we may leave unacknowledged (broker's Receive Maximum)
+        self.send_lock = threading.RLock()  # listen thread and caller thread both write to the socket
+
+        # Topic aliases, reset on every connection
+        self.topic_alias_maximum: int = 0  # aliases we accept from the broker
+        self.broker_alias_maximum: int = 0  # aliases the broker accepts from us (from CONNACK)
+        self.topic_aliases: dict[str, int] = dict()  # topic -> alias we defined for our publishes
+        self.inbound_aliases: dict[int, str] = dict()  # alias -> topic the broker defined
 
         self.on_connect = lambda flags, reason_code: None  # lambda functions for event handling
         self.on_message = lambda msg: None  # lambda function for handling incoming messages
+        self.on_payload_chunk = None  # (chunk, offset, total) for messages over stream_threshold, None: reassemble
+        self.payload_type = payload_type  # what on_message receives: bytes, str or memoryview
 
-    def connect(self, broker: str, port: int, keep_alive: int = 0):
+    def connect(self, broker: str, port: int, keep_alive: int = 0, clean_start: bool = True,
+                topic_alias_maximum: int = 0, receive_maximum: int = 0):
         try:
             self.conn.close()  # close the existing connection if open
         except:
             pass
         self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.conn.connect((broker, port))  # connect to the broker on the given port
+        self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # no Nagle delay for small packets
+        self.reader = FrameReader(stream_threshold=self.stream_threshold)
 
         # Create the MQTT CONNECT packet
         connect_fixed_header = FixedHeader(CONNECT)
-        connect_var_header = ConnectVariableHeader(self.client_id, keep_alive=keep_alive)
+        connect_properties = dict()
+        if(topic_alias_maximum):
+            connect_properties[TOPIC_ALIAS_MAXIMUM] = topic_alias_maximum
+        if(receive_maximum):
+            connect_properties[RECEIVE_MAXIMUM] = receive_maximum
+        connect_var_header = ConnectVariableHeader(self.client_id, keep_alive=keep_alive,
+                                                   flags=0x02 if clean_start else 0x00,  # 0x02: Clean Start
+                                                   properties=connect_properties)
         connect_packet = MQTTPacket(connect_fixed_header, connect_var_header)
         connect_packet_encoded = connect_packet.encode()
 
         self.conn.sendall(connect_packet_encoded)  # send the CONNECT packet
+        self.last_send_time = time.time()
+        self.ping_outstanding = False
 
         # Wait for the CONNACK response
-        connack_packet_encoded, connack_packet_len = recv_fixed_header(self.conn)
-        connack_packet_encoded += self.conn.recv(connack_packet_len)
+        connack_packet_encoded = self.reader.read_frame(self.conn)
+        if(connack_packet_encoded is None):
+            raise ConnectionError("Broker closed the connection before CONNACK")
         connack_packet = MQTTPacket.decode(connack_packet_encoded)
+        if(connack_packet.variable_data.reason_code >= 0x80):
+            # Refused, e.g. 0x82 duplicate client id or 0x9F connection rate exceeded (retry later)
+            self.conn.close()
+            raise ConnectionRefusedError("Broker refused the connection, reason code "
+                                         f"{hex(connack_packet.variable_data.reason_code)}")
 
         # Set connection status and callback
         self.last_packet_time = time.time()
@@ -71,6 +117,15 @@ class Client:
         self.broker = broker
         self.port = port
         self.keep_alive = keep_alive
+        self.session_present = bool(connack_packet.variable_data.flags & 0x01)
+        self.topic_alias_maximum = topic_alias_maximum
+        self.broker_alias_maximum = connack_packet.variable_data.properties.get(TOPIC_ALIAS_MAXIMUM, 0)
+        self.receive_maximum = receive_maximum
+        with self.acks:
+            self.send_quota = connack_packet.variable_data.properties.get(RECEIVE_MAXIMUM, 65535)
+            self.acks.notify_all()
+        self.topic_aliases = dict()
+        self.inbound_aliases = dict()
 
         self.on_connect(connack_packet.variable_data.flags,
                         connack_packet.variable_data.reason_code)
@@ -78,90 +133,315 @@ class Client:
     def loop(self):
         thread = threading.Thread(target = self.__listen)  # start listening in a separate thread
         thread.start()
+        if(self.keep_alive):
+            threading.Thread(target = self.__keep_alive_loop, daemon=True).start()
 
         if(len(self.waiting_acks)):
-            for packet in self.waiting_acks.values():
-                self.conn.sendall(packet)  # resend any unacknowledged packets
+            for packet_id, packet in list(self.waiting_acks.items()):
+                if(packet is not None):
+                    self.__send(packet)  # resend any unacknowledged packets
+                    continue
+                with self.acks:
+                    # A streamed publish cut off by the disconnect, its payload was not kept
+                    self.waiting_acks.pop(packet_id, None)
+                    self.inflight_publishes.discard(packet_id)
+                    self.acks.notify_all()
 
     def __listen(self):
         while True:
             try:
-                data = recv_fixed_header(self.conn)  # read incoming data
+                encoded_packet = self.reader.read_frame(self.conn)  # read the next complete packet
             except Exception as e:
                 if(not self.connected):
                     return
                 else:
                     raise e
+            if(encoded_packet is None):
+                return  # broker closed the connection
             self.last_packet_time = time.time()
 
-            if(data):
-                encoded_packet, packet_len = data
-                encoded_packet += self.conn.recv(packet_len)
+            if(self.reader.payload_left):
+                try:
+                    if(not self.__receive_stream(encoded_packet)):
+                        return  # broker closed the connection
+                except Exception as e:
+                    if(not self.connected):
+                        return
+                    else:
+                        raise e
+                continue
+
+            if(encoded_packet):
                 recv_packet = MQTTPacket.decode(encoded_packet)
 
                 if(recv_packet.fixed_header.packet_type == PUBLISH):
+                    self.__resolve_topic_alias(recv_packet.variable_data)
+                    # Acknowledge QoS 1 messages so the broker stops tracking them
+                    if((recv_packet.fixed_header.flags & 0b0110) == 0b0010):
+                        self.__send(puback_packet(recv_packet.variable_data.packet_id))
                     # Handle incoming messages with PUBLISH packet type
-                    self.on_message(recv_packet.variable_data.payload)
+                    self.on_message(self.__payload(recv_packet.variable_data.payload))
                 if(recv_packet.fixed_header.packet_type == SUBACK or recv_packet.fixed_header.packet_type == PUBACK):
                     # Handle acknowledgement packets (SUBACK, PUBACK)
                     self.__handle_ack(recv_packet)
+                if(recv_packet.fixed_header.packet_type == PINGRESP):
+                    self.ping_outstanding = False
+
+    def __receive_stream(self, head: memoryview):
+        # A message over stream_threshold: its payload goes to on_payload_chunk as it is read, or is put back
+        # together for on_message. Returns False if the connection closed before the end of the payload.
+        recv_packet = MQTTPacket.decode_head(head)
+        self.__resolve_topic_alias(recv_packet.variable_data)  # decoded before the head's buffer is reused
+        packet_id = recv_packet.variable_data.packet_id if recv_packet.fixed_header.flags & 0b0110 else None
+        total = self.reader.payload_left
+        on_chunk = self.on_payload_chunk
+        whole = bytearray() if on_chunk is None else None
+        offset = 0
+        while True:
+            for chunk in self.reader.payload():
+                if(whole is not None):
+                    whole += chunk
+                else:
+                    on_chunk(chunk if self.payload_type is memoryview else bytes(chunk), offset, total)
+                offset += len(chunk)
+            if(not self.reader.payload_left):
+                break
+            if(not self.reader.recv_from(self.conn)):
+                return False
+            self.last_packet_time = time.time()
+            self.ping_outstanding = False  # the PINGRESP waits behind the stream, its bytes show the link is alive
+        if(packet_id is not None):
+            self.__send(puback_packet(packet_id))
+        if(whole is not None):
+            self.on_message(self.__payload(memoryview(whole)))
+        return True
+
+    def __payload(self, view: memoryview):
+        # The decoded payload is a view of the reader's buffer, reused by the next read
+        if(self.payload_type is bytes):
+            return bytes(view)
+        if(self.payload_type is str):
+            return str(view, 'utf-8', 'replace')  # binary data must not kill the listen thread
+        return view
+
+    def __resolve_topic_alias(self, publish: PublishHeader):
+        # A topic name with an alias defines it, an empty topic name uses it
+        alias = publish.properties.get(TOPIC_ALIAS)
+        if(alias is None):
+            return
+        if(publish.topic_name):
+            self.inbound_aliases[alias] = publish.topic_name
+        else:
+            publish.topic_name = self.inbound_aliases.get(alias, "")
+
+    def __keep_alive_loop(self):
+        # Send PINGREQ once nothing has been sent for 3/4 of the keep-alive, so the broker never times us out
+        conn = self.conn
+        idle_limit = self.keep_alive * 0.75
+        while self.connected and self.conn is conn:
+            wait = self.last_send_time + idle_limit - time.time()
+            if(wait > 0):
+                time.sleep(wait)
+                continue
+            if(self.ping_outstanding):
+                # No PINGRESP within a whole ping interval: the link is dead
+                self.connected = False
+                conn.close()
+                return
+            self.ping_outstanding = True
+            try:
+                self.__send(PINGREQ_PACKET)
+            except OSError:
+                return
+
+    def __send(self, data: bytes):
+        with self.send_lock:
+            self.conn.sendall(data)
+            self.last_send_time = time.time()
 
     def subscribe(self, topics: str | tuple[str, int] | list[tuple[str, int]]):
-        if(time.time() - self.last_packet_time > self.keep_alive):
-            # TODO: Ping the broker if the connection has been idle for too long
-            pass
         # Create the MQTT SUBSCRIBE packet
         subscribe_fixed_header = FixedHeader(SUBSCRIBE)
-        if(isinstance(topics, str)):
-            subscribe_variable_header = SubscribeVariableHeader(self.packet_id, [(topics, 0)])
-        elif(isinstance(topics, tuple) and len(topics)==1):
-            subscribe_variable_header = SubscribeVariableHeader(self.packet_id, [topics])
-        else:
-            subscribe_variable_header = SubscribeVariableHeader(self.packet_id, topics)
-        subscribe_packet = MQTTPacket(subscribe_fixed_header, subscribe_variable_header)
-        subscribe_packet_encoded = subscribe_packet.encode()
-
-        self.conn.sendall(subscribe_packet_encoded)  # send the SUBSCRIBE packet
-        
-        # Store the current packet ID and wait for an ACK
-        cur_packet_id = self.packet_id
-        self.waiting_acks[cur_packet_id] = subscribe_packet_encoded
-        self.packet_id += 1
-        while(cur_packet_id in self.waiting_acks):
-            pass  # block until ACK is received
-        return self.ack_reason_code
+        with self.acks:
+            cur_packet_id = self.__next_packet_id()
+            if(isinstance(topics, str)):
+                subscribe_variable_header = SubscribeVariableHeader(cur_packet_id, [(topics, 0)])
+            elif(isinstance(topics, tuple) and len(topics)==1):
+                subscribe_variable_header = SubscribeVariableHeader(cur_packet_id, [topics])
+            else:
+                subscribe_variable_header = SubscribeVariableHeader(cur_packet_id, topics)
+            subscribe_packet = MQTTPacket(subscribe_fixed_header, subscribe_variable_header)
+            subscribe_packet_encoded = subscribe_packet.encode()
+            # Register before sending so a fast ACK is not missed
+            self.waiting_acks[cur_packet_id] = subscribe_packet_encoded
+
+        self.__send(subscribe_packet_encoded)  # send the SUBSCRIBE packet
+
+        # Wait for an ACK
+        with self.acks:
+            self.acks.wait_for(lambda: cur_packet_id not in self.waiting_acks)
+            return self.ack_reason_code
+
+    def __next_packet_id(self):
+        # Packet ids run 1..65535, skipping those still awaiting an ack (acks lock held)
+        while(self.packet_id in self.waiting_acks):
+            self.packet_id = self.packet_id % 65535 + 1
+        packet_id = self.packet_id
+        self.packet_id = packet_id % 65535 + 1
+        return packet_id
 
     def __handle_ack(self, recv_packet: MQTTPacket):
         # Handle incoming acknowledgment packets (SUBACK, PUBACK)
-        if(recv_packet.variable_data.packet_id in self.waiting_acks):
-            self.ack_reason_code = recv_packet.variable_data.reason_code
-            self.waiting_acks.pop(recv_packet.variable_data.packet_id)
+        with self.acks:
+            if(recv_packet.variable_data.packet_id in self.waiting_acks):
+                if(recv_packet.fixed_header.packet_type == SUBACK):
+                    self.ack_reason_code = recv_packet.variable_data.reason_codes
+                else:
+                    self.ack_reason_code = recv_packet.variable_data.reason_code
+                self.waiting_acks.pop(recv_packet.variable_data.packet_id)
+                self.inflight_publishes.discard(recv_packet.variable_data.packet_id)
+                self.acks.notify_all()
 
-    def publish(self, topic_name: str, payload: str, flags: int = 0):
-        if(time.time() - self.last_packet_time > self.keep_alive):
-            # ping broker if connection is idle
-            pass
+    def wait_for_acks(self, timeout: float | None = None):
+        # Returns False if some QoS 1 publish is still unacknowledged after timeout seconds
+        with self.acks:
+            return self.acks.wait_for(lambda: not self.inflight_publishes, timeout)
 
+    def __alias_properties(self, topic_name: str):
+        # Returns (topic name to send, properties): the first publish on a topic defines an alias,
+        # later ones send an empty topic name and just the alias (send_lock held to keep them in order)
+        alias = self.topic_aliases.get(topic_name)
+        if(alias is not None):
+            return "", {TOPIC_ALIAS: alias}
+        if(len(self.topic_aliases) < self.broker_alias_maximum):
+            alias = self.topic_aliases[topic_name] = len(self.topic_aliases) + 1
+            return topic_name, {TOPIC_ALIAS: alias}
+        return topic_name, {}
+
+    def publish(self, topic_name: str, payload: bytes | bytearray | memoryview | str, flags: int = 0, properties: dict | None = None,
+                wait: bool = True):
+        properties = properties or dict()
         # Create the PUBLISH packet with appropriate flags (QoS)
         if((flags & 0b0110) == 0b0000):  # QoS 0
-            publish_fixed_header = FixedHeader(PUBLISH, flags)
-            publish_variable_header = PublishVariableHeader(topic_name, payload)
-            publish_packet = MQTTPacket(publish_fixed_header, publish_variable_header)
-            publish_packet_encoded = publish_packet.encode()
-            self.conn.sendall(publish_packet_encoded)
+            with self.send_lock:
+                wire_topic, alias_properties = self.__alias_properties(topic_name)
+                publish_fixed_header = FixedHeader(PUBLISH, flags)
+                publish_variable_header = PublishVariableHeader(wire_topic, payload,
+                                                                properties={**properties, **alias_properties})
+                publish_packet = MQTTPacket(publish_fixed_header, publish_variable_header)
+                publish_packet_encoded = publish_packet.encode()
+                self.__send(publish_packet_encoded)
         elif((flags & 0b0110) == 0b0010):  # QoS 1
             publish_fixed_header = FixedHeader(PUBLISH, flags)
-            publish_variable_header = PublishVariableHeader(topic_name, payload, self.packet_id)
-            publish_packet = MQTTPacket(publish_fixed_header, publish_variable_header)
-            publish_packet_encoded = publish_packet.encode()
-            self.conn.sendall(publish_packet_encoded)
+            with self.acks:
+                # Sliding window: wait for a PUBACK while the broker's Receive Maximum is used up
+                self.acks.wait_for(lambda: len(self.inflight_publishes) < self.send_quota)
+                cur_packet_id = self.__next_packet_id()
+                publish_variable_header = PublishVariableHeader(topic_name, payload, cur_packet_id, properties)
+                publish_packet = MQTTPacket(publish_fixed_header, publish_variable_header)
+                publish_packet_encoded = publish_packet.encode()
+
+                # Register before sending so a fast PUBACK is not missed.
+                # Resends after a reconnect use the full topic name, aliases do not outlive a connection.
+                self.waiting_acks[cur_packet_id] = publish_packet_encoded
+                self.inflight_publishes.add(cur_packet_id)
+            with self.send_lock:
+                wire_topic, alias_properties = self.__alias_properties(topic_name)
+                if(alias_properties):
+                    publish_variable_header = PublishVariableHeader(wire_topic, payload, cur_packet_id,
+                                                                    {**properties, **alias_properties})
+                    publish_packet_encoded = MQTTPacket(publish_fixed_header, publish_variable_header).encode()
+                self.__send(publish_packet_encoded)
 
             # Wait for acknowledgment (PUBACK)
-            cur_packet_id = self.packet_id
-            self.waiting_acks[cur_packet_id] = publish_packet_encoded
-            self.packet_id += 1
-            while(cur_packet_id in self.waiting_acks):
-                pass
+            if(not wait):
+                return None
+            with self.acks:
+                self.acks.wait_for(lambda: cur_packet_id not in self.waiting_acks)
+                return self.ack_reason_code
+
+    def publish_many(self, messages: list[tuple[str, bytes | bytearray | memoryview | str]], flags: int = 0,
+                     properties: dict | None = None, wait: bool = True):
+        properties = properties or dict()
+        publish_fixed_header = FixedHeader(PUBLISH, flags)  # Shared by the whole batch
+        if((flags & 0b0110) == 0b0000):  # QoS 0
+            with self.send_lock:
+                packets = []
+                for topic_name, payload in messages:
+                    wire_topic, alias_properties = self.__alias_properties(topic_name)
+                    packets.append(MQTTPacket(publish_fixed_header, PublishVariableHeader(
+                        wire_topic, payload, properties={**properties, **alias_properties})))
+                self.__send(encode_many(packets))
+            return None
+        elif((flags & 0b0110) == 0b0010):  # QoS 1
+            packet_ids = set()
+            sent = 0
+            while(sent < len(messages)):
+                with self.acks:
+                    # As many as the broker's Receive Maximum has room for, at least one
+                    self.acks.wait_for(lambda: len(self.inflight_publishes) < self.send_quota)
+                    chunk = messages[sent:sent + self.send_quota - len(self.inflight_publishes)]
+                    packets = [MQTTPacket(publish_fixed_header,
+                                          PublishVariableHeader(topic_name, payload, self.__next_packet_id(), properties))
+                               for topic_name, payload in chunk]
+                    ends = []
+                    frames = memoryview(encode_many(packets, ends))
+
+                    # Register before sending so a fast PUBACK is not missed. The resend copies are views of
+                    # the buffer with full topic names, aliases do not outlive a connection.
+                    start = 0
+                    for packet, end in zip(packets, ends):
+                        packet_id = packet.variable_data.packet_id
+                        self.waiting_acks[packet_id] = frames[start:end]
+                        self.inflight_publishes.add(packet_id)
+                        packet_ids.add(packet_id)
+                        start = end
+                with self.send_lock:
+                    if(self.broker_alias_maximum):
+                        for packet in packets:
+                            publish = packet.variable_data
+                            publish.topic_name, alias_properties = self.__alias_properties(publish.topic_name)
+                            publish.properties = {**properties, **alias_properties}
+                        frames = encode_many(packets)
+                    self.__send(frames)
+                sent += len(chunk)
+
+            # Wait for acknowledgment (PUBACK) of the whole batch
+            if(wait):
+                with self.acks:
+                    self.acks.wait_for(lambda: self.inflight_publishes.isdisjoint(packet_ids))
+            return None
+
+    def publish_stream(self, topic_name: str, chunks, length: int, flags: int = 0, properties: dict | None = None,
+                       wait: bool = True):
+        packet_id = None
+        if((flags & 0b0110) == 0b0010):  # QoS 1
+            with self.acks:
+                self.acks.wait_for(lambda: len(self.inflight_publishes) < self.send_quota)
+                packet_id = self.__next_packet_id()
+                self.waiting_acks[packet_id] = None  # nothing to resend, the payload is not kept
+                self.inflight_publishes.add(packet_id)
+
+        # The head and every chunk go out back to back, nothing else may be sent in between
+        with self.send_lock:
+            self.__send(publish_head(flags, topic_name, length, packet_id, properties))
+            sent = 0
+            for chunk in chunks:
+                sent += len(chunk)
+                if(sent > length):
+                    break
+                self.__send(chunk)
+            if(sent != length):
+                # The broker is still reading the packet we announced, only a new connection gets past it
+                self.connected = False
+                self.conn.close()
+                raise ValueError(f"Payload chunks do not add up to the {length} bytes announced")
+
+        # Wait for acknowledgment (PUBACK)
+        if(packet_id is None or not wait):
+            return None
+        with self.acks:
+            self.acks.wait_for(lambda: packet_id not in self.waiting_acks)
             return self.ack_reason_code
 
     def disconnect(self):
@@ -171,7 +451,7 @@ class Client:
         disconnect_variable_header = DisconnectVariableHeader(0x00)
         disconnect_packet = MQTTPacket(disconnect_fixed_header, disconnect_variable_header)
         disconnect_packet_encoded = disconnect_packet.encode()
-        self.conn.sendall(disconnect_packet_encoded)
+        self.__send(disconnect_packet_encoded)
         self.conn.close()  # close the connection
 
 if(__name__ == "__main__"):
@@ -181,7 +461,7 @@ if(__name__ == "__main__"):
         def on_message(msg: str):
             print("Message from A:", msg)
 
-        mqttca = Client("A")
+        mqttca = Client("A", payload_type=str)
         mqttca.on_message = on_message
         mqttca.connect("localhost", 1883, 10)
         mqttca.loop()
@@ -197,7 +477,7 @@ if(__name__ == "__main__"):
         def on_message(msg: str):
             print("Message from B:", msg)
 
-        mqttcb = Client("B")
+        mqttcb = Client("B", payload_type=str)
         mqttcb.on_message = on_message
         time.sleep(0.5)
         mqttcb.connect("localhost", 1883, 5)
@@ -213,7 +493,7 @@ if(__name__ == "__main__"):
         def on_message(msg: str):
             print("Message from C:", msg)
 
-        mqttcc = Client("C")
+        mqttcc = Client("C", payload_type=str)
         mqttcc.on_message = on_message
         time.sleep(1)
         mqttcc.connect("localhost", 1883, 10)
@@ -0,0 +1,131 @@
+# Buffered MQTT frame parser shared by the broker and the client
+import socket
+
+MAX_REMAINING_LENGTH = 268435455       # Largest value a 4 byte variable length integer can hold
+STREAM_CHUNK = 65536                   # Buffer size while a streamed payload is read through it
+
+
+class FrameReader:
+    '''
+    Incremental reader that splits a TCP byte stream into MQTT packets:
+    reader.recv_from(sock): one recv_into the free end of a reusable buffer, returns bytes read (0 on EOF).
+    reader.frames(): yields every complete packet in the buffer as a memoryview, without copying.
+    reader.read_frame(sock): blocking helper returning the next complete packet (None on EOF).
+    Yielded memoryviews are only valid until the next recv_from call; decode or copy them before reading again.
+    With a stream_threshold, a PUBLISH larger than it is never buffered whole: frames() yields its head (fixed
+    header, topic, packet id and properties) and sets reader.payload_left to the payload bytes still to come.
+    reader.payload() then yields the buffered part of the payload, and frames() yields nothing until all of it
+    has been handed out; the buffer stays at STREAM_CHUNK bytes whatever the size of the payload.
+    '''
+
+    def __init__(self, size: int = 65536, max_packet_size: int = MAX_REMAINING_LENGTH+5,
+                 stream_threshold: int | None = None):
+        self.size = size                           # Initial buffer size, restored once a large packet is consumed
+        self.max_packet_size = max_packet_size
+        self.stream_threshold = stream_threshold   # PUBLISH packets larger than this are streamed, None: never
+        self.payload_left = 0                      # Bytes of a streamed payload not yet handed out by payload()
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0                             # First byte not yet handed out as a frame
+        self.end = 0                               # End of received data
+        self.needed = 0                            # Size of the partial packet at start, once its header is known
+
+    def recv_from(self, sock: socket.socket):
+        if(self.start == self.end):
+            self.start = self.end = 0
+            if(len(self.buffer) > self.size and not self.payload_left):
+                self.__replace_buffer(self.size)   # Give back memory grabbed for a large packet
+        elif(self.start):
+            # Move the partial packet to the front (it is at most one packet long)
+            pending = self.end - self.start
+            self.buffer[:pending] = bytes(self.view[self.start:self.end])
+            self.start, self.end = 0, pending
+
+        if(self.payload_left):
+            if(len(self.buffer) < STREAM_CHUNK):
+                self.__replace_buffer(STREAM_CHUNK)   # Fewer reads for a large payload, still bounded
+        elif(self.needed > len(self.buffer) or self.end == len(self.buffer)):
+            self.__replace_buffer(max(self.needed, 2*len(self.buffer)))
+
+        received = sock.recv_into(self.view[self.end:])
+        self.end += received
+        return received
+
+    def frames(self):
+        while True:
+            buffer = self.buffer
+            start = self.start
+            if(self.end - start < 2 or self.payload_left): return
+
+            # Decode the remaining length (1 to 4 bytes after the packet type byte)
+            packet_len = 0; shift = 0; i = start+1
+            while True:
+                if(i >= self.end): return          # Remaining length not fully received
+                byte = buffer[i]
+                packet_len |= (byte & 127) << shift
+                i += 1
+                if(not byte & 128): break
+                shift += 7
+                if(shift > 21): raise ValueError("Malformed remaining length")
+
+            frame_end = i + packet_len
+            if(frame_end - start > self.max_packet_size):
+                raise ValueError("Packet too large")
+            if(self.stream_threshold is not None and buffer[start] >> 4 == 3
+               and frame_end - start > self.stream_threshold):
+                self.needed = 0                    # The buffer only has to hold the head
+                payload_start = self.__payload_start(start, i, frame_end)
+                if(payload_start is None): return  # Head not fully received
+                self.start = payload_start
+                self.payload_left = frame_end - payload_start
+                yield self.view[start:payload_start]
+                return
+            if(frame_end > self.end):
+                self.needed = frame_end - start    # Make sure the buffer can hold the whole packet
+                return
+            self.needed = 0
+            self.start = frame_end
+            yield self.view[start:frame_end]
+
+    def payload(self):
+        while self.payload_left and self.start < self.end:
+            start = self.start
+            self.start = min(self.end, start + self.payload_left)
+            self.payload_left -= self.start - start
+            yield self.view[start:self.start]
+
+    def read_frame(self, sock: socket.socket):
+        while True:
+            frame = next(self.frames(), None)
+            if(frame is not None): return frame
+            if(not self.recv_from(sock)): return None
+
+    # Offset of the payload of the PUBLISH at `start` (its variable header starts at i), None until received
+    def __payload_start(self, start: int, i: int, frame_end: int):
+        buffer = self.buffer
+        if(i+2 > self.end): return None
+        i += 2 + (buffer[i] << 8 | buffer[i+1])   # Topic name
+        if(buffer[start] & 0b0110): i += 2         # Packet id
+        props_len = 0; shift = 0
+        while True:
+            if(i >= min(self.end, frame_end)):
+                if(i >= frame_end): raise ValueError("Malformed PUBLISH")
+                return None
+            byte = buffer[i]
+            props_len |= (byte & 127) << shift
+            i += 1
+            if(not byte & 128): break
+            shift += 7
+            if(shift > 21): raise ValueError("Malformed properties length")
+        i += props_len
+        if(i > frame_end): raise ValueError("Malformed PUBLISH")
+        return i if i <= self.end else None
+
+    def __replace_buffer(self, size: int):
+        # Allocate a new buffer rather than resizing, earlier memoryviews keep the old one alive
+        buffer = bytearray(size)
+        pending = self.end - self.start
+        buffer[:pending] = self.view[self.start:self.end]
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.start, self.end = 0, pending
@@ -0,0 +1,129 @@
+# QoS 1 inflight tracking: outgoing PUBLISH packets awaiting PUBACK, keyed by (client_id, packet_id)
+import heapq, threading, time
+
+MAX_BACKOFF = 6                    # The retry interval doubles with each resend, up to 2**MAX_BACKOFF times
+
+
+# One unacknowledged outgoing message
+class InflightMessage:
+    __slots__ = ("client_id", "packet_id", "packet", "deadline", "retries", "on_complete", "expires_at")
+
+    def __init__(self, client_id: str, packet_id: int, packet: tuple, on_complete = None,
+                 expires_at: float | None = None):
+        self.client_id = client_id
+        self.packet_id = packet_id
+        self.packet = packet                       # Encoded PUBLISH as a tuple of buffers, DUP flag set after the first resend
+        self.deadline = None                       # Time at which the packet is resent, None until the copy is written
+        self.retries = 0
+        self.on_complete = on_complete             # Called as on_complete(client_id, packet_id, delivered)
+        self.expires_at = expires_at               # Message Expiry deadline: given up instead of resent after it
+
+
+class InflightTable:
+    '''
+    Table of QoS 1 messages sent but not yet acknowledged:
+    table.next_packet_id(client_id): allocates a packet id not in use for that client.
+    table.add(client_id, packet_id, packet, on_complete, expires_at): starts tracking a packet, returns its message.
+    table.sent(message): starts the retransmission timer once the copy has left the outbound queue, so messages
+        still waiting behind a slow socket are never resent.
+    table.ack(client_id, packet_id): completes a message when its PUBACK arrives.
+    table.expired(now): returns messages due for retransmission (with DUP set), their timers start again when
+        the new copy is written, each time twice as long; messages past their expires_at are abandoned instead.
+    table.drop_client(client_id): forgets every message for a client.
+    '''
+
+    def __init__(self, retry_interval: float = 5.0, max_retries: int | None = None):
+        self.retry_interval = retry_interval
+        self.max_retries = max_retries             # None: retry for as long as the client stays connected
+        self.messages: dict[tuple[str, int], InflightMessage] = dict()
+        self.by_client: dict[str, set[int]] = dict()       # Maps client_id -> packet ids in flight
+        self.last_packet_id: dict[str, int] = dict()       # Maps client_id -> last packet id handed out
+        self.deadlines: list[tuple[float, int, InflightMessage]] = []  # Heap of retransmission timers
+        self.seq = 0                                        # Tie breaker for heap entries
+        self.lock = threading.Lock()
+
+    def next_packet_id(self, client_id: str):
+        with self.lock:
+            in_use = self.by_client.get(client_id, ())
+            if(len(in_use) >= 65535):
+                return None                                 # Every packet id is taken
+            packet_id = self.last_packet_id.get(client_id, 0)
+            while True:
+                packet_id = packet_id % 65535 + 1           # Packet ids run 1..65535
+                if(packet_id not in in_use): break
+            self.last_packet_id[client_id] = packet_id
+            return packet_id
+
+    def add(self, client_id: str, packet_id: int, packet: tuple, on_complete = None, expires_at: float | None = None):
+        with self.lock:
+            message = InflightMessage(client_id, packet_id, packet, on_complete, expires_at)
+            self.messages[(client_id, packet_id)] = message
+            self.by_client.setdefault(client_id, set()).add(packet_id)
+        return message
+
+    def sent(self, message: InflightMessage):
+        with self.lock:
+            # Ignore copies of messages acknowledged in the meantime
+            if(message.deadline is not None or self.messages.get((message.client_id, message.packet_id)) is not message):
+                return
+            message.deadline = time.time() + self.retry_interval * 2**min(message.retries, MAX_BACKOFF)
+            self.__arm(message)
+
+    def ack(self, client_id: str, packet_id: int):
+        with self.lock:
+            message = self.__pop(client_id, packet_id)
+        if(message is None): return False
+        if(message.on_complete): message.on_complete(client_id, packet_id, True)
+        return True
+
+    def expired(self, now: float):
+        due = []
+        failed = []
+        with self.lock:
+            while self.deadlines and self.deadlines[0][0] <= now:
+                deadline, _, message = heapq.heappop(self.deadlines)
+                # Skip timers for messages that were acknowledged since
+                if(self.messages.get((message.client_id, message.packet_id)) is not message
+                   or message.deadline != deadline):
+                    continue
+                if((self.max_retries is not None and message.retries >= self.max_retries)
+                   or (message.expires_at is not None and message.expires_at <= now)):
+                    self.__pop(message.client_id, message.packet_id)
+                    failed.append(message)
+                    continue
+                if(not message.retries):
+                    # Set DUP on resend, only the buffer holding the fixed header is copied
+                    head = message.packet[0]
+                    message.packet = (bytes([head[0] | 0x08]) + head[1:],) + message.packet[1:]
+                message.retries += 1
+                message.deadline = None
+                due.append(message)
+        for message in failed:
+            if(message.on_complete): message.on_complete(message.client_id, message.packet_id, False)
+        return due
+
+    def next_deadline(self):
+        return self.deadlines[0][0] if self.deadlines else None
+
+    def drop_client(self, client_id: str):
+        with self.lock:
+            self.last_packet_id.pop(client_id, None)
+            dropped = [self.__pop(client_id, packet_id) for packet_id in list(self.by_client.get(client_id, ()))]
+        for message in dropped:
+            if(message.on_complete): message.on_complete(client_id, message.packet_id, False)
+
+    def count(self, client_id: str | None = None):
+        if(client_id is None): return len(self.messages)
+        return len(self.by_client.get(client_id, ()))
+
+    def __arm(self, message: InflightMessage):
+        self.seq += 1
+        heapq.heappush(self.deadlines, (message.deadline, self.seq, message))
+
+    def __pop(self, client_id: str, packet_id: int):
+        message = self.messages.pop((client_id, packet_id), None)
+        if(message is not None):
+            packet_ids = self.by_client[client_id]
+            packet_ids.discard(packet_id)
+            if(not packet_ids): self.by_client.pop(client_id)
+        return message
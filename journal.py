@@ -0,0 +1,168 @@
+# Segmented append-only journal with group-commit fsync, used to persist broker sessions
+import os, struct, threading, time, zlib
+
+RECORD_HEADER = struct.Struct(">II")       # Record length, CRC32 of the record
+SEGMENT_SUFFIX = ".log"
+CHECKPOINT = b"K"                          # First record of a compacted segment: everything before it is obsolete
+
+
+class Journal:
+    '''
+    Append-only log split into numbered segment files:
+    journal.append(record): queues a record, returns its sequence number. A flusher thread writes everything
+        queued in one write and one fsync (group commit); records appended while an fsync runs join the next one.
+    journal.wait(seq): blocks until the record with that sequence number is on disk.
+    journal.replay(): yields every record since the last checkpoint, stopping at a torn or corrupt tail.
+    journal.rotate() / journal.checkpoint(segment, records): compaction, see checkpoint().
+    journal.close(): commits what is queued and stops the flusher.
+    '''
+
+    def __init__(self, directory: str, segment_size: int = 16 << 20, commit_interval: float = 0.0):
+        self.directory = directory
+        self.segment_size = segment_size           # Start a new segment once the active one is this large
+        self.commit_interval = commit_interval     # Extra wait before each commit to batch more records (trades latency)
+        os.makedirs(directory, exist_ok=True)
+
+        self.pending: list[bytes] = []             # Framed records not yet written
+        self.appended = 0                          # Sequence number of the last appended record
+        self.committed = 0                         # Sequence number of the last record on disk
+        self.lock = threading.Lock()               # Guards pending and the sequence numbers
+        self.committed_cond = threading.Condition(self.lock)
+        self.io_lock = threading.Lock()            # Serialises writes to the segment files, taken before lock
+
+        # Counters
+        self.bytes_appended = 0
+        self.bytes_written = 0
+        self.commits = 0                           # fsync calls
+
+        # Remove leftovers of an interrupted checkpoint, reopen after the newest segment
+        for name in os.listdir(directory):
+            if(name.endswith(".tmp")): os.remove(os.path.join(directory, name))
+        segments = self.__segments()
+        self.active_id = segments[-1] + 1 if segments else 1
+        self.active = open(self.__path(self.active_id), "ab")
+        self.active_size = 0
+        self.closed = False
+        self.flusher = threading.Thread(target=self.__flush_loop, daemon=True)
+        self.flusher.start()
+
+    def append(self, record: bytes):
+        framed = RECORD_HEADER.pack(len(record), zlib.crc32(record)) + record
+        with self.lock:
+            self.pending.append(framed)
+            self.appended += 1
+            self.bytes_appended += len(framed)
+            if(len(self.pending) == 1): self.committed_cond.notify_all()   # Wake the flusher
+            return self.appended
+
+    def wait(self, seq: int):
+        with self.lock:
+            while self.committed < seq and not self.closed:
+                self.committed_cond.wait()
+
+    def replay(self):
+        segments = self.__segments()
+        # Start from the newest checkpoint; older segments were superseded by it
+        start = 0
+        for i, segment_id in enumerate(segments):
+            with open(self.__path(segment_id), "rb") as segment:
+                header = segment.read(RECORD_HEADER.size)
+                if(len(header) == RECORD_HEADER.size and segment.read(RECORD_HEADER.unpack(header)[0]) == CHECKPOINT):
+                    start = i
+        for segment_id in segments[:start]:
+            os.remove(self.__path(segment_id))
+
+        for segment_id in segments[start:]:
+            with open(self.__path(segment_id), "rb") as segment:
+                data = segment.read()
+            i = 0
+            while i + RECORD_HEADER.size <= len(data):
+                length, crc = RECORD_HEADER.unpack_from(data, i)
+                record = data[i+RECORD_HEADER.size:i+RECORD_HEADER.size+length]
+                if(len(record) < length or zlib.crc32(record) != crc):
+                    break                          # Torn write at the tail of a segment
+                i += RECORD_HEADER.size + length
+                if(record != CHECKPOINT): yield record
+
+    # Compaction, step 1: commit what is queued and switch to a fresh segment. Returns the id reserved for
+    # the checkpoint; the caller must capture its live state at the same moment (under its own lock).
+    def rotate(self):
+        with self.io_lock:
+            self.__commit()
+            self.active.close()
+            checkpoint_id = self.active_id + 1
+            self.active_id = checkpoint_id + 1
+            self.active = open(self.__path(self.active_id), "ab")
+            self.active_size = 0
+        return checkpoint_id
+
+    # Compaction, step 2: write the live state as segment `checkpoint_id` and delete the segments before it.
+    # Records appended since rotate() live in later segments, so nothing is lost if we crash half way.
+    def checkpoint(self, checkpoint_id: int, records):
+        temp_path = self.__path(checkpoint_id) + ".tmp"
+        with open(temp_path, "wb") as segment:
+            for record in [CHECKPOINT, *records]:
+                segment.write(RECORD_HEADER.pack(len(record), zlib.crc32(record)) + record)
+            segment.flush()
+            os.fsync(segment.fileno())
+        os.replace(temp_path, self.__path(checkpoint_id))
+        self.__sync_directory()
+        for segment_id in self.__segments():
+            if(segment_id < checkpoint_id): os.remove(self.__path(segment_id))
+
+    def close(self):
+        with self.io_lock:
+            self.__commit()
+            self.active.close()
+            with self.lock:
+                self.closed = True
+                self.committed_cond.notify_all()
+
+    # Flusher thread: one write and one fsync for everything appended since the last commit
+    def __flush_loop(self):
+        while True:
+            with self.lock:
+                while not self.pending and not self.closed:
+                    self.committed_cond.wait()
+                if(self.closed): return
+            if(self.commit_interval):
+                time.sleep(self.commit_interval)   # Let more appends join this commit
+            with self.io_lock:
+                if(self.closed): return
+                self.__commit()
+
+    # Write and fsync the queued records (io_lock held)
+    def __commit(self):
+        with self.lock:
+            batch, self.pending = self.pending, []
+            seq = self.appended
+        if(batch):
+            data = b"".join(batch)
+            self.active.write(data)
+            self.active.flush()
+            os.fsync(self.active.fileno())
+            self.active_size += len(data)
+            self.bytes_written += len(data)
+            self.commits += 1
+        with self.lock:
+            self.committed = seq
+            self.committed_cond.notify_all()
+        if(self.active_size >= self.segment_size):
+            self.active.close()
+            self.active_id += 1
+            self.active = open(self.__path(self.active_id), "ab")
+            self.active_size = 0
+
+    def __segments(self):
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def __path(self, segment_id: int):
+        return os.path.join(self.directory, f"{segment_id:08d}{SEGMENT_SUFFIX}")
+
+    def __sync_directory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
@@ -0,0 +1,143 @@
+# Broker metrics: plain counters and fixed-bucket histograms, cheap enough to update on the hot path
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)   # Seconds
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)                                   # Subscribers
+
+
+# A Prometheus label value: backslash, double quote and line feed escaped
+def label_value(value: str):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Histogram:
+    '''
+    Fixed-bucket histogram:
+    histogram.observe(value): counts a value in the first bucket whose upper bound is >= value.
+    histogram.quantile(q): upper bound of the bucket holding the q-th quantile (an estimate).
+    '''
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.counts = [0]*(len(bounds)+1)          # Last bucket is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float):
+        if(not self.count): return 0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if(seen >= rank): return bound
+        return float("inf")
+
+    def render(self, name: str):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum {self.sum}")
+        lines.append(f"{name}_count {self.count}")
+        return lines
+
+
+class BrokerMetrics:
+    '''
+    Counters and histograms updated by the broker as it works; gauges (connected clients, queue depths...)
+    are read from the broker when a snapshot is taken:
+    metrics.render(gauges, client_queues): Prometheus text exposition format; client_queues ({client_id: stats},
+        see CLIENT_QUEUE_SERIES) adds one series per client labelled with its client id.
+    metrics.serve(port, gauges_func, client_queues_func): HTTP endpoint on 127.0.0.1 answering every GET with
+        render().
+    Updates are plain integer increments without a lock; under the threaded engine a concurrent update can
+    occasionally be lost, which is fine for monitoring.
+    '''
+
+    COUNTERS = {
+        "messages_received": "PUBLISH packets received",
+        "messages_sent": "PUBLISH copies routed to subscribers",
+        "bytes_received": "Bytes read from client sockets",
+        "bytes_sent": "Bytes written to client sockets",
+        "connections": "Accepted CONNECT packets",
+        "connections_rejected": "CONNECT packets refused by the connection rate limit",
+        "handshake_timeouts": "Connections closed for not sending CONNECT in time",
+        "socket_reads": "recv calls on client sockets that returned data",
+        "socket_writes": "sendmsg calls on client sockets",
+        "publishes_streamed": "PUBLISH packets forwarded in chunks while their payload arrived",
+    }
+
+    CLIENT_QUEUE_SERIES = {                                 # Stat: (metric type, help)
+        "messages": ("gauge", "Packets waiting in the client's outbound queue"),
+        "bytes": ("gauge", "Bytes waiting in the client's outbound queue"),
+        "high_water": ("gauge", "Deepest the client's outbound queue has been, in packets"),
+        "enqueued": ("counter", "Packets queued for the client"),
+        "dropped": ("counter", "Packets dropped by the client's outbound queue overflow"),
+        "conflated": ("counter", "Packets replaced by a newer one with the same conflation key"),
+    }
+
+    def __init__(self):
+        self.messages_received = 0
+        self.messages_sent = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.connections = 0
+        self.connections_rejected = 0
+        self.handshake_timeouts = 0
+        self.socket_reads = 0
+        self.socket_writes = 0
+        self.publishes_streamed = 0
+        self.fanout = Histogram(FANOUT_BUCKETS)            # Subscribers per received PUBLISH
+        self.latency = Histogram(LATENCY_BUCKETS)          # Seconds from reading a PUBLISH to queueing every copy
+        self.server = None
+
+    def render(self, gauges: dict[str, tuple[str, float]], client_queues: dict[str, dict[str, int]] | None = None):
+        lines = []
+        for name, help_text in self.COUNTERS.items():
+            lines += [f"# HELP mqtt_{name}_total {help_text}", f"# TYPE mqtt_{name}_total counter",
+                      f"mqtt_{name}_total {getattr(self, name)}"]
+        for name, (help_text, value) in gauges.items():
+            lines += [f"# HELP mqtt_{name} {help_text}", f"# TYPE mqtt_{name} gauge", f"mqtt_{name} {value}"]
+        for name, help_text, histogram in (("publish_fanout", "Subscribers per received PUBLISH", self.fanout),
+                                           ("publish_forward_latency_seconds",
+                                            "Time from reading a PUBLISH to queueing it for every subscriber",
+                                            self.latency)):
+            lines += [f"# HELP mqtt_{name} {help_text}", f"# TYPE mqtt_{name} histogram", *histogram.render(f"mqtt_{name}")]
+        if(client_queues is not None):
+            labels = {client_id: label_value(client_id) for client_id in client_queues}
+            for stat, (kind, help_text) in self.CLIENT_QUEUE_SERIES.items():
+                name = f"mqtt_client_queue_{stat}_total" if kind == "counter" else f"mqtt_client_queue_{stat}"
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+                lines += [f'{name}{{client_id="{labels[client_id]}"}} {stats[stat]}'
+                          for client_id, stats in client_queues.items()]
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, gauges_func, client_queues_func=None):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                client_queues = client_queues_func() if client_queues_func else None
+                body = metrics.render(gauges_func(), client_queues).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass                                        # Scrapes are not worth a line each
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server
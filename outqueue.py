@@ -0,0 +1,247 @@
+# Bounded per-client outbound queue drained by the broker's I/O layer
+import threading, time
+from collections import deque
+
+# Overflow policies
+DROP_OLDEST = "drop-oldest"        # Make room by discarding the oldest queued message
+DROP_NEWEST = "drop-newest"        # Discard the message being queued
+DISCONNECT = "disconnect"          # Give up on the client
+POLICIES = (DROP_OLDEST, DROP_NEWEST, DISCONNECT)
+
+MAX_IOV = 512                      # Buffers handed to one sendmsg call
+
+
+class OutboundQueue:
+    '''
+    Queue of encoded packets waiting to be written to one client:
+    queue.put(data, droppable, conflate_key, expires_at, on_dequeued): queues a packet (bytes, or a tuple of buffers
+        written back to back), applying the overflow policy. Returns False when the client should be disconnected.
+        With a conflate_key, a pending packet with the same key is replaced in place instead of queueing another one.
+        With expires_at (a time.time() value), the packet is discarded if it is still waiting at that time.
+        on_dequeued() is called once the packet leaves the queue, written or discarded.
+    queue.pending(): buffers ready for sock.sendmsg, first one trimmed by what was already written.
+    queue.consume(sent): removes sent bytes from the front of the queue.
+    queue.wait_pending(): blocks until something is queued (threaded engine writer threads).
+    queue.open_stream(head, size): queues a packet of `size` bytes of which only `head` is known yet, returns its
+        entry for queue.feed_stream(entry, chunk) to append the rest as it arrives. Nothing queued after it is
+        written before it is complete, and its buffers are released as soon as they are written.
+    queue.wait_below(max_bytes, timeout): blocks until at most max_bytes are queued, False on timeout.
+    Limits only apply to droppable packets; control packets such as CONNACK and PUBACK are always queued.
+    '''
+
+    def __init__(self, max_messages: int = 1000, max_bytes: int = 1 << 20, policy: str = DROP_OLDEST):
+        assert policy in POLICIES
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.policy = policy
+
+        # Entries are [buffers, size, droppable, conflate_key, expires_at, missing, on_dequeued]; missing counts the
+        # bytes of a streamed packet still to come, its size only what has been fed so far
+        self.items: deque[list] = deque()
+        self.latest: dict[str, list] = dict()      # Maps conflate_key -> pending entry that can still be replaced
+        self.offset = 0                            # Bytes of the head entry already written
+        self.bytes = 0                             # Bytes queued, including the written part of the head
+        self.next_expiry = None                    # Earliest expires_at among queued entries, if any
+        self.closed = False
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.drained = threading.Condition(self.lock)  # Notified as written bytes leave the queue
+        self.waiting = 0                               # Threads in wait_below
+        self.dequeued = []                             # on_dequeued callbacks to run once the lock is released
+
+        # Counters
+        self.enqueued = 0
+        self.dropped = 0
+        self.high_water = 0                        # Largest depth (messages) seen
+        self.conflated = 0                         # Packets replaced by a newer one with the same key
+        self.expired = 0                           # Packets discarded unsent after their Message Expiry Interval
+
+    def put(self, data: bytes | tuple, droppable: bool = True, conflate_key: str | None = None,
+            expires_at: float | None = None, on_dequeued = None):
+        buffers = data if isinstance(data, tuple) else (data,)
+        size = sum(map(len, buffers))
+        with self.lock:
+            if(self.closed): return True
+            queued = self.__put(buffers, size, droppable, conflate_key, expires_at, on_dequeued)
+            dequeued = self.__take_dequeued()
+        for callback in dequeued: callback()
+        return queued
+
+    def pending(self):
+        with self.lock:
+            if(self.next_expiry is not None and time.time() >= self.next_expiry):
+                self.__discard_expired(time.time())
+            dequeued = self.__take_dequeued()
+            buffers = []
+            skip = self.offset                     # Already written part of the head entry
+            for entry in self.items:
+                for buffer in entry[0]:
+                    if(skip >= len(buffer)):
+                        skip -= len(buffer)
+                        continue
+                    buffers.append(memoryview(buffer)[skip:] if skip else buffer)
+                    skip = 0
+                self.__forget(entry)               # Being written now, no longer replaceable
+                if(entry[5] or len(buffers) >= MAX_IOV): break   # The rest of a stream goes first
+        for callback in dequeued: callback()
+        return buffers
+
+    def consume(self, sent: int):
+        with self.lock:
+            sent += self.offset
+            while self.items and sent >= self.items[0][1] and not self.items[0][5]:
+                entry = self.items.popleft()
+                sent -= entry[1]
+                self.bytes -= entry[1]
+                self.__forget(entry)
+                if(entry[6]): self.dequeued.append(entry[6])
+            self.offset = sent if self.items else 0
+            if(self.offset and self.items[0][5]):
+                self.__release_written(self.items[0])
+            if(self.waiting): self.drained.notify_all()
+            dequeued = self.__take_dequeued()
+        for callback in dequeued: callback()
+
+    def wait_pending(self, timeout: float | None = None):
+        with self.ready:
+            while not self.writable() and not self.closed:
+                if(not self.ready.wait(timeout)): break
+            return not self.closed
+
+    # Whether pending() has anything to hand out: not the case while a stream waits for its next chunk
+    def writable(self):
+        return bool(self.items) and not (self.items[0][5] and self.offset >= self.items[0][1])
+
+    def open_stream(self, head: bytes, size: int):
+        with self.lock:
+            if(self.closed): return None
+            return self.__append([head], len(head), False, None, None, size - len(head), None)
+
+    def feed_stream(self, entry: list, chunk: bytes):
+        with self.lock:
+            if(self.closed): return
+            entry[0].append(chunk)
+            entry[1] += len(chunk)
+            entry[5] -= len(chunk)
+            self.bytes += len(chunk)
+            if(entry is self.items[0]): self.ready.notify()
+
+    def wait_below(self, max_bytes: int, timeout: float):
+        with self.drained:
+            self.waiting += 1
+            try:
+                return self.drained.wait_for(lambda: self.bytes <= max_bytes or self.closed, timeout)
+            finally:
+                self.waiting -= 1
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.items.clear()
+            self.latest.clear()
+            self.bytes = 0
+            self.next_expiry = None
+            self.ready.notify_all()
+            self.drained.notify_all()
+
+    def __len__(self):
+        return len(self.items)
+
+    # Overflow policy and conflation for put, called with the lock held
+    def __put(self, buffers: tuple, size: int, droppable: bool, conflate_key: str | None, expires_at: float | None,
+              on_dequeued):
+        # Replace the pending packet for this key, unless it has already been handed to a write
+        if(conflate_key is not None):
+            entry = self.latest.get(conflate_key)
+            if(entry is not None):
+                self.bytes += size - entry[1]
+                entry[0] = buffers
+                entry[1] = size
+                entry[4] = expires_at
+                if(entry[6]): self.dequeued.append(entry[6])       # The replaced packet is never written
+                entry[6] = on_dequeued
+                if(expires_at is not None): self.__track_expiry(expires_at)
+                self.conflated += 1
+                return True
+
+        if(droppable and (len(self.items) >= self.max_messages or self.bytes+size > self.max_bytes)):
+            if(self.policy == DISCONNECT):
+                return False
+            if(self.policy == DROP_NEWEST or not self.__drop_oldest(size)):
+                self.dropped += 1
+                if(on_dequeued): self.dequeued.append(on_dequeued)
+                return True
+        self.__append(buffers, size, droppable, conflate_key, expires_at, 0, on_dequeued)
+        return True
+
+    def __append(self, buffers: tuple | list, size: int, droppable: bool, conflate_key: str | None,
+                 expires_at: float | None, missing: int, on_dequeued):
+        entry = [buffers, size, droppable, conflate_key, expires_at, missing, on_dequeued]
+        self.items.append(entry)
+        if(conflate_key is not None):
+            self.latest[conflate_key] = entry
+        if(expires_at is not None):
+            self.__track_expiry(expires_at)
+        self.bytes += size
+        self.enqueued += 1
+        self.high_water = max(self.high_water, len(self.items))
+        if(len(self.items) == 1): self.ready.notify()
+        return entry
+
+    # Discard droppable entries from the front until `size` more bytes fit; the partly written head is kept
+    def __drop_oldest(self, size: int):
+        i = 1 if self.offset else 0
+        while len(self.items) >= self.max_messages or self.bytes+size > self.max_bytes:
+            while i < len(self.items) and not self.items[i][2]:
+                i += 1
+            if(i >= len(self.items)): return False
+            entry = self.items[i]
+            del self.items[i]
+            self.bytes -= entry[1]
+            self.dropped += 1
+            self.__forget(entry)
+            if(entry[6]): self.dequeued.append(entry[6])
+        return True
+
+    # A stream still arriving gives back the buffers already written, so it never holds its whole packet
+    def __release_written(self, entry: list):
+        buffers = entry[0]
+        written = 0
+        while written < len(buffers) and self.offset >= len(buffers[written]):
+            self.offset -= len(buffers[written])
+            entry[1] -= len(buffers[written])
+            self.bytes -= len(buffers[written])
+            written += 1
+        del buffers[:written]
+
+    def __track_expiry(self, expires_at: float):
+        if(self.next_expiry is None or expires_at < self.next_expiry):
+            self.next_expiry = expires_at
+
+    # Remove expired entries before they are written; the partly written head has to go out whole.
+    # Only runs once the earliest deadline has passed, so queues without expiring packets never scan.
+    def __discard_expired(self, now: float):
+        kept = deque()
+        self.next_expiry = None
+        for i, entry in enumerate(self.items):
+            expires_at = entry[4]
+            if(expires_at is not None and expires_at <= now and (i or not self.offset)):
+                self.bytes -= entry[1]
+                self.expired += 1
+                self.__forget(entry)
+                if(entry[6]): self.dequeued.append(entry[6])
+                continue
+            if(expires_at is not None): self.__track_expiry(expires_at)
+            kept.append(entry)
+        self.items = kept
+
+    # Callbacks of entries that left the queue, run by the caller after releasing the lock
+    def __take_dequeued(self):
+        dequeued = self.dequeued
+        if(dequeued): self.dequeued = []
+        return dequeued
+
+    # Stop tracking an entry for conflation once it leaves the queue or is handed to a write
+    def __forget(self, entry: list):
+        if(entry[3] is not None and self.latest.get(entry[3]) is entry):
+            del self.latest[entry[3]]
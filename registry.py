@@ -0,0 +1,69 @@
+# Registry of connected clients: everything the broker keeps for one network connection, in one object
+import threading
+from collections import deque
+
+
+# Connection state of one client. What outlives the connection (persistent subscriptions, messages queued
+# while offline) is in sessions.Session; this is created by CONNECT and dropped with the connection.
+class ClientSession:
+    __slots__ = ("client_id", "sock", "queue", "conn", "subs", "inbound_aliases", "alias_maximum",
+                 "outbound_aliases", "receive_window", "send_window", "held", "stream")
+
+    def __init__(self, client_id: str, sock, queue, conn = None):
+        self.client_id = client_id
+        self.sock = sock                                        # Client socket
+        self.queue = queue                                      # OutboundQueue of packets waiting to be written
+        self.conn = conn                                        # Selector engine Connection, None when threaded
+        self.subs: set[str] = set()                             # Topic filters this client is subscribed to
+        self.inbound_aliases: dict[int, str] = dict()           # Topic aliases the client defined, alias -> topic
+        self.alias_maximum = 0                                  # Client's Topic Alias Maximum, 0: none towards it
+        self.outbound_aliases: dict[str, int] = dict()          # Topic aliases we defined, topic -> alias
+        self.receive_window: threading.Semaphore | None = None  # Free slots of our Receive Maximum (threaded engine)
+        self.send_window: int | None = None                     # Client's Receive Maximum, None if it sent none
+        self.held: deque | None = None                          # QoS 1 deliveries waiting for a slot of send_window
+        self.stream = None                                      # broker.PublishStream being received from the client
+
+
+class SessionRegistry:
+    '''
+    Connected clients keyed by client id, spread over `shards` dicts with a lock each, so connects and
+    disconnects landing on different shards never wait for each other:
+    registry.add(session): registers a session, returns False if its client id is already connected.
+    registry.get(client_id): the client's session or None; a single dict lookup without taking a lock.
+    registry.remove(client_id, session): unregisters and returns the client's session (only if it is `session`,
+        when given), or None; exactly one caller gets the session, so a client is torn down once.
+    registry.sessions(): snapshot of every registered session.
+    '''
+
+    def __init__(self, shards: int = 16):
+        self.shards: list[dict[str, ClientSession]] = [dict() for _ in range(shards)]
+        self.locks = [threading.Lock() for _ in range(shards)]
+
+    def add(self, session: ClientSession):
+        index = hash(session.client_id) % len(self.shards)
+        with self.locks[index]:
+            shard = self.shards[index]
+            if(session.client_id in shard): return False
+            shard[session.client_id] = session
+            return True
+
+    def get(self, client_id: str):
+        return self.shards[hash(client_id) % len(self.shards)].get(client_id)
+
+    def remove(self, client_id: str, session: ClientSession | None = None):
+        index = hash(client_id) % len(self.shards)
+        with self.locks[index]:
+            shard = self.shards[index]
+            current = shard.get(client_id)
+            if(current is None or (session is not None and current is not session)): return None
+            del shard[client_id]
+            return current
+
+    def sessions(self):
+        return [session for shard in self.shards for session in list(shard.values())]
+
+    def __contains__(self, client_id: str):
+        return self.get(client_id) is not None
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
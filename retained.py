@@ -0,0 +1,175 @@
+# Retained message store: the last RETAIN publish per topic, looked up by topic filter on SUBSCRIBE
+import os, threading
+from collections import OrderedDict
+
+# Snapshot records are bare PUBLISH frames, or for expiring messages this tag, the 8 byte expiry time in ms and the
+# frame. PUBLISH frames start with 0x30-0x3F, so the tag cannot be mistaken for one.
+EXPIRING = b"X"
+
+
+# One level of the topic tree
+class RetainedNode:
+    __slots__ = ("children", "message")
+
+    def __init__(self):
+        self.children: dict[str, RetainedNode] = dict()   # Maps next topic level -> node
+        self.message = None                               # Retained message for the topic ending here
+
+
+class RetainedStore:
+    '''
+    Retained messages indexed by topic name:
+    store.set(topic_name, message, size): keeps `message` as the retained message for the topic.
+    store.delete(topic_name): forgets the retained message (a RETAIN publish with an empty payload).
+    store.match(topic_filter): returns the retained messages whose topics match a filter ('+' and '#' allowed).
+    store.save(path) / store.load(path, decode): snapshot to disk as a stream of PUBLISH frames and read it back.
+    Messages are opaque to the store apart from a `frame` attribute holding the encoded PUBLISH and an `expires_at`
+    attribute (time.time() value or None), used by save() so that expiry deadlines survive a restart.
+    With max_messages or max_bytes set, the least recently updated topics are evicted first.
+    '''
+
+    def __init__(self, max_messages: int | None = None, max_bytes: int | None = None):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.root = RetainedNode()
+        self.sizes: OrderedDict[str, int] = OrderedDict()  # Maps topic -> message size, least recently updated first
+        self.bytes = 0
+        self.evicted = 0
+        self.dirty = False                                  # Changed since the last snapshot
+        self.lock = threading.Lock()
+
+    def set(self, topic_name: str, message, size: int):
+        with self.lock:
+            node = self.root
+            for level in topic_name.split('/'):
+                child = node.children.get(level)
+                if(child is None):
+                    child = node.children[level] = RetainedNode()
+                node = child
+            node.message = message
+            self.bytes += size - self.sizes.pop(topic_name, 0)
+            self.sizes[topic_name] = size
+            self.dirty = True
+
+            # Evict the stalest topics until back under the caps (never the one just stored)
+            while(len(self.sizes) > 1 and ((self.max_messages is not None and len(self.sizes) > self.max_messages)
+                                            or (self.max_bytes is not None and self.bytes > self.max_bytes))):
+                oldest = next(iter(self.sizes))
+                self.__remove(oldest)
+                self.evicted += 1
+
+    def delete(self, topic_name: str):
+        with self.lock:
+            if(topic_name in self.sizes):
+                self.__remove(topic_name)
+                self.dirty = True
+
+    def get(self, topic_name: str):
+        node = self.root
+        for level in topic_name.split('/'):
+            node = node.children.get(level)
+            if(node is None): return None
+        return node.message
+
+    def match(self, topic_filter: str):
+        levels = topic_filter.split('/')
+        depth = len(levels)
+        matched = []
+        with self.lock:
+            stack = [(self.root, 0)]
+            while stack:
+                node, i = stack.pop()
+                if(i == depth):
+                    if(node.message is not None): matched.append(node.message)
+                    continue
+                level = levels[i]
+                if(level == '#'):
+                    # '#' matches the parent level and everything below it
+                    if(node.message is not None and i): matched.append(node.message)
+                    self.__collect(node, i == 0, matched)
+                elif(level == '+'):
+                    for name, child in node.children.items():
+                        if(i == 0 and name.startswith('$')): continue    # Wildcards do not match '$' topics
+                        stack.append((child, i+1))
+                else:
+                    child = node.children.get(level)
+                    if(child is not None):
+                        stack.append((child, i+1))
+        return matched
+
+    def save(self, path: str):
+        # Write to a temporary file and rename it so a crash never leaves a half written snapshot
+        with self.lock:
+            records = [(message.frame, message.expires_at) for message in self.__messages()]
+            self.dirty = False
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as snapshot:
+            for frame, expires_at in records:
+                if(expires_at is not None):
+                    snapshot.write(EXPIRING + int(expires_at*1000).to_bytes(8))
+                snapshot.write(frame)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temp_path, path)
+        return len(records)
+
+    # Read a snapshot back; decode(frame, expires_at) turns each PUBLISH frame into (topic_name, message, size),
+    # expires_at is None for frames saved without an expiry time
+    def load(self, path: str, decode):
+        if(not os.path.exists(path)): return 0
+        with open(path, "rb") as snapshot:
+            data = snapshot.read()
+        loaded = 0; i = 0
+        while i < len(data):
+            expires_at = None
+            if(data[i:i+1] == EXPIRING):
+                if(i+9 >= len(data)): raise ValueError(f"Truncated retained snapshot {path}")
+                expires_at = int.from_bytes(data[i+1:i+9]) / 1000
+                i += 9
+            # Frame length from the remaining length field
+            j = i+1; packet_len = 0; shift = 0
+            while True:
+                if(j >= len(data)): raise ValueError(f"Truncated retained snapshot {path}")
+                packet_len |= (data[j] & 127) << shift
+                shift += 7
+                j += 1
+                if(not data[j-1] & 128): break
+            if(j+packet_len > len(data)): raise ValueError(f"Truncated retained snapshot {path}")
+            self.set(*decode(data[i:j+packet_len], expires_at))
+            i = j+packet_len
+            loaded += 1
+        self.dirty = False
+        return loaded
+
+    def __len__(self):
+        return len(self.sizes)
+
+    # Every message at or below a node; the top level skips '$' topics
+    def __collect(self, node: RetainedNode, top: bool, matched: list):
+        stack = [(name, child) for name, child in node.children.items() if not (top and name.startswith('$'))]
+        while stack:
+            _, child = stack.pop()
+            if(child.message is not None): matched.append(child.message)
+            stack.extend(child.children.items())
+
+    def __messages(self):
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if(node.message is not None): yield node.message
+            stack.extend(node.children.values())
+
+    def __remove(self, topic_name: str):
+        self.bytes -= self.sizes.pop(topic_name)
+        path = []
+        node = self.root
+        for level in topic_name.split('/'):
+            path.append((node, level))
+            node = node.children[level]
+        node.message = None
+
+        # Prune empty branches
+        for parent, level in reversed(path):
+            child = parent.children[level]
+            if(child.message is not None or child.children): break
+            del parent.children[level]
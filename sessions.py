@@ -0,0 +1,261 @@
+# Persistent MQTT sessions (Clean Start = 0): subscriptions and undelivered QoS 1 messages per client
+import threading, time
+from collections import OrderedDict
+from journal import Journal
+from timerwheel import TimingWheel
+from utils import str_to_bytes, bytes_to_str
+
+SESSION_EXPIRY = 24 * 3600  # Default longest a session outlives its client's connection, seconds
+
+# Journal record types
+CREATE = b"C"              # client_id
+END = b"E"                 # client_id: session discarded
+SUB = b"S"                 # client_id, topic filter, 2 byte options
+MESSAGE = b"M"             # client_id, 2 byte packet id, PUBLISH frame
+EXPIRING = b"X"            # client_id, 2 byte packet id, 8 byte expiry time in ms, PUBLISH frame
+ACK = b"A"                 # client_id, 2 byte packet id
+ATTACH = b"T"              # client_id, 4 byte Session Expiry Interval: the client connected
+DETACH = b"D"              # client_id, 8 byte expiry time in ms: the client disconnected
+
+
+# State kept for one client across connections
+class Session:
+    __slots__ = ("client_id", "subs", "messages", "last_packet_id", "expiry_interval", "expires_at")
+
+    def __init__(self, client_id: str, expiry_interval: int):
+        self.client_id = client_id
+        self.subs: dict[str, int] = dict()                      # Maps topic filter -> subscription options
+        self.messages: OrderedDict[int, list] = OrderedDict()  # Maps packet_id -> [PUBLISH frame, sent before,
+                                                                #   Message Expiry time or None]
+        self.last_packet_id = 0
+        self.expiry_interval = expiry_interval                  # Seconds kept after the client disconnects
+        self.expires_at: float | None = None                    # None while the client is connected
+
+    # Packet id for a message queued while the client is offline
+    def next_packet_id(self):
+        if(len(self.messages) >= 65535): return None
+        packet_id = self.last_packet_id
+        while True:
+            packet_id = packet_id % 65535 + 1
+            if(packet_id not in self.messages): break
+        self.last_packet_id = packet_id
+        return packet_id
+
+
+class SessionStore:
+    '''
+    Sessions of clients that connected with Clean Start = 0, journaled so they survive broker restarts:
+    store.open(client_id, expiry_interval): returns (session, present), creating the session if needed. The
+        client's Session Expiry Interval is capped at max_expiry, which also applies when it sent none.
+    store.end(client_id): discards a session (Clean Start = 1 connect), returns it or None.
+    store.detach(client_id, now): the client disconnected; starts its session's expiry timer and returns True,
+        or ends the session at once for an interval of 0 and returns False (also when there is no session).
+    store.expire(now, connected): ends and returns the sessions whose expiry time has passed, skipping those
+        whose client connected(client_id) says is connected again.
+    store.subscribe(client_id, topic_filter, options): records a subscription.
+    store.add_message(client_id, packet_id, frame, sent, expires_at): records a QoS 1 message until it is acknowledged.
+    store.ack(client_id, packet_id): forgets an acknowledged message.
+    store.resume(client_id): the messages to (re)send when the client reconnects, minus the expired ones.
+    Without a directory sessions only survive disconnects. The journal is compacted once
+    compact_bytes have been written since the last checkpoint.
+    '''
+
+    def __init__(self, directory: str | None = None, max_messages: int = 1000, compact_bytes: int = 64 << 20,
+                 commit_interval: float = 0.0, max_expiry: int = SESSION_EXPIRY):
+        self.sessions: dict[str, Session] = dict()
+        self.max_messages = max_messages           # Queued messages per session, oldest dropped beyond this
+        self.max_expiry = max_expiry               # Longest a session is kept after its client disconnects
+        self.expiry = TimingWheel(tick=1.0)        # Maps client_id -> expiry of its detached session
+        self.compact_bytes = compact_bytes
+        self.lock = threading.Lock()
+        self.journal = None
+        self.compacting = False
+        self.checkpoint_bytes = 0                  # journal.bytes_appended at the last compaction
+        self.dropped = 0
+        if(directory):
+            self.journal = Journal(directory, commit_interval=commit_interval)
+            for record in self.journal.replay():
+                self.__apply(record)
+        # No client is connected yet: sessions that had one when the broker stopped count their interval from
+        # now, the others keep their expiry time. Both are bounded by the current max_expiry.
+        now = time.time()
+        for session in self.sessions.values():
+            session.expiry_interval = min(session.expiry_interval, max_expiry)
+            expires_at = min(now + session.expiry_interval, session.expires_at or float("inf"))
+            session.expires_at = None
+            self.__detach(session, expires_at, now)
+
+    def get(self, client_id: str):
+        return self.sessions.get(client_id)
+
+    def open(self, client_id: str, expiry_interval: int | None = None):
+        expiry_interval = self.max_expiry if expiry_interval is None else min(expiry_interval, self.max_expiry)
+        with self.lock:
+            session = self.sessions.get(client_id)
+            present = session is not None
+            if(not present):
+                session = self.sessions[client_id] = Session(client_id, expiry_interval)
+                self.__log(CREATE + str_to_bytes(client_id))
+            self.expiry.cancel(client_id)
+            session.expiry_interval = expiry_interval
+            session.expires_at = None
+            self.__log(ATTACH + str_to_bytes(client_id) + expiry_interval.to_bytes(4))
+            return session, present
+
+    def detach(self, client_id: str, now: float):
+        with self.lock:
+            session = self.sessions.get(client_id)
+            if(session is None): return False
+            if(not session.expiry_interval):
+                del self.sessions[client_id]
+                self.__log(END + str_to_bytes(client_id))
+                return False
+            self.__detach(session, now + session.expiry_interval, now)
+            self.__log(DETACH + str_to_bytes(client_id) + int(session.expires_at*1000).to_bytes(8))
+            return True
+
+    def expire(self, now: float, connected):
+        expired = []
+        for client_id in self.expiry.expire(now):
+            with self.lock:
+                session = self.sessions.get(client_id)
+                if(session is None or session.expires_at is None): continue
+                if(connected(client_id)):
+                    session.expires_at = None                   # Reconnected before its detach was recorded
+                    continue
+                del self.sessions[client_id]
+                self.__log(END + str_to_bytes(client_id))
+                expired.append(session)
+        return expired
+
+    def end(self, client_id: str):
+        with self.lock:
+            session = self.sessions.pop(client_id, None)
+            if(session is not None):
+                self.expiry.cancel(client_id)
+                self.__log(END + str_to_bytes(client_id))
+            return session
+
+    def subscribe(self, client_id: str, topic_filter: str, options: int):
+        with self.lock:
+            session = self.sessions.get(client_id)
+            if(session is None or session.subs.get(topic_filter) == options): return
+            session.subs[topic_filter] = options
+            self.__log(SUB + str_to_bytes(client_id) + str_to_bytes(topic_filter) + options.to_bytes(2))
+
+    def add_message(self, client_id: str, packet_id: int, frame: bytes, sent: bool, expires_at: float | None = None):
+        with self.lock:
+            session = self.sessions.get(client_id)
+            if(session is None): return
+            if(len(session.messages) >= self.max_messages):
+                oldest, _ = session.messages.popitem(last=False)
+                self.__log(ACK + str_to_bytes(client_id) + oldest.to_bytes(2))
+                self.dropped += 1
+            session.messages[packet_id] = [frame, sent, expires_at]
+            self.__log(self.__message_record(str_to_bytes(client_id), packet_id, frame, expires_at))
+
+    def next_packet_id(self, client_id: str):
+        with self.lock:
+            session = self.sessions.get(client_id)
+            return session.next_packet_id() if session is not None else None
+
+    # Messages to send when the client reconnects, as (packet_id, frame, sent before, expires_at); all count as
+    # sent afterwards. Messages whose Message Expiry Interval ran out while the client was away are dropped.
+    def resume(self, client_id: str):
+        with self.lock:
+            session = self.sessions.get(client_id)
+            if(session is None): return []
+            now = time.time()
+            for packet_id in [packet_id for packet_id, entry in session.messages.items()
+                              if entry[2] is not None and entry[2] <= now]:
+                del session.messages[packet_id]
+                self.__log(ACK + str_to_bytes(client_id) + packet_id.to_bytes(2))
+            pending = [(packet_id, entry[0], entry[1], entry[2]) for packet_id, entry in session.messages.items()]
+            for entry in session.messages.values():
+                entry[1] = True
+            return pending
+
+    def ack(self, client_id: str, packet_id: int):
+        with self.lock:
+            session = self.sessions.get(client_id)
+            if(session is None or session.messages.pop(packet_id, None) is None): return
+            self.__log(ACK + str_to_bytes(client_id) + packet_id.to_bytes(2))
+
+    def close(self):
+        if(self.journal): self.journal.close()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    # Start the expiry timer of a session whose client is gone (lock held, or during startup)
+    def __detach(self, session: Session, expires_at: float, now: float):
+        session.expires_at = expires_at
+        self.expiry.schedule(session.client_id, max(0.0, expires_at - now), now)
+
+    # Append a record (lock held) and start a compaction when enough has been written since the last one
+    def __log(self, record: bytes):
+        if(self.journal is None): return
+        self.journal.append(record)
+        if(not self.compacting and self.journal.bytes_appended - self.checkpoint_bytes > self.compact_bytes):
+            self.compacting = True
+            checkpoint_id = self.journal.rotate()
+            records = list(self.__live_records())   # Captured under the lock, consistent with the rotation
+            self.checkpoint_bytes = self.journal.bytes_appended
+            threading.Thread(target=self.__compact, args=(checkpoint_id, records), daemon=True).start()
+
+    def __compact(self, checkpoint_id: int, records: list[bytes]):
+        try:
+            self.journal.checkpoint(checkpoint_id, records)
+        finally:
+            self.compacting = False
+
+    # The records that rebuild the current state
+    def __live_records(self):
+        for client_id, session in self.sessions.items():
+            encoded_id = str_to_bytes(client_id)
+            yield CREATE + encoded_id
+            yield ATTACH + encoded_id + session.expiry_interval.to_bytes(4)
+            for topic_filter, options in session.subs.items():
+                yield SUB + encoded_id + str_to_bytes(topic_filter) + options.to_bytes(2)
+            for packet_id, (frame, _, expires_at) in session.messages.items():
+                yield self.__message_record(encoded_id, packet_id, frame, expires_at)
+            if(session.expires_at is not None):
+                yield DETACH + encoded_id + int(session.expires_at*1000).to_bytes(8)
+
+    @staticmethod
+    def __message_record(encoded_id: bytes, packet_id: int, frame: bytes, expires_at: float | None):
+        if(expires_at is None):
+            return MESSAGE + encoded_id + packet_id.to_bytes(2) + frame
+        return EXPIRING + encoded_id + packet_id.to_bytes(2) + int(expires_at*1000).to_bytes(8) + frame
+
+    # Replay one journal record into memory
+    def __apply(self, record: bytes):
+        kind = record[:1]
+        client_id, id_len = bytes_to_str(record[1:])
+        body = record[3+id_len:]
+        if(kind == CREATE):
+            self.sessions.setdefault(client_id, Session(client_id, self.max_expiry))   # Journals without ATTACH
+            return
+        if(kind == END):
+            self.sessions.pop(client_id, None)
+            return
+        session = self.sessions.get(client_id)
+        if(session is None): return
+        if(kind == SUB):
+            topic_filter, filter_len = bytes_to_str(body)
+            session.subs[topic_filter] = int.from_bytes(body[2+filter_len:4+filter_len])
+        elif(kind == MESSAGE):
+            packet_id = int.from_bytes(body[:2])
+            session.messages[packet_id] = [body[2:], True, None]   # May have been sent before the restart
+            session.last_packet_id = packet_id
+        elif(kind == EXPIRING):
+            packet_id = int.from_bytes(body[:2])
+            session.messages[packet_id] = [body[10:], True, int.from_bytes(body[2:10]) / 1000]
+            session.last_packet_id = packet_id
+        elif(kind == ACK):
+            session.messages.pop(int.from_bytes(body[:2]), None)
+        elif(kind == ATTACH):
+            session.expiry_interval = int.from_bytes(body[:4])
+            session.expires_at = None
+        elif(kind == DETACH):
+            session.expires_at = int.from_bytes(body[:8]) / 1000
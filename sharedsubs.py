@@ -0,0 +1,80 @@
+# Shared subscriptions: "$share/<group>/<filter>" spreads matching messages across the members of a group
+from topictrie import valid_filter
+
+SHARE_PREFIX = "$share/"
+
+# Dispatch policies
+ROUND_ROBIN = "round-robin"        # Members take turns
+LEAST_QUEUE = "least-queue"        # Member with the fewest packets waiting (queued + unacknowledged)
+SHARE_POLICIES = (ROUND_ROBIN, LEAST_QUEUE)
+
+
+# Split "$share/<group>/<filter>" into (group, filter); (None, filter) for an ordinary filter.
+# Raises ValueError for a malformed share name.
+def split_share(topic_filter: str):
+    if(not topic_filter.startswith(SHARE_PREFIX)): return None, topic_filter
+    group, _, inner = topic_filter[len(SHARE_PREFIX):].partition('/')
+    if(not group or '+' in group or '#' in group or not valid_filter(inner)):
+        raise ValueError(f"invalid shared subscription {topic_filter!r}")
+    return group, inner
+
+
+# Members of one shared subscription
+class ShareGroup:
+    __slots__ = ("members", "next")
+
+    def __init__(self):
+        self.members: dict[str, int] = dict()      # Maps client_id -> subscription options, in joining order
+        self.next = 0                              # Round-robin position
+
+
+class SharedSubscriptions:
+    '''
+    Shared subscription groups, keyed by the full "$share/<group>/<filter>" name. The broker's trie holds
+    one entry per group under that key; a match on it is resolved to one member here:
+    shared.join(share_name, client_id, options): adds a member, returns True if the group is new.
+    shared.leave(share_name, client_id): removes a member, returns True if the group is now empty.
+    shared.pick(share_name, online, depth): chooses the member that gets the next message, preferring
+        clients for which online(client_id) is true; depth(client_id) is their backlog for LEAST_QUEUE.
+    Not thread safe, the broker calls it under its topics lock.
+    '''
+
+    def __init__(self, policy: str = ROUND_ROBIN):
+        assert policy in SHARE_POLICIES
+        self.policy = policy
+        self.groups: dict[str, ShareGroup] = dict()
+
+    def join(self, share_name: str, client_id: str, options: int):
+        group = self.groups.get(share_name)
+        new = group is None
+        if(new):
+            group = self.groups[share_name] = ShareGroup()
+        group.members[client_id] = options
+        return new
+
+    def leave(self, share_name: str, client_id: str):
+        group = self.groups.get(share_name)
+        if(group is None or group.members.pop(client_id, None) is None): return False
+        if(group.members): return False
+        del self.groups[share_name]
+        return True
+
+    def pick(self, share_name: str, online, depth):
+        group = self.groups.get(share_name)
+        if(group is None): return None
+        members = list(group.members.items())
+        # Offline members (persistent sessions) only get messages when nobody in the group is connected
+        candidates = [member for member in members if online(member[0])] or members
+
+        if(self.policy == LEAST_QUEUE):
+            # Start the scan at the round-robin position so ties rotate instead of always hitting the first member
+            start = group.next % len(candidates)
+            order = candidates[start:] + candidates[:start]
+            choice = min(order, key=lambda member: depth(member[0]))
+        else:
+            choice = candidates[group.next % len(candidates)]
+        group.next += 1
+        return choice
+
+    def __len__(self):
+        return len(self.groups)
@@ -0,0 +1,97 @@
+# Splitting a TCP byte stream into MQTT packets when reads end in the middle of one
+# Run from the repository root: python -m unittest tests.test_framereader
+import socket, unittest
+from framereader import FrameReader, STREAM_CHUNK
+from MQTTPacket import FixedHeader, MQTTPacket
+from variableheaders import *
+from utils import *
+
+PINGREQ_FRAME = bytes([PINGREQ << 4, 0])
+
+
+def publish(topic_name: str, payload: bytes, flags: int = 0, packet_id: int | None = None):
+    return MQTTPacket(FixedHeader(PUBLISH, flags), PublishVariableHeader(topic_name, payload, packet_id)).encode()
+
+
+class FrameReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sender, self.receiver = socket.socketpair()
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+
+    # Send `data` and read it into the reader, returning the complete frames it now holds (copied)
+    def feed(self, reader: FrameReader, data: bytes):
+        self.sender.sendall(data)
+        received = 0
+        while received < len(data):
+            received += reader.recv_from(self.receiver)
+        return [bytes(frame) for frame in reader.frames()]
+
+    def test_frame_split_across_reads(self):
+        frame = publish("trains/train1", b"x" * 100)
+        reader = FrameReader()
+        self.assertEqual(self.feed(reader, frame[:40]), [])
+        self.assertEqual(self.feed(reader, frame[40:]), [frame])
+
+    def test_every_split_point(self):
+        frames = [publish("a", b"1"), PINGREQ_FRAME, publish("trains/train2", b"y" * 300, 0b0010, 7)]
+        stream = b"".join(frames)
+        for cut in range(1, len(stream)):
+            reader = FrameReader(size=16)                       # Small, so the buffer grows for the long frame
+            got = self.feed(reader, stream[:cut]) + self.feed(reader, stream[cut:])
+            self.assertEqual(got, frames, cut)
+
+    def test_remaining_length_split_between_its_bytes(self):
+        frame = publish("t", b"z" * 20000)                      # Three byte remaining length
+        self.assertEqual(frame[1] & 128 and frame[2] & 128, 128)
+        reader = FrameReader()
+        self.assertEqual(self.feed(reader, frame[:2]), [])
+        self.assertEqual(self.feed(reader, frame[2:3]), [])
+        self.assertEqual(self.feed(reader, frame[3:]), [frame])
+
+    def test_several_frames_in_one_read(self):
+        frames = [publish(f"t/{i}", bytes([i])) for i in range(50)]
+        self.assertEqual(self.feed(FrameReader(), b"".join(frames)), frames)
+
+    def test_buffer_shrinks_back_after_a_large_frame(self):
+        reader = FrameReader(size=64)
+        frame = publish("big", b"b" * 5000)
+        self.assertEqual(self.feed(reader, frame), [frame])
+        self.assertGreater(len(reader.buffer), 64)
+        self.feed(reader, PINGREQ_FRAME)
+        self.assertEqual(len(reader.buffer), 64)
+
+    def test_streamed_payload_split_across_reads(self):
+        payload = bytes(range(256)) * 40
+        frame = publish("firmware/train1", payload, 0b0010, 9)
+        reader = FrameReader(stream_threshold=1000)
+        head_len = len(frame) - len(payload)
+        heads = self.feed(reader, frame[:head_len - 3])
+        self.assertEqual(heads, [])                             # Head not complete yet
+        heads = self.feed(reader, frame[head_len - 3:head_len + 500])
+        self.assertEqual(heads, [frame[:head_len]])
+        self.assertEqual(reader.payload_left, len(payload))
+        received = b"".join(bytes(chunk) for chunk in reader.payload())
+        self.sender.sendall(frame[head_len + 500:])
+        while reader.payload_left:
+            reader.recv_from(self.receiver)
+            received += b"".join(bytes(chunk) for chunk in reader.payload())
+            self.assertEqual(list(reader.frames()), [])         # Nothing else until the payload is through
+        self.assertEqual(received, payload)
+        self.assertLessEqual(len(reader.buffer), STREAM_CHUNK)
+        self.assertEqual(reader.payload_left, 0)
+        self.assertEqual(self.feed(reader, PINGREQ_FRAME), [PINGREQ_FRAME])
+
+    def test_malformed_remaining_length(self):
+        reader = FrameReader()
+        self.sender.sendall(bytes([0x30, 0xff, 0xff, 0xff, 0xff, 0x01]))
+        reader.recv_from(self.receiver)
+        with self.assertRaises(ValueError):
+            list(reader.frames())
+
+
+if(__name__ == "__main__"):
+    unittest.main()
@@ -0,0 +1,107 @@
+# Retransmission timers of unacknowledged QoS 1 messages: armed once written, doubled on each resend
+# Run from the repository root: python -m unittest tests.test_inflight
+import time, unittest
+from inflight import InflightTable, MAX_BACKOFF
+
+PUBLISH_QOS1 = (bytes([0x32, 7]), b"\x00\x01t\x00\x01\x00x")   # Fixed header, then the rest of the frame
+LATER = 1e12                                                   # A time.time() value past every deadline
+
+
+class InflightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.table = InflightTable(retry_interval=2.0)
+        self.completed = []
+
+    def add(self, packet_id: int = 1, expires_at: float | None = None):
+        return self.table.add("c", packet_id, PUBLISH_QOS1,
+                              lambda *args: self.completed.append(args), expires_at)
+
+    # Mark the message written and check its timer: interval * 2**backoff from now
+    def assert_armed(self, message, backoff: int):
+        before = time.time()
+        self.table.sent(message)
+        delay = 2.0 * 2**backoff
+        self.assertGreaterEqual(message.deadline, before + delay)
+        self.assertLessEqual(message.deadline, time.time() + delay)
+
+    def test_timer_starts_once_written(self):
+        message = self.add()
+        self.assertIsNone(message.deadline)
+        self.assertEqual(self.table.expired(LATER), [])         # Still in the outbound queue
+        self.assert_armed(message, 0)
+        self.assertEqual(self.table.expired(message.deadline - 0.001), [])
+        self.assertEqual(self.table.expired(message.deadline), [message])
+
+    def test_backoff_doubles_up_to_the_cap(self):
+        message = self.add()
+        for backoff in range(MAX_BACKOFF + 3):
+            self.assert_armed(message, min(backoff, MAX_BACKOFF))
+            self.assertEqual(self.table.expired(message.deadline), [message])
+            self.assertIsNone(message.deadline)                 # Rearmed when the resent copy is written
+            self.assertEqual(message.retries, backoff + 1)
+
+    def test_resend_sets_dup(self):
+        message = self.add()
+        self.table.sent(message)
+        self.table.expired(LATER)
+        self.assertEqual(message.packet[0][0], 0x32 | 0x08)
+        self.assertEqual(message.packet[1], PUBLISH_QOS1[1])
+        self.assertEqual(PUBLISH_QOS1[0][0], 0x32)             # The original buffers are not modified
+
+    def test_second_sent_call_keeps_the_timer(self):
+        message = self.add()
+        self.table.sent(message)
+        deadline = message.deadline
+        self.table.sent(message)                                # Another copy written, e.g. a session resend
+        self.assertEqual(message.deadline, deadline)
+
+    def test_ack_completes_and_cancels_the_timer(self):
+        message = self.add()
+        self.table.sent(message)
+        self.assertTrue(self.table.ack("c", 1))
+        self.assertFalse(self.table.ack("c", 1))
+        self.assertEqual(self.completed, [("c", 1, True)])
+        self.assertEqual(self.table.expired(LATER), [])
+
+    def test_copy_written_after_the_ack_arms_nothing(self):
+        message = self.add()
+        self.table.ack("c", 1)
+        self.table.sent(message)
+        self.assertIsNone(message.deadline)
+        self.assertIsNone(self.table.next_deadline())
+
+    def test_expired_message_is_given_up(self):
+        message = self.add(expires_at=time.time() - 1)
+        self.table.sent(message)
+        self.assertEqual(self.table.expired(LATER), [])
+        self.assertEqual(self.completed, [("c", 1, False)])
+        self.assertEqual(self.table.count(), 0)
+
+    def test_max_retries(self):
+        self.table.max_retries = 1
+        message = self.add()
+        self.table.sent(message)
+        self.assertEqual(self.table.expired(LATER), [message])
+        self.table.sent(message)
+        self.assertEqual(self.table.expired(LATER), [])
+        self.assertEqual(self.completed, [("c", 1, False)])
+
+    def test_packet_ids_skip_those_in_flight(self):
+        self.add(1)
+        self.add(2)
+        self.assertEqual(self.table.next_packet_id("c"), 3)
+        self.table.last_packet_id["c"] = 65534
+        self.assertEqual(self.table.next_packet_id("c"), 65535)
+        self.assertEqual(self.table.next_packet_id("c"), 3)      # Wraps to 1, skips 1 and 2
+
+    def test_drop_client(self):
+        self.add(1)
+        self.add(2)
+        self.table.drop_client("c")
+        self.assertEqual(sorted(self.completed), [("c", 1, False), ("c", 2, False)])
+        self.assertEqual(self.table.count("c"), 0)
+
+
+if(__name__ == "__main__"):
+    unittest.main()
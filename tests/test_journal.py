@@ -0,0 +1,141 @@
+# Replaying the session journal after a restart: records in order, torn tails, checkpoints and sessions
+# Run from the repository root: python -m unittest tests.test_journal
+import os, shutil, tempfile, time, unittest
+from journal import Journal
+from sessions import SessionStore
+
+
+class JournalReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, records: list[bytes], segment_size: int = 16 << 20):
+        journal = Journal(self.directory, segment_size=segment_size)
+        for record in records:
+            journal.append(record)
+        journal.close()
+
+    def replay(self):
+        journal = Journal(self.directory)
+        try:
+            return list(journal.replay())
+        finally:
+            journal.close()
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(".log"))
+
+    def test_records_come_back_in_order(self):
+        records = [f"record {i}".encode() for i in range(100)]
+        self.write(records)
+        self.assertEqual(self.replay(), records)
+
+    def test_across_segments_and_restarts(self):
+        self.write([b"a", b"b"], segment_size=1)                # A new segment after every commit
+        self.write([b"c"])
+        self.assertGreater(len(self.segments()), 2)
+        self.assertEqual(self.replay(), [b"a", b"b", b"c"])
+
+    def test_wait_returns_once_on_disk(self):
+        journal = Journal(self.directory)
+        journal.wait(journal.append(b"a"))
+        self.assertGreaterEqual(journal.commits, 1)
+        journal.close()
+
+    def test_torn_tail_is_ignored(self):
+        self.write([b"first", b"second"])
+        with open(os.path.join(self.directory, self.segments()[-1]), "ab") as segment:
+            segment.write(b"\x00\x00\x00\x10\x12\x34")           # Header of a record cut off by a crash
+        self.assertEqual(self.replay(), [b"first", b"second"])
+
+    def test_corrupt_record_ends_the_segment(self):
+        self.write([b"first", b"second", b"third"])
+        path = os.path.join(self.directory, self.segments()[-1])
+        with open(path, "r+b") as segment:
+            data = segment.read()
+            segment.seek(data.index(b"second"))
+            segment.write(b"SECOND")                            # CRC no longer matches
+        self.assertEqual(self.replay(), [b"first"])
+
+    def test_checkpoint_supersedes_earlier_segments(self):
+        journal = Journal(self.directory)
+        for record in (b"old 1", b"old 2"):
+            journal.append(record)
+        checkpoint_id = journal.rotate()
+        journal.append(b"after rotate")
+        journal.checkpoint(checkpoint_id, [b"live"])
+        journal.close()
+        self.assertEqual(self.replay(), [b"live", b"after rotate"])
+        self.assertEqual(len(self.segments()), 3)               # Checkpoint, the active one and the reopened one
+
+
+class SessionReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_sessions_survive_a_restart(self):
+        store = SessionStore(self.directory)
+        store.open("train1")
+        store.subscribe("train1", "trains/+/route", 0b0001)
+        store.add_message("train1", 1, b"frame 1", False)
+        store.add_message("train1", 2, b"frame 2", True, expires_at=time.time() + 60)
+        store.add_message("train1", 3, b"frame 3", False)
+        store.ack("train1", 1)
+        store.open("train2")
+        store.end("train2")
+        store.close()
+
+        restored = SessionStore(self.directory)
+        self.assertEqual(list(restored.sessions), ["train1"])
+        session = restored.get("train1")
+        self.assertEqual(session.subs, {"trains/+/route": 0b0001})
+        self.assertEqual(list(session.messages), [2, 3])
+        self.assertEqual(session.messages[2][0], b"frame 2")
+        self.assertAlmostEqual(session.messages[2][2], time.time() + 60, delta=5)
+        self.assertTrue(session.messages[3][1])                 # May have been sent before the restart
+        restored.close()
+
+    def test_compacted_journal_replays_the_same_state(self):
+        store = SessionStore(self.directory, compact_bytes=256)
+        store.open("train1", 600)
+        for packet_id in range(1, 50):
+            store.add_message("train1", packet_id, b"x" * 20, False)
+            if(packet_id % 2): store.ack("train1", packet_id)
+        store.detach("train1", time.time())
+        while store.compacting: time.sleep(0.01)                # Compaction runs on its own thread
+        store.close()
+
+        restored = SessionStore(self.directory)
+        session = restored.get("train1")
+        self.assertEqual(list(session.messages), list(range(2, 50, 2)))
+        self.assertEqual(session.expiry_interval, 600)
+        self.assertAlmostEqual(session.expires_at, time.time() + 600, delta=5)
+        restored.close()
+
+    def test_session_expiry_is_restored_and_capped(self):
+        store = SessionStore(self.directory)
+        store.open("gone", 1)
+        store.detach("gone", time.time() - 10)                  # Expired while the broker was down
+        store.open("connected", 3600)                           # Connected when the broker stopped
+        store.close()
+
+        restored = SessionStore(self.directory, max_expiry=60)
+        connected = restored.get("connected")
+        self.assertEqual(connected.expiry_interval, 60)
+        self.assertAlmostEqual(connected.expires_at, time.time() + 60, delta=5)
+        self.assertEqual([session.client_id for session in restored.expire(time.time() + 2, lambda _: False)],
+                         ["gone"])
+        self.assertIsNone(restored.get("gone"))
+        restored.close()
+
+
+if(__name__ == "__main__"):
+    unittest.main()
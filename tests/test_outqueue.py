@@ -0,0 +1,112 @@
+# Overflow policies, conflation and expiry of the per-client outbound queue
+# Run from the repository root: python -m unittest tests.test_outqueue
+import time, unittest
+from outqueue import OutboundQueue, DROP_OLDEST, DROP_NEWEST, DISCONNECT
+
+
+# Everything the queue would hand to sendmsg now, joined
+def queued(queue: OutboundQueue):
+    return b"".join(bytes(buffer) for buffer in queue.pending())
+
+
+class OverflowTest(unittest.TestCase):
+
+    def test_drop_oldest(self):
+        queue = OutboundQueue(max_messages=3, policy=DROP_OLDEST)
+        for data in (b"1", b"2", b"3", b"4", b"5"):
+            self.assertTrue(queue.put(data))
+        self.assertEqual(len(queue), 3)
+        self.assertEqual(queue.dropped, 2)
+        self.assertEqual(queued(queue), b"345")
+
+    def test_drop_newest(self):
+        queue = OutboundQueue(max_messages=3, policy=DROP_NEWEST)
+        for data in (b"1", b"2", b"3", b"4", b"5"):
+            self.assertTrue(queue.put(data))
+        self.assertEqual(queue.dropped, 2)
+        self.assertEqual(queued(queue), b"123")
+
+    def test_disconnect(self):
+        queue = OutboundQueue(max_messages=2, policy=DISCONNECT)
+        self.assertTrue(queue.put(b"1"))
+        self.assertTrue(queue.put(b"2"))
+        self.assertFalse(queue.put(b"3"))
+
+    def test_byte_limit(self):
+        queue = OutboundQueue(max_bytes=10, policy=DROP_OLDEST)
+        queue.put(b"a" * 6)
+        queue.put(b"b" * 6)
+        self.assertEqual(queue.bytes, 6)
+        self.assertEqual(queued(queue), b"b" * 6)
+
+    def test_control_packets_are_never_dropped(self):
+        queue = OutboundQueue(max_messages=2, policy=DROP_OLDEST)
+        queue.put(b"A", droppable=False)
+        queue.put(b"B", droppable=False)
+        queue.put(b"1")
+        queue.put(b"C", droppable=False)
+        self.assertEqual(queued(queue), b"ABC")
+        self.assertEqual(queue.dropped, 1)
+
+    def test_partly_written_head_is_kept(self):
+        queue = OutboundQueue(max_messages=2, policy=DROP_OLDEST)
+        queue.put(b"11")
+        queue.put(b"22")
+        queue.pending()
+        queue.consume(1)                                    # Half of the first packet is on the wire
+        queue.put(b"33")
+        self.assertEqual(queued(queue), b"133")
+
+    def test_dropped_packets_are_dequeued(self):
+        dequeued = []
+        queue = OutboundQueue(max_messages=1, policy=DROP_OLDEST)
+        queue.put(b"1", on_dequeued=lambda: dequeued.append(1))
+        queue.put(b"2", on_dequeued=lambda: dequeued.append(2))
+        self.assertEqual(dequeued, [1])
+        queue.pending()
+        queue.consume(1)
+        self.assertEqual(dequeued, [1, 2])
+
+
+class ConflationTest(unittest.TestCase):
+
+    def test_pending_packet_is_replaced_in_place(self):
+        queue = OutboundQueue()
+        queue.put(b"a1", conflate_key="a")
+        queue.put(b"b1", conflate_key="b")
+        queue.put(b"a2", conflate_key="a")
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(queue.conflated, 1)
+        self.assertEqual(queue.bytes, 4)
+        self.assertEqual(queued(queue), b"a2b1")
+
+    def test_packet_handed_to_a_write_is_not_replaced(self):
+        queue = OutboundQueue()
+        queue.put(b"a1", conflate_key="a")
+        queue.pending()                                     # Being written
+        queue.put(b"a2", conflate_key="a")
+        self.assertEqual(queue.conflated, 0)
+        self.assertEqual(queued(queue), b"a1a2")
+
+    def test_replaced_packet_is_dequeued(self):
+        dequeued = []
+        queue = OutboundQueue()
+        queue.put(b"a1", conflate_key="a", on_dequeued=lambda: dequeued.append("a1"))
+        queue.put(b"a2", conflate_key="a", on_dequeued=lambda: dequeued.append("a2"))
+        self.assertEqual(dequeued, ["a1"])
+
+
+class ExpiryTest(unittest.TestCase):
+
+    def test_expired_packets_are_not_written(self):
+        queue = OutboundQueue()
+        queue.put(b"1", expires_at=time.time() - 1)
+        queue.put(b"2")
+        queue.put(b"3", expires_at=time.time() + 60)
+        self.assertEqual(queued(queue), b"23")
+        self.assertEqual(queue.expired, 1)
+        self.assertEqual(queue.bytes, 2)
+
+
+if(__name__ == "__main__"):
+    unittest.main()
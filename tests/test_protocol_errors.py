@@ -0,0 +1,98 @@
+# Unexpected or malformed frames from one client close at most that client's connection, on both engines
+# Run from the repository root: python -m unittest tests.test_protocol_errors
+import socket, unittest
+from benchmarks.broker_engines import start_broker, mqtt_connect
+from MQTTPacket import FixedHeader, MQTTPacket
+from variableheaders import *
+from utils import *
+
+PORT = 18960
+
+PUBREC_FRAME = bytes.fromhex("50020001")                           # QoS 2 is never used by the broker
+MQTT311_CONNECT = bytes.fromhex("100d00044d5154540402003c000161")  # Protocol level 4, client id "a"
+PUBACK_0X92 = bytes.fromhex("4003000192")                          # Packet Identifier not found
+DISCONNECT_0X05 = bytes.fromhex("e00105")                          # Not an MQTT 5 DISCONNECT reason code
+
+
+class ProtocolErrorTest(unittest.TestCase):
+    engine = "threaded"
+    port = PORT
+
+    @classmethod
+    def setUpClass(cls):
+        cls.proc = start_broker(cls.engine, cls.port, "--sys-interval", "0")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.proc.kill()
+        cls.proc.wait()
+
+    def setUp(self):
+        self.socks = []
+
+    def tearDown(self):
+        for sock in self.socks:
+            sock.close()
+
+    def connect(self, client_id: str):
+        sock = mqtt_connect(self.port, client_id)
+        sock.settimeout(5)
+        self.socks.append(sock)
+        return sock
+
+    # Whether the broker still answers a PINGREQ on `sock`
+    def answers_ping(self, sock: socket.socket):
+        try:
+            sock.sendall(MQTTPacket(FixedHeader(PINGREQ)).encode())
+            return sock.recv(2) == bytes([PINGRESP << 4, 0])
+        except OSError:
+            return False
+
+    # Whether the broker closed `sock`, after reading anything it sent first
+    def closed(self, sock: socket.socket):
+        try:
+            while True:
+                if(not sock.recv(1024)): return True
+        except socket.timeout:
+            return False
+        except OSError:
+            return True
+
+    # The broker is still running and serves a client that did nothing wrong
+    def assert_broker_serves(self):
+        self.assertIsNone(self.proc.poll(), "broker process exited")
+        self.assertTrue(self.answers_ping(self.connect("bystander")))
+
+    def test_pubrec(self):
+        sock = self.connect("sends-pubrec")
+        sock.sendall(PUBREC_FRAME)
+        self.assertTrue(self.answers_ping(sock))
+        self.assert_broker_serves()
+
+    def test_mqtt311_connect(self):
+        sock = socket.create_connection(("127.0.0.1", self.port), timeout=5)
+        self.socks.append(sock)
+        sock.sendall(MQTT311_CONNECT)
+        self.assertTrue(self.closed(sock))
+        self.assert_broker_serves()
+
+    def test_puback_reason_0x92(self):
+        sock = self.connect("sends-puback-0x92")
+        sock.sendall(PUBACK_0X92)
+        self.assertTrue(self.answers_ping(sock))
+        self.assert_broker_serves()
+
+    def test_disconnect_reason_0x05(self):
+        sock = self.connect("sends-disconnect-0x05")
+        sock.sendall(DISCONNECT_0X05)
+        self.assertTrue(self.closed(sock))
+        self.assert_broker_serves()
+
+
+class SelectorProtocolErrorTest(ProtocolErrorTest):
+    engine = "selector"
+    port = PORT + 1
+
+
+if(__name__ == "__main__"):
+    unittest.main()
@@ -0,0 +1,57 @@
+# Streamed PUBLISHes through a broker started in a subprocess, on both engines
+# Run from the repository root: python -m unittest tests.test_streaming
+import threading, time, unittest
+from benchmarks.broker_engines import start_broker
+from client import Client
+
+PORT = 18950
+CHUNK = 1 << 16
+
+
+class SlowStreamTest(unittest.TestCase):
+
+    # A stream that takes longer than the subscriber's keep-alive holds back its PINGRESP until the last chunk;
+    # the stream bytes arriving meanwhile show the link is alive, so the subscriber must keep the connection
+    def check_slow_stream(self, engine: str, port: int):
+        proc = start_broker(engine, port, "--sys-interval", "0")
+        clients = []
+        try:
+            size = 2 << 20
+            received = []
+            delivered = threading.Event()
+            subscriber = Client("slow-stream-sub")
+            subscriber.on_message = lambda payload: (received.append(bytes(payload)), delivered.set())
+            subscriber.connect("127.0.0.1", port, keep_alive=2)
+            subscriber.loop()
+            clients.append(subscriber)
+            subscriber.subscribe([("firmware/#", 0)])
+
+            publisher = Client("slow-stream-pub")
+            publisher.connect("127.0.0.1", port)
+            publisher.loop()
+            clients.append(publisher)
+
+            def chunks():                                   # 2 MiB over 3.2 seconds
+                for sent in range(0, size, CHUNK):
+                    time.sleep(0.1)
+                    yield bytes([sent // CHUNK]) * CHUNK
+            publisher.publish_stream("firmware/train42", chunks(), size)
+
+            self.assertTrue(delivered.wait(10), "subscriber did not get the whole stream")
+            self.assertEqual(received[0], b"".join(bytes([i]) * CHUNK for i in range(size // CHUNK)))
+            self.assertTrue(subscriber.connected)
+        finally:
+            for client in clients:
+                if(client.connected): client.disconnect()
+            proc.kill()
+            proc.wait()
+
+    def test_threaded(self):
+        self.check_slow_stream("threaded", PORT)
+
+    def test_selector(self):
+        self.check_slow_stream("selector", PORT + 1)
+
+
+if(__name__ == "__main__"):
+    unittest.main()
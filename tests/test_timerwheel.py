@@ -0,0 +1,59 @@
+# Keep-alive timers on the hashed timing wheel: expiry, touch, cancel and timeouts longer than one lap
+# Run from the repository root: python -m unittest tests.test_timerwheel
+import unittest
+from timerwheel import TimingWheel
+
+NOW = 1000.0
+
+
+class TimingWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.wheel = TimingWheel(tick=1.0, slots=8)
+
+    def test_expires_at_its_deadline(self):
+        self.wheel.schedule("a", 3, NOW)
+        self.assertEqual(self.wheel.expire(NOW + 2), [])
+        self.assertEqual(self.wheel.expire(NOW + 3), ["a"])
+        self.assertEqual(self.wheel.expire(NOW + 4), [])        # Expired once
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_touch_pushes_the_deadline_back(self):
+        self.wheel.schedule("a", 3, NOW)
+        self.wheel.touch("a", NOW + 2)
+        self.assertEqual(self.wheel.expire(NOW + 4), [])
+        self.assertEqual(self.wheel.expire(NOW + 5), ["a"])
+
+    def test_cancel(self):
+        self.wheel.schedule("a", 1, NOW)
+        self.wheel.cancel("a")
+        self.wheel.touch("a", NOW)                              # Ignored once cancelled
+        self.assertEqual(self.wheel.expire(NOW + 10), [])
+
+    def test_reschedule_replaces_the_timer(self):
+        self.wheel.schedule("a", 1, NOW)
+        self.wheel.schedule("a", 5, NOW)
+        self.assertEqual(self.wheel.expire(NOW + 4), [])
+        self.assertEqual(self.wheel.expire(NOW + 5), ["a"])
+
+    def test_timeout_longer_than_one_lap(self):
+        self.wheel.schedule("a", 20, NOW)                       # 8 slots of 1 second: two and a half laps
+        for second in range(1, 20):
+            self.assertEqual(self.wheel.expire(NOW + second), [], second)
+        self.assertEqual(self.wheel.expire(NOW + 20), ["a"])
+
+    def test_long_pause_expires_everything_due(self):
+        for i in range(20):
+            self.wheel.schedule(i, i + 1, NOW)
+        self.assertEqual(sorted(self.wheel.expire(NOW + 100)), list(range(20)))
+
+    def test_same_slot_different_laps(self):
+        self.wheel.schedule("soon", 2, NOW)
+        self.wheel.schedule("late", 10, NOW)                    # Hashed into the same slot, one lap later
+        self.assertEqual(self.wheel.expire(NOW + 2), ["soon"])
+        self.assertEqual(self.wheel.expire(NOW + 9), [])
+        self.assertEqual(self.wheel.expire(NOW + 10), ["late"])
+
+
+if(__name__ == "__main__"):
+    unittest.main()
@@ -0,0 +1,63 @@
+# Wildcard matching and pruning of the subscription trie
+# Run from the repository root: python -m unittest tests.test_topictrie
+import unittest
+from topictrie import TopicTrie, valid_filter
+
+
+class TopicTrieTest(unittest.TestCase):
+
+    def setUp(self):
+        self.trie = TopicTrie()
+
+    def test_exact_filter(self):
+        self.trie.insert("trains/train1", "a", 1)
+        self.assertEqual(self.trie.match("trains/train1"), {"a": 1})
+        self.assertEqual(self.trie.match("trains/train2"), {})
+        self.assertEqual(self.trie.match("trains/train1/route"), {})
+
+    def test_plus_matches_one_level(self):
+        self.trie.insert("trains/+/route", "a")
+        self.assertIn("a", self.trie.match("trains/train1/route"))
+        self.assertIn("a", self.trie.match("trains//route"))            # An empty level is still a level
+        self.assertNotIn("a", self.trie.match("trains/route"))
+        self.assertNotIn("a", self.trie.match("trains/train1/x/route"))
+
+    def test_hash_matches_parent_and_below(self):
+        self.trie.insert("trains/#", "a")
+        for topic_name in ("trains", "trains/train1", "trains/train1/route"):
+            self.assertIn("a", self.trie.match(topic_name), topic_name)
+        self.assertNotIn("a", self.trie.match("depots/trains"))
+
+    def test_wildcards_skip_system_topics(self):
+        self.trie.insert("#", "all")
+        self.trie.insert("+/broker/uptime", "plus")
+        self.trie.insert("$SYS/#", "sys")
+        self.assertEqual(self.trie.match("$SYS/broker/uptime"), {"sys": 0})
+        self.assertEqual(self.trie.match("x/broker/uptime"), {"all": 0, "plus": 0})
+
+    def test_client_matching_several_filters_gets_highest_qos(self):
+        self.trie.insert("trains/#", "a", 0b0000)
+        self.trie.insert("trains/+", "a", 0b0001)
+        self.trie.insert("trains/train1", "a", 0b0000)
+        self.assertEqual(self.trie.match("trains/train1"), {"a": 0b0001})
+
+    def test_remove_prunes_empty_branches(self):
+        self.trie.insert("a/b/c", "x")
+        self.trie.insert("a/b/c", "y")
+        self.assertEqual(len(self.trie), 2)
+        self.assertTrue(self.trie.remove("a/b/c", "x"))
+        self.assertEqual(self.trie.match("a/b/c"), {"y": 0})
+        self.assertTrue(self.trie.remove("a/b/c", "y"))
+        self.assertFalse(self.trie.remove("a/b/c", "y"))
+        self.assertEqual(len(self.trie), 0)
+        self.assertEqual(self.trie.root.children, {})
+
+    def test_valid_filter(self):
+        for topic_filter in ("a", "a/b", "+", "#", "a/+/c", "a/#", "+/+", "/"):
+            self.assertTrue(valid_filter(topic_filter), topic_filter)
+        for topic_filter in ("", "a/#/c", "a#", "a/b+", "#/a", "a/+b"):
+            self.assertFalse(valid_filter(topic_filter), topic_filter)
+
+
+if(__name__ == "__main__"):
+    unittest.main()
@@ -0,0 +1,75 @@
+# Hashed timing wheel: keep-alive deadlines for many connections at O(1) cost per packet and per tick
+import threading
+
+
+# One key's timer; touch() only moves the deadline, the wheel entry follows lazily
+class Timer:
+    __slots__ = ("deadline", "timeout")
+
+    def __init__(self, deadline: float, timeout: float):
+        self.deadline = deadline
+        self.timeout = timeout
+
+
+class TimingWheel:
+    '''
+    Timers keyed by an id (a client id for keep-alive), hashed into slots of `tick` seconds:
+    wheel.schedule(key, timeout, now): (re)starts the key's timer with a new timeout.
+    wheel.touch(key, now): pushes the key's deadline back by its timeout (activity on the connection).
+    wheel.cancel(key): forgets the key.
+    wheel.expire(now): advances the wheel and returns the keys whose deadline has passed.
+    touch() only records the new deadline; the entry is moved when its old slot comes round, so a packet
+    costs one attribute write and a tick only visits the entries hashed into the slots it passes.
+    '''
+
+    def __init__(self, tick: float = 0.5, slots: int = 1024):
+        self.tick = tick
+        self.slots: list[list] = [[] for _ in range(slots)]    # (key, Timer) entries to check when the wheel gets there
+        self.timers: dict = dict()                              # Maps key -> live Timer
+        self.current = None                                     # Last tick processed
+        self.lock = threading.Lock()
+
+    def schedule(self, key, timeout: float, now: float):
+        with self.lock:
+            if(self.current is None): self.current = int(now / self.tick)
+            timer = self.timers[key] = Timer(now + timeout, timeout)   # Entries of a replaced timer are skipped
+            self.__place(key, timer)
+
+    def touch(self, key, now: float):
+        timer = self.timers.get(key)
+        if(timer is not None):
+            timer.deadline = now + timer.timeout
+
+    def cancel(self, key):
+        with self.lock:
+            self.timers.pop(key, None)
+
+    def expire(self, now: float):
+        expired = []
+        with self.lock:
+            if(self.current is None): return expired
+            target = int(now / self.tick)
+            # Visit each slot at most once even after a long pause, one lap covers every entry
+            first = max(self.current+1, target-len(self.slots)+1)
+            for tick in range(first, target+1):
+                self.current = tick                             # Re-placed entries go to a later slot
+                index = tick % len(self.slots)
+                entries, self.slots[index] = self.slots[index], []
+                for key, timer in entries:
+                    if(self.timers.get(key) is not timer):
+                        continue                                # Cancelled or rescheduled
+                    if(timer.deadline <= now):
+                        del self.timers[key]
+                        expired.append(key)
+                    else:
+                        self.__place(key, timer)                # Touched since, or due on a later lap
+            self.current = max(self.current, target)
+        return expired
+
+    def __len__(self):
+        return len(self.timers)
+
+    # Hash a timer into the slot of its deadline's tick; never into the past, or it would wait a whole lap
+    def __place(self, key, timer: Timer):
+        tick = max(int(timer.deadline / self.tick), self.current+1)
+        self.slots[tick % len(self.slots)].append((key, timer))
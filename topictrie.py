@@ -0,0 +1,103 @@
+# Subscription index: a trie keyed by topic levels supporting MQTT '+' and '#' wildcards
+
+
+# Check that a topic filter is well formed ('#' only as the last level, wildcards occupy a whole level)
+def valid_filter(topic_filter: str):
+    if(topic_filter == ""): return False
+    levels = topic_filter.split('/')
+    for i, level in enumerate(levels):
+        if('#' in level and (level != '#' or i != len(levels)-1)): return False
+        if('+' in level and level != '+'): return False
+    return True
+
+
+# One level of the trie
+class TopicNode:
+    __slots__ = ("children", "subscribers")
+
+    def __init__(self):
+        self.children: dict[str, TopicNode] = dict()      # Maps next topic level -> node
+        self.subscribers: dict[str, int] = dict()         # Maps client_id -> subscription options byte
+
+
+class TopicTrie:
+    '''
+    Trie of topic filters:
+    trie.insert(topic_filter, client_id, options): adds a subscription.
+    trie.remove(topic_filter, client_id): removes a subscription, pruning empty branches.
+    trie.match(topic_name): returns {client_id: options} for every matching filter in one walk.
+    '''
+
+    def __init__(self):
+        self.root = TopicNode()
+        self.count = 0                                    # Number of (filter, client) subscriptions
+
+    def insert(self, topic_filter: str, client_id: str, options: int = 0):
+        node = self.root
+        for level in topic_filter.split('/'):
+            child = node.children.get(level)
+            if(child is None):
+                child = node.children[level] = TopicNode()
+            node = child
+        if(client_id not in node.subscribers):
+            self.count += 1
+        node.subscribers[client_id] = options
+
+    def remove(self, topic_filter: str, client_id: str):
+        # Walk down remembering the path so empty nodes can be pruned on the way back
+        path = []
+        node = self.root
+        for level in topic_filter.split('/'):
+            child = node.children.get(level)
+            if(child is None): return False
+            path.append((node, level))
+            node = child
+        if(node.subscribers.pop(client_id, None) is None): return False
+        self.count -= 1
+
+        for parent, level in reversed(path):
+            child = parent.children[level]
+            if(child.subscribers or child.children): break
+            del parent.children[level]
+        return True
+
+    def match(self, topic_name: str):
+        levels = topic_name.split('/')
+        depth = len(levels)
+        matched: dict[str, int] = dict()
+
+        # Filters starting with a wildcard must not match topics beginning with '$'
+        system_topic = topic_name.startswith('$')
+
+        stack = [(self.root, 0)]
+        while stack:
+            node, i = stack.pop()
+            children = node.children
+            wildcards = not (system_topic and i == 0)
+
+            # '#' matches the parent level and everything below it
+            if(wildcards and '#' in children):
+                self.__merge(matched, children['#'].subscribers)
+            if(i == depth):
+                self.__merge(matched, node.subscribers)
+                continue
+
+            child = children.get(levels[i])
+            if(child is not None):
+                stack.append((child, i+1))
+            if(wildcards):
+                child = children.get('+')
+                if(child is not None):
+                    stack.append((child, i+1))
+        return matched
+
+    # Add subscribers to the result, keeping the highest QoS when a client matches several filters
+    @staticmethod
+    def __merge(matched: dict[str, int], subscribers: dict[str, int]):
+        for client_id, options in subscribers.items():
+            current = matched.get(client_id)
+            if(current is None or (options & 0b11) > (current & 0b11)):
+                matched[client_id] = options
+
+    def __len__(self):
+        return self.count
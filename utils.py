@@ -14,8 +14,11 @@ PINGRESP = 13
 DISCONNECT = 14
 AUTH = 15
 
+# One-byte bytes objects indexed by value, shared so that encoders do not allocate them
+SINGLE_BYTES = tuple(bytes((value,)) for value in range(256))
+
 def int_to_var_bytes(x: int):
-    if(x==0): return (0).to_bytes()
+    if(x < 128): return SINGLE_BYTES[x]                   # Single byte, the usual case
     encoded = b''
     encoded_byte = b''
     while(x > 0):
@@ -36,10 +39,138 @@ def var_bytes_to_int(encoded: bytes):
     return decoded
 
 def str_to_bytes(x: str):
-    return len(x).to_bytes(2) + x.encode('utf-8')
+    encoded = x.encode('utf-8')
+    return len(encoded).to_bytes(2) + encoded           # Length in bytes, not characters
 def bytes_to_str(encoded: bytes):
     utflen = int.from_bytes(encoded[0:2])
-    return encoded[2:2+utflen].decode(), utflen
+    return str(encoded[2:2+utflen], 'utf-8'), utflen      # str() also accepts memoryviews
+
+# MQTT 5 properties: a variable length integer giving their size, then (identifier, value) pairs.
+# Decoded properties are a dict keyed by identifier; the repeatable ones hold a list of values.
+PAYLOAD_FORMAT_INDICATOR = 0x01
+MESSAGE_EXPIRY_INTERVAL = 0x02
+CONTENT_TYPE = 0x03
+RESPONSE_TOPIC = 0x08
+CORRELATION_DATA = 0x09
+SUBSCRIPTION_IDENTIFIER = 0x0B
+SESSION_EXPIRY_INTERVAL = 0x11
+ASSIGNED_CLIENT_IDENTIFIER = 0x12
+SERVER_KEEP_ALIVE = 0x13
+AUTHENTICATION_METHOD = 0x15
+AUTHENTICATION_DATA = 0x16
+REQUEST_PROBLEM_INFORMATION = 0x17
+WILL_DELAY_INTERVAL = 0x18
+REQUEST_RESPONSE_INFORMATION = 0x19
+RESPONSE_INFORMATION = 0x1A
+SERVER_REFERENCE = 0x1C
+REASON_STRING = 0x1F
+RECEIVE_MAXIMUM = 0x21
+TOPIC_ALIAS_MAXIMUM = 0x22
+TOPIC_ALIAS = 0x23
+MAXIMUM_QOS = 0x24
+RETAIN_AVAILABLE = 0x25
+USER_PROPERTY = 0x26
+MAXIMUM_PACKET_SIZE = 0x27
+WILDCARD_SUBSCRIPTION_AVAILABLE = 0x28
+SUBSCRIPTION_IDENTIFIER_AVAILABLE = 0x29
+SHARED_SUBSCRIPTION_AVAILABLE = 0x2A
+
+# Property value types, each with an encoder value -> bytes and a decoder (encoded, i) -> (value, next i)
+def encode_byte(value: int): return SINGLE_BYTES[value]
+def encode_two_byte_int(value: int): return value.to_bytes(2)
+def encode_four_byte_int(value: int): return value.to_bytes(4)
+def encode_binary(value: bytes): return len(value).to_bytes(2) + value
+def encode_str_pair(value: tuple[str, str]): return str_to_bytes(value[0]) + str_to_bytes(value[1])
+
+def decode_byte(encoded: bytes, i: int): return encoded[i], i+1
+def decode_two_byte_int(encoded: bytes, i: int): return int.from_bytes(encoded[i:i+2]), i+2
+def decode_four_byte_int(encoded: bytes, i: int): return int.from_bytes(encoded[i:i+4]), i+4
+def decode_var_int(encoded: bytes, i: int):
+    if(encoded[i] < 128): return encoded[i], i+1          # Single byte, the usual case
+    value = 0; shift = 0
+    while True:
+        value |= (encoded[i] & 127) << shift
+        i += 1
+        if(not encoded[i-1] & 128): return value, i
+        shift += 7
+        if(shift > 21): raise ValueError("Malformed variable byte integer")
+def decode_str(encoded: bytes, i: int):
+    end = i+2+int.from_bytes(encoded[i:i+2])
+    return str(encoded[i+2:end], 'utf-8'), end
+def decode_binary(encoded: bytes, i: int):
+    size = int.from_bytes(encoded[i:i+2])
+    return bytes(encoded[i+2:i+2+size]), i+2+size
+def decode_str_pair(encoded: bytes, i: int):
+    name, i = decode_str(encoded, i)
+    value, i = decode_str(encoded, i)
+    return (name, value), i
+
+BYTE = (encode_byte, decode_byte)
+TWO_BYTE_INT = (encode_two_byte_int, decode_two_byte_int)
+FOUR_BYTE_INT = (encode_four_byte_int, decode_four_byte_int)
+VAR_INT = (int_to_var_bytes, decode_var_int)
+UTF8_STRING = (str_to_bytes, decode_str)
+BINARY_DATA = (encode_binary, decode_binary)
+UTF8_PAIR = (encode_str_pair, decode_str_pair)
+
+PROPERTY_TYPES = {
+    PAYLOAD_FORMAT_INDICATOR: BYTE,
+    MESSAGE_EXPIRY_INTERVAL: FOUR_BYTE_INT,
+    CONTENT_TYPE: UTF8_STRING,
+    RESPONSE_TOPIC: UTF8_STRING,
+    CORRELATION_DATA: BINARY_DATA,
+    SUBSCRIPTION_IDENTIFIER: VAR_INT,
+    SESSION_EXPIRY_INTERVAL: FOUR_BYTE_INT,
+    ASSIGNED_CLIENT_IDENTIFIER: UTF8_STRING,
+    SERVER_KEEP_ALIVE: TWO_BYTE_INT,
+    AUTHENTICATION_METHOD: UTF8_STRING,
+    AUTHENTICATION_DATA: BINARY_DATA,
+    REQUEST_PROBLEM_INFORMATION: BYTE,
+    WILL_DELAY_INTERVAL: FOUR_BYTE_INT,
+    REQUEST_RESPONSE_INFORMATION: BYTE,
+    RESPONSE_INFORMATION: UTF8_STRING,
+    SERVER_REFERENCE: UTF8_STRING,
+    REASON_STRING: UTF8_STRING,
+    RECEIVE_MAXIMUM: TWO_BYTE_INT,
+    TOPIC_ALIAS_MAXIMUM: TWO_BYTE_INT,
+    TOPIC_ALIAS: TWO_BYTE_INT,
+    MAXIMUM_QOS: BYTE,
+    RETAIN_AVAILABLE: BYTE,
+    USER_PROPERTY: UTF8_PAIR,
+    MAXIMUM_PACKET_SIZE: FOUR_BYTE_INT,
+    WILDCARD_SUBSCRIPTION_AVAILABLE: BYTE,
+    SUBSCRIPTION_IDENTIFIER_AVAILABLE: BYTE,
+    SHARED_SUBSCRIPTION_AVAILABLE: BYTE,
+}
+REPEATABLE_PROPERTIES = (USER_PROPERTY, SUBSCRIPTION_IDENTIFIER)     # Values are lists
+
+def encode_properties(properties: dict | None):
+    if(not properties): return b'\x00'
+    encoded = b''
+    for prop_id, value in properties.items():
+        encode = PROPERTY_TYPES[prop_id][0]
+        for item in (value if prop_id in REPEATABLE_PROPERTIES else (value,)):
+            encoded += prop_id.to_bytes(1) + encode(item)
+    return int_to_var_bytes(len(encoded)) + encoded
+
+# Decodes the properties starting at offset i. Returns them as a dict and the offset just past them
+# (from the default offset 0, the number of bytes they took, length included)
+def decode_properties(encoded: bytes, i: int = 0):
+    props_len, i = decode_var_int(encoded, i)
+    end = i + props_len
+    if(end > len(encoded)): raise ValueError("Malformed properties")
+    properties = dict()
+    if(not props_len): return properties, end
+    while(i < end):
+        prop_id = encoded[i]
+        prop_type = PROPERTY_TYPES.get(prop_id)
+        if(prop_type is None): raise ValueError(f"Unknown property 0x{prop_id:02x}")
+        value, i = prop_type[1](encoded, i+1)
+        if(prop_id in REPEATABLE_PROPERTIES):
+            properties.setdefault(prop_id, []).append(value)
+        else:
+            properties[prop_id] = value
+    return properties, end
 
 connack_reason_codes = {
     0x00: "Success",
@@ -121,6 +252,40 @@ puback_reason_codes = {
     0x87: "Not authorized",
     0x90: "Topic Name invalid",
     0x91: "Packet identifier in use",
+    0x92: "Packet Identifier not found",
+    0x97: "Quota exceeded",
+    0x99: "Payload format invalid"
+}
+
+pubrec_reason_codes = {
+    0x00: "Success",
+    0x10: "No matching subscribers",
+    0x80: "Unspecified error",
+    0x83: "Implementation specific error",
+    0x87: "Not authorized",
+    0x90: "Topic Name invalid",
+    0x91: "Packet Identifier in use",
     0x97: "Quota exceeded",
     0x99: "Payload format invalid"
 }
+
+pubrel_reason_codes = {                 # Also PUBCOMP
+    0x00: "Success",
+    0x92: "Packet Identifier not found"
+}
+
+unsuback_reason_codes = {
+    0x00: "Success",
+    0x11: "No subscription existed",
+    0x80: "Unspecified error",
+    0x83: "Implementation specific error",
+    0x87: "Not authorized",
+    0x8F: "Topic Filter invalid",
+    0x91: "Packet Identifier in use"
+}
+
+auth_reason_codes = {
+    0x00: "Success",
+    0x18: "Continue authentication",
+    0x19: "Re-authenticate"
+}
@@ -1,3 +1,4 @@
+import struct
 from utils import *
 
 # NOTE: Variable headers also contain payload, I found it easier to use flags this way
@@ -5,6 +6,7 @@ from utils import *
 __all__ = [
     "ConnectVariableHeader",
     "ConnackVariableHeader",
+    "PublishHeader",
     "PublishVariableHeader",
     "PubackVariableHeader",
     "PubrecVariableHeader",
@@ -18,230 +20,350 @@ __all__ = [
     "AuthVariableHeader",
 ]
 
-def removeFixedHeader(encoded: bytes):
-    encoded=encoded[1:]
-    remaining_len = var_bytes_to_int(encoded)
-    encoded = encoded[remaining_len.bit_length()//7+1:]
-    return encoded
-
+# Fixed size fields, packed in one call
+MQTT5_PROTOCOL = b'\x00\x04MQTT\x05'      # Protocol name and version 5
+FLAGS_KEEP_ALIVE = struct.Struct(">BH")     # CONNECT flags, keep-alive
+FLAGS_REASON = struct.Struct(">BB")         # CONNACK flags, reason code
+PACKET_ID = struct.Struct(">H")
+PACKET_ID_REASON = struct.Struct(">HB")     # PUBACK packet id, reason code
+
+# Offset of the variable header in a whole packet: past the type byte and the 1 to 4 byte remaining length
+def variable_header_start(encoded: bytes | memoryview):
+    return decode_var_int(encoded, 1)[1]
+
+# Every variable header keeps its MQTT 5 properties as a dict keyed by property identifier (see utils.py).
+# decode(encoded, start) reads the fields of a whole packet (bytes or a memoryview) in place by their offsets, from
+# `start` (the end of the fixed header, found by MQTTPacket.decode) or from the offset it finds itself; nothing is
+# sliced off and copied.
+# Packet objects are slotted: the broker builds and decodes one per packet, so they carry no __dict__.
 class ConnectVariableHeader:
+    __slots__ = ("flags", "keep_alive", "properties", "client_id")
 
-    def __init__(self, client_id: str, keep_alive: int = 0, flags: int = 0):
-        assert not (flags&1) # check that reserved is 0
+    def __init__(self, client_id: str, keep_alive: int = 0, flags: int = 0, properties: dict[int, int] | None = None):
+        if(flags & 1): raise ValueError("CONNECT reserved flag set")
         self.flags = flags
         self.keep_alive = keep_alive
-        # self.properties = properties
+        self.properties = properties or dict()
         self.client_id = client_id
 
     def encode(self):
-        encoded = b'\x00\x04MQTT' # protocol MQTT
-        encoded += b'\x05' # version 5
-        encoded += self.flags.to_bytes(1)
-        encoded += self.keep_alive.to_bytes(2)
-        #TODO Add properties support
-        encoded += int_to_var_bytes(0) #assume no properties for now
-
-        encoded += str_to_bytes(self.client_id)
         #TODO add flags support
-        return encoded
+        return b"".join((MQTT5_PROTOCOL, FLAGS_KEEP_ALIVE.pack(self.flags, self.keep_alive),
+                         encode_properties(self.properties), str_to_bytes(self.client_id)))
     
     @classmethod
-    def decode(cls, encoded: bytes):
-        encoded = removeFixedHeader(encoded) #removing fixed header
-        assert encoded[:7] == b'\x00\x04MQTT\x05'
-        flags = encoded[7]
-        keep_alive = int.from_bytes(encoded[8:10])
-        i = 10
-        i+=1 # accounting for no properties
-        client_id, client_id_size = bytes_to_str(encoded[i:])
-        i+= client_id_size+2
-        #idek how to decode properties, problem for later
-        return ConnectVariableHeader(client_id, keep_alive, flags)
+    def decode(cls, encoded: bytes, start: int | None = None):
+        i = variable_header_start(encoded) if start is None else start
+        if(encoded[i:i+7] != MQTT5_PROTOCOL): raise ValueError("Not an MQTT 5 CONNECT")
+        flags = encoded[i+7]
+        keep_alive = int.from_bytes(encoded[i+8:i+10])
+        properties, i = decode_properties(encoded, i+10)
+        client_id, i = decode_str(encoded, i)
+        return ConnectVariableHeader(client_id, keep_alive, flags, properties)
 
 
 class ConnackVariableHeader:
+    __slots__ = ("flags", "reason_code", "properties")
 
-    def __init__(self, flags: int, reason_code: int, username: str = "", password: str = ""):
-        assert not (flags & 0xfe) #check that bits 1-7 are 0
+    def __init__(self, flags: int, reason_code: int, properties: dict[int, int] | None = None):
+        if(flags & 0xfe): raise ValueError("CONNACK reserved flags set")
         self.flags = flags
-        assert reason_code in connack_reason_codes
+        if(reason_code not in connack_reason_codes):
+            raise ValueError(f"Invalid CONNACK reason code 0x{reason_code:02x}")
         self.reason_code = reason_code
-        # self.properties = properties
+        self.properties = properties or dict()
 
     def encode(self):
-        encoded = self.flags.to_bytes(1)
-        encoded += self.reason_code.to_bytes(1)
-        #TODO Add properties support
-        encoded += int_to_var_bytes(0) #assume no properties for now
-        return encoded
+        return FLAGS_REASON.pack(self.flags, self.reason_code) + encode_properties(self.properties)
 
     @classmethod
-    def decode(cls, encoded: bytes):
-        encoded = removeFixedHeader(encoded) #removing fixed header
-        flags = encoded[0]
-        reason_code = encoded[1]
-        return ConnackVariableHeader(flags, reason_code)
-
-class PublishVariableHeader:
-
-    def __init__(self, topic_name: str, payload: str, packet_id: int | None = None):
-        self.topic_name = topic_name
-        self.packet_id = packet_id
-        self.payload = payload
-        # self.properties = properties
+    def decode(cls, encoded: bytes, start: int | None = None):
+        i = variable_header_start(encoded) if start is None else start
+        flags = encoded[i]
+        reason_code = encoded[i+1]
+        properties, _ = decode_properties(encoded, i+2) if len(encoded) > i+2 else (None, 0)
+        return ConnackVariableHeader(flags, reason_code, properties)
+
+# The payload is opaque binary data. Encoding takes any bytes-like object as is (a str is UTF-8 encoded for
+# convenience) and decoding returns a memoryview of the payload inside the encoded packet, without copying it.
+# PublishHeader holds what both forms of the header share: PublishVariableHeader, built to be sent, and
+# LazyPublishVariableHeader, read from a received packet. Each keeps its fields in slots of its own.
+class PublishHeader:
+    __slots__ = ()
 
     def encode(self):
-        encoded = str_to_bytes(self.topic_name)
+        return b"".join(self.encode_parts())
+
+    # Header and payload, so that MQTTPacket.encode copies the payload only once, straight into the frame
+    def encode_parts(self):
+        header = str_to_bytes(self.topic_name)
         if(self.packet_id):
-            encoded += self.packet_id.to_bytes(2)
-        encoded += int_to_var_bytes(0) #assume no properties for now
-        encoded += self.payload.encode('utf-8')
-        return encoded
+            header += PACKET_ID.pack(self.packet_id)
+        header += encode_properties(self.properties)
+        payload = self.payload
+        if(isinstance(payload, str)):
+            payload = payload.encode('utf-8')
+        return header, payload
 
     @classmethod
-    def decode(cls, encoded:bytes):
-        var_header = removeFixedHeader(encoded) #removing fixed header
-        topic_name, topic_name_size = bytes_to_str(var_header)
-        i = topic_name_size+2
-        packet_id = None
-        if(encoded[0] & 0b0110): #QoS not 0
-            packet_id = int.from_bytes(var_header[i:i+2])
-            i+=2
-        i+=1 # no props
-        payload = var_header[i:].decode('utf-8')
-        if(packet_id):
-            return PublishVariableHeader(topic_name, payload, packet_id)
-        return PublishVariableHeader(topic_name, payload)        
+    def decode(cls, encoded: bytes, start: int | None = None):
+        return LazyPublishVariableHeader(encoded, variable_header_start(encoded) if start is None else start)
 
 
-class PubackVariableHeader:
+class PublishVariableHeader(PublishHeader):
+    __slots__ = ("topic_name", "packet_id", "payload", "properties")
 
-    def __init__(self, packet_id: int, reason_code: int):
+    def __init__(self, topic_name: str, payload: bytes | bytearray | memoryview | str, packet_id: int | None = None,
+                 properties: dict[int, int] | None = None):
+        self.topic_name = topic_name        # Empty when a Topic Alias property stands in for it
+        self.packet_id = packet_id
+        self.payload = payload
+        self.properties = properties or dict()
+
+
+# A received PUBLISH, decoded on demand. Decoding only finds the offsets of the fields and reads the packet id;
+# the topic name, properties and payload are read from the packet the first time they are used, so the client
+# never decodes a topic it does not look at and the broker routes on the topic without touching the payload.
+# The payload is a memoryview of `encoded`, valid only as long as it is (see FrameReader).
+# Assigning a field replaces it, as for a PublishVariableHeader built by hand.
+class LazyPublishVariableHeader(PublishHeader):
+    __slots__ = ("encoded", "topic_start", "topic_end", "packet_id", "properties_start", "payload_start",
+                 "_topic_name", "_properties", "_payload")
+
+    def __init__(self, encoded: bytes | memoryview, start: int):
+        self.encoded = encoded
+        self.topic_start = start + 2
+        self.topic_end = i = start + 2 + int.from_bytes(encoded[start:start+2])
+        self.packet_id = None
+        if(encoded[0] & 0b0110): #QoS not 0
+            self.packet_id = int.from_bytes(encoded[i:i+2])
+            i += 2
+        self.properties_start = i
+        props_len, i = decode_var_int(encoded, i)
+        self.payload_start = i + props_len
+        if(self.payload_start > len(encoded)): raise ValueError("Malformed PUBLISH")
+        self._topic_name = None             # Decoded values, None until first used
+        self._properties = None
+        self._payload = None
+
+    @property
+    def topic_name(self):
+        if(self._topic_name is None):
+            self._topic_name = str(self.encoded[self.topic_start:self.topic_end], 'utf-8')
+        return self._topic_name
+
+    @topic_name.setter
+    def topic_name(self, topic_name: str):
+        self._topic_name = topic_name
+
+    @property
+    def properties(self):
+        if(self._properties is None):
+            self._properties = decode_properties(self.encoded, self.properties_start)[0]
+        return self._properties
+
+    @properties.setter
+    def properties(self, properties: dict):
+        self._properties = properties
+
+    @property
+    def payload(self):
+        if(self._payload is None):
+            self._payload = memoryview(self.encoded)[self.payload_start:]
+        return self._payload
+
+    @payload.setter
+    def payload(self, payload: bytes | bytearray | memoryview | str):
+        self._payload = payload
+
+
+# PUBACK, PUBREC, PUBREL and PUBCOMP: packet id, reason code and properties, the last two omitted when the reason
+# code is 0x00 and there are no properties. Each packet type only allows the reason codes of its own table.
+class AckVariableHeader:
+    __slots__ = ("packet_id", "reason_code", "properties")
+    packet_name = ""
+    allowed_codes: dict[int, str] = dict()
+
+    def __init__(self, packet_id: int, reason_code: int, properties: dict | None = None):
         self.packet_id = packet_id
-        assert reason_code in puback_reason_codes
+        if(reason_code not in self.allowed_codes):
+            raise ValueError(f"Invalid {self.packet_name} reason code 0x{reason_code:02x}")
         self.reason_code = reason_code
-        # self.properties = properties
-        pass
+        self.properties = properties or dict()
 
     def encode(self):
-        encoded = self.packet_id.to_bytes(2)
-        encoded += self.reason_code.to_bytes(1)
-        encoded += (0).to_bytes(1) #assume no properties
-        return encoded
+        return PACKET_ID_REASON.pack(self.packet_id, self.reason_code) + encode_properties(self.properties)
 
     @classmethod
-    def decode(cls, encoded:bytes):
-        encoded = removeFixedHeader(encoded)
-        packet_id = int.from_bytes(encoded[:2])
-        reason_code = encoded[2]
-        return PubackVariableHeader(packet_id, reason_code)
+    def decode(cls, encoded: bytes, start: int | None = None):
+        i = variable_header_start(encoded) if start is None else start
+        packet_id = int.from_bytes(encoded[i:i+2])
+        reason_code = encoded[i+2] if len(encoded) > i+2 else 0x00    # Reason code and properties may be omitted
+        properties, _ = decode_properties(encoded, i+3) if len(encoded) > i+3 else (None, 0)
+        return cls(packet_id, reason_code, properties)
+
+
+class PubackVariableHeader(AckVariableHeader):
+    __slots__ = ()
+    packet_name = "PUBACK"
+    allowed_codes = puback_reason_codes
 
 
-class PubrecVariableHeader:
-    def __init__(self):
-        # self.properties = properties
-        pass
+class PubrecVariableHeader(AckVariableHeader):
+    __slots__ = ()
+    packet_name = "PUBREC"
+    allowed_codes = pubrec_reason_codes
 
 
-class PubrelVariableHeader:
-    def __init__(self):
-        # self.properties = properties
-        pass
+class PubrelVariableHeader(AckVariableHeader):
+    __slots__ = ()
+    packet_name = "PUBREL"
+    allowed_codes = pubrel_reason_codes
 
 
-class PubcompVariableHeader:
-    def __init__(self):
-        # self.properties = properties
-        pass
+class PubcompVariableHeader(AckVariableHeader):
+    __slots__ = ()
+    packet_name = "PUBCOMP"
+    allowed_codes = pubrel_reason_codes
 
 
 class SubscribeVariableHeader:
+    __slots__ = ("properties", "packet_id", "topics")
 
-    def __init__(self, packet_id: int, topics: list[tuple[str, int]]):
-        # self.properties = properties
+    def __init__(self, packet_id: int, topics: list[tuple[str, int]], properties: dict | None = None):
+        self.properties = properties or dict()
         self.packet_id = packet_id
         self.topics = topics
 
     def encode(self):
-        encoded = self.packet_id.to_bytes(2)
-        encoded += int_to_var_bytes(0) #assume no properties for now
+        parts = [PACKET_ID.pack(self.packet_id), encode_properties(self.properties)]
         for topic_filter, sub_options in self.topics:
-            encoded += str_to_bytes(topic_filter)
-            encoded += sub_options.to_bytes(1)
-        return encoded
+            parts.append(str_to_bytes(topic_filter))
+            parts.append(SINGLE_BYTES[sub_options])
+        return b"".join(parts)
     
     @classmethod
-    def decode(cls, encoded: bytes):
-        encoded = removeFixedHeader(encoded) #removing fixed header
-        packet_id = int.from_bytes(encoded[0:2])
-        i = 3 # 2 for packet_id, 1 for no props
+    def decode(cls, encoded: bytes, start: int | None = None):
+        i = variable_header_start(encoded) if start is None else start
+        packet_id = int.from_bytes(encoded[i:i+2])
+        properties, i = decode_properties(encoded, i+2)
         topics = []
         while(i < len(encoded)):
-            topic_filter, topic_len = bytes_to_str(encoded[i:])
-            i += topic_len+2
+            topic_filter, i = decode_str(encoded, i)
             sub_options = encoded[i]
             i+=1
             topics.append((topic_filter, sub_options))
-        return SubscribeVariableHeader(packet_id, topics)
+        return SubscribeVariableHeader(packet_id, topics, properties)
 
 
 class SubackVariableHeader:
+    __slots__ = ("properties", "packet_id", "reason_codes")
 
-    def __init__(self, packet_id: int, reason_code: int):
-        # self.properties = properties
+    def __init__(self, packet_id: int, reason_codes: list[int], properties: dict | None = None):
+        self.properties = properties or dict()
         self.packet_id = packet_id
-        assert reason_code in suback_reason_codes
-        self.reason_code = reason_code
+        for reason_code in reason_codes:                    # One per topic filter of the SUBSCRIBE
+            if(reason_code not in suback_reason_codes):
+                raise ValueError(f"Invalid SUBACK reason code 0x{reason_code:02x}")
+        self.reason_codes = reason_codes
 
     def encode(self):
-        encoded = self.packet_id.to_bytes(2)
-        encoded += int_to_var_bytes(0) #assume no properties for now
-        encoded += self.reason_code.to_bytes(1)
-        return encoded
+        return b"".join((PACKET_ID.pack(self.packet_id), encode_properties(self.properties), bytes(self.reason_codes)))
     
     @classmethod
-    def decode(cls, encoded: bytes):
-        encoded = removeFixedHeader(encoded) #removing fixed header
-        packet_id = int.from_bytes(encoded[0:2])
-        reason_code = encoded[-1]
-        return SubackVariableHeader(packet_id, reason_code)
+    def decode(cls, encoded: bytes, start: int | None = None):
+        i = variable_header_start(encoded) if start is None else start
+        packet_id = int.from_bytes(encoded[i:i+2])
+        properties, i = decode_properties(encoded, i+2)
+        return SubackVariableHeader(packet_id, list(encoded[i:]), properties)
 
 
 class UnsubscribeVariableHeader:
-    def __init__(self):
-        # self.properties = properties
-        pass
+    __slots__ = ("properties", "packet_id", "topics")
+
+    def __init__(self, packet_id: int, topics: list[str], properties: dict | None = None):
+        self.properties = properties or dict()
+        self.packet_id = packet_id
+        self.topics = topics
+
+    def encode(self):
+        parts = [PACKET_ID.pack(self.packet_id), encode_properties(self.properties)]
+        for topic_filter in self.topics:
+            parts.append(str_to_bytes(topic_filter))
+        return b"".join(parts)
+
+    @classmethod
+    def decode(cls, encoded: bytes, start: int | None = None):
+        i = variable_header_start(encoded) if start is None else start
+        packet_id = int.from_bytes(encoded[i:i+2])
+        properties, i = decode_properties(encoded, i+2)
+        topics = []
+        while(i < len(encoded)):
+            topic_filter, i = decode_str(encoded, i)
+            topics.append(topic_filter)
+        return UnsubscribeVariableHeader(packet_id, topics, properties)
 
 
 class UnsubackVariableHeader:
-    def __init__(self):
-        # self.properties = properties
-        pass
+    __slots__ = ("properties", "packet_id", "reason_codes")
+
+    def __init__(self, packet_id: int, reason_codes: list[int], properties: dict | None = None):
+        self.properties = properties or dict()
+        self.packet_id = packet_id
+        for reason_code in reason_codes:                    # One per topic filter of the UNSUBSCRIBE
+            if(reason_code not in unsuback_reason_codes):
+                raise ValueError(f"Invalid UNSUBACK reason code 0x{reason_code:02x}")
+        self.reason_codes = reason_codes
+
+    def encode(self):
+        return b"".join((PACKET_ID.pack(self.packet_id), encode_properties(self.properties), bytes(self.reason_codes)))
+
+    @classmethod
+    def decode(cls, encoded: bytes, start: int | None = None):
+        i = variable_header_start(encoded) if start is None else start
+        packet_id = int.from_bytes(encoded[i:i+2])
+        properties, i = decode_properties(encoded, i+2)
+        return UnsubackVariableHeader(packet_id, list(encoded[i:]), properties)
 
 
 class DisconnectVariableHeader:
-    def __init__(self, reason_code: int):
-        assert reason_code in disconnect_reason_codes
+    __slots__ = ("reason_code", "properties")
+
+    def __init__(self, reason_code: int, properties: dict | None = None):
+        if(reason_code not in disconnect_reason_codes):
+            raise ValueError(f"Invalid DISCONNECT reason code 0x{reason_code:02x}")
         self.reason_code = reason_code
-        # self.properties = properties
+        self.properties = properties or dict()
 
     def encode(self):
-        encoded = self.reason_code.to_bytes(1)
-        #TODO Add properties support
-        encoded += int_to_var_bytes(0) #assume no properties for now
-        return encoded
+        return SINGLE_BYTES[self.reason_code] + encode_properties(self.properties)
 
     @classmethod
-    def decode(cls, encoded: bytes):
-        encoded = removeFixedHeader(encoded) #removing fixed header
-        reason_code = encoded[1]
-        return DisconnectVariableHeader(reason_code)
+    def decode(cls, encoded: bytes, start: int | None = None):
+        i = variable_header_start(encoded) if start is None else start
+        reason_code = encoded[i] if len(encoded) > i else 0x00    # Empty body: normal disconnection
+        properties, _ = decode_properties(encoded, i+1) if len(encoded) > i+1 else (None, 0)
+        return DisconnectVariableHeader(reason_code, properties)
 
 
 class AuthVariableHeader:
-    def __init__(self):
-        # self.properties = properties
-        pass
+    __slots__ = ("reason_code", "properties")
+
+    def __init__(self, reason_code: int = 0x00, properties: dict | None = None):
+        if(reason_code not in auth_reason_codes):
+            raise ValueError(f"Invalid AUTH reason code 0x{reason_code:02x}")
+        self.reason_code = reason_code
+        self.properties = properties or dict()
+
+    def encode(self):
+        return SINGLE_BYTES[self.reason_code] + encode_properties(self.properties)
+
+    @classmethod
+    def decode(cls, encoded: bytes, start: int | None = None):
+        i = variable_header_start(encoded) if start is None else start
+        reason_code = encoded[i] if len(encoded) > i else 0x00    # Empty body: success
+        properties, _ = decode_properties(encoded, i+1) if len(encoded) > i+1 else (None, 0)
+        return AuthVariableHeader(reason_code, properties)
 
 
 variableHeaders = {